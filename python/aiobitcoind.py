@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Dave Pifke.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+asyncio JSON-RPC implementation for talking to bitcoind.  Requires Python
+3.7 or later.
+"""
+
+import asyncio
+import json
+import ssl
+import sys
+import time
+
+from pifkoin.bitcoind import IDEMPOTENT_METHODS, Bitcoind, BitcoindCommand, BitcoindException, BitcoindResult, BitcoindTransportError, logger
+
+
+class AsyncBitcoindCommand(BitcoindCommand):
+    """Awaitable callable representing a bitcoind JSON-RPC method."""
+
+    def __call__(self, *args, timeout=None):
+        """
+        JSON-RPC wrapper.  Returns a coroutine.
+
+        :param timeout:
+            Number of seconds to wait for the result, including any time
+            spent queued, before raising :class:`asyncio.TimeoutError`.  By
+            default, only the ``rpctimeout`` for the request itself applies.
+
+        """
+
+        return self.server._rpc_call(self.method, *args, timeout=timeout)
+
+
+class _AsyncConnection(object):
+    """A single keep-alive HTTP/1.1 connection to bitcoind."""
+
+    def __init__(self, server):
+        """Constructor."""
+
+        self.server = server
+        self.reader = None
+        self.writer = None
+        self.last_used = None
+        self.response_started = False
+
+    def is_stale(self):
+        """
+        Returns :const:`True` if the connection needs to be (re-)established
+        before sending another request.
+        """
+
+        return (
+            self.writer is None or
+            self.reader.at_eof() or
+            time.time() - self.last_used >= self.server._rpc_idle_timeout
+        )
+
+    async def connect(self):
+        """(Re-)establishes the connection to the server."""
+
+        reconnect = self.last_used is not None
+        self.close()
+        start = time.time()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.server._rpc_host,
+            self.server._rpc_port,
+            ssl=ssl.create_default_context() if self.server._rpc_ssl else None,
+        )
+        self.last_used = time.time()
+        if self.server.metrics is not None:
+            self.server.metrics.record_connect(self.last_used - start, reconnect)
+
+    def close(self):
+        """Closes the connection, if open."""
+
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _read_response(self):
+        """Reads an HTTP response, returning its status, reason and body."""
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            # A clean close, before any of the response.  (A reset raises
+            # ConnectionResetError from readline() instead.)
+            raise asyncio.IncompleteReadError(b'', None)
+        self.response_started = True
+        if not status_line.endswith(b'\n'):
+            raise ConnectionResetError('Connection closed by server partway through response')
+        try:
+            version, status, reason = status_line.decode('latin1').rstrip('\r\n').split(' ', 2)
+            status = int(status)
+        except ValueError:
+            raise BitcoindException('Invalid HTTP status line from bitcoind: %r' % status_line)
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2) # CRLF
+            while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # trailers
+            body = b''.join(chunks)
+        else:
+            body = await self.reader.read()
+
+        if headers.get('connection', '').lower() == 'close' or (
+            version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive'
+        ):
+            self.close()
+
+        return status, reason, body
+
+    async def request(self, body, resendable=False):
+        """
+        Sends *body* to the server and returns the response status, reason
+        and body.
+
+        :param resendable:
+            Whether the request can safely be sent again if the connection
+            fails after it was sent, as with :meth:`Bitcoind._rpc_finish`.
+
+        """
+
+        reused = not self.is_stale()
+        if not reused:
+            await self.connect()
+
+        request = b''.join((
+            b'POST / HTTP/1.1\r\n',
+            ('Host: %s:%d\r\n' % (self.server._rpc_host, self.server._rpc_port)).encode('latin1'),
+            ('Authorization: Basic %s\r\n' % self.server._rpc_auth).encode('latin1'),
+            b'Content-Type: application/json\r\n',
+            ('Content-Length: %d\r\n\r\n' % len(body)).encode('latin1'),
+            body,
+        ))
+
+        self.response_started = False
+        try:
+            self.writer.write(request)
+            await self.writer.drain()
+            response = await self._read_response()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            # As in Bitcoind._rpc_finish(), a keep-alive connection closed
+            # by the server gets one more try on a new connection, unless
+            # the server may have acted on the request and it isn't safe
+            # to send twice.  Only a clean close with nothing read rules
+            # that out; a reset may come after the server acted on it.
+            nothing_read = isinstance(e, asyncio.IncompleteReadError) and not e.partial and not self.response_started
+            if not reused or not (resendable or nothing_read):
+                raise
+            logger.debug('Connection to %s:%d was closed, reconnecting', self.server._rpc_host, self.server._rpc_port)
+            await self.connect()
+            self.response_started = False
+            self.writer.write(request)
+            await self.writer.drain()
+            response = await self._read_response()
+
+        self.last_used = time.time()
+        return response
+
+
+class _PendingCall(object):
+    """A queued JSON-RPC command waiting for a connection."""
+
+    __slots__ = ('method', 'args', 'future')
+
+    def __init__(self, method, args, future):
+        self.method = method
+        self.args = args
+        self.future = future
+
+
+class AsyncBitcoind(object):
+    """
+    asyncio JSON-RPC wrapper for talking to bitcoind.  Methods of instances
+    of this object correspond to server commands, and return coroutines,
+    e.g. ``await AsyncBitcoind().getblockcount()``.
+
+    Commands are queued and sent over a small number of keep-alive
+    connections.  When more commands are waiting than there are
+    connections, they are combined into JSON-RPC batches, so that any number
+    of commands can be in flight at once.
+    """
+
+    def __init__(self, config_filename=Bitcoind.DEFAULT_CONFIG_FILENAME, max_connections=4, max_batch=100, **config_options):
+        """
+        Constructor.  Parses RPC communication details from ``bitcoin.conf``
+        the same way :class:`Bitcoind` does.  Connections are established on
+        first use.
+
+        :param config_filename:
+            The filename from which the configuration should be read.
+
+        :param max_connections:
+            The maximum number of connections to open to the server.
+
+        :param max_batch:
+            The maximum number of queued commands to combine into a single
+            request.  Set to 1 to disable batching.
+
+        Any other arguments (including ``amounts``, ``metrics`` and
+        ``retry``) are passed to the :class:`Bitcoind` constructor.  Hedged
+        requests are not supported, so passing ``hedge`` raises
+        :exc:`TypeError`.
+
+        """
+
+        if config_options.get('hedge') is not None:
+            raise TypeError('AsyncBitcoind does not support hedged requests')
+
+        template = Bitcoind(config_filename, **config_options)
+        self._rpc_host = template._rpc_host
+        self._rpc_port = template._rpc_port
+        self._rpc_auth = template._rpc_auth
+        self._rpc_ssl = template._rpc_ssl
+        self._rpc_timeout = template._rpc_timeout
+        self._rpc_idle_timeout = template._rpc_idle_timeout
+        self._rpc_ids = template._rpc_ids
+        self._json_decoder = template._json_decoder
+        self._convert_result = template._convert_result
+        self.metrics = template.metrics
+        self.retry = template.retry
+
+        self.max_connections = max_connections
+        self.max_batch = max_batch
+
+        self._loop = None
+        self._queue = None
+        self._workers = []
+
+    def __getattr__(self, method):
+        """
+        Attribute getter.  Assumes the attribute being fetched is the name
+        of a JSON-RPC method.
+        """
+
+        return AsyncBitcoindCommand(method, self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _start(self):
+        """Starts the connection workers on the running event loop."""
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._workers = [
+                asyncio.ensure_future(self._worker())
+                for i in range(self.max_connections)
+            ]
+
+    async def _worker(self):
+        """
+        Sends queued commands over a single connection until cancelled.
+        """
+
+        conn = _AsyncConnection(self)
+        try:
+            while True:
+                calls = [await self._queue.get()]
+                while len(calls) < self.max_batch and not self._queue.empty():
+                    calls.append(self._queue.get_nowait())
+
+                # Skip anything which timed out while waiting in the queue:
+                calls = [call for call in calls if not call.future.done()]
+                if calls:
+                    await self._send(conn, calls)
+        finally:
+            conn.close()
+
+    async def _send(self, conn, calls):
+        """
+        Sends *calls* to the server as a single request, and resolves each
+        of their futures with the corresponding response entry.
+        """
+
+        requests = []
+        pending = {}
+        for call in calls:
+            rpc_id = next(self._rpc_ids)
+            pending[rpc_id] = call
+            requests.append({
+                'version': '1.1',
+                'method': call.method,
+                'params': call.args,
+                'id': rpc_id,
+            })
+
+        if len(requests) == 1:
+            method = requests[0]['method']
+            description = '"%s"' % method
+            body = json.dumps(requests[0]).encode('utf8')
+        else:
+            method = 'batch'
+            description = '%d-command batch' % len(requests)
+            body = json.dumps(requests).encode('utf8')
+
+        logger.debug('Starting %s JSON-RPC request', description)
+        start = time.time()
+        try:
+            status, reason, response_body = await asyncio.wait_for(
+                conn.request(body, all(call.method in IDEMPOTENT_METHODS for call in calls)),
+                self._rpc_timeout
+            )
+            elapsed = time.time() - start
+            logger.debug('Got %d (%s) %d byte response from server in %d ms', status, reason, len(response_body), elapsed * 1000.0)
+            try:
+                response_json = self._json_decoder.decode(response_body.decode('utf8'))
+            except ValueError as e:
+                if status != 200:
+                    raise BitcoindTransportError('%d (%s) response from bitcoind' % (status, reason), status)
+                raise BitcoindException('Error parsing bitcoind response: %s' % str(e))
+            if status != 200:
+                # Newer versions of bitcoind report errors with a 500
+                # status, but still include the JSON-RPC error in the body,
+                # as in Bitcoind._rpc_finish().
+                if not (isinstance(response_json, dict) and response_json.get('error')):
+                    raise BitcoindTransportError('%d (%s) response from bitcoind' % (status, reason), status)
+            elif self.metrics is not None:
+                self.metrics.record_request(method, elapsed, len(body), len(response_body))
+        except asyncio.CancelledError:
+            conn.close()
+            for call in calls:
+                if not call.future.done():
+                    call.future.set_exception(BitcoindTransportError('Connection closed'))
+            raise
+        except Exception as e:
+            conn.close()
+            if not isinstance(e, BitcoindException):
+                e = BitcoindTransportError('Error talking to bitcoind: %s' % (str(e) or type(e).__name__))
+            if self.metrics is not None:
+                self.metrics.record_error(method, e.args[0])
+            for call in calls:
+                if not call.future.done():
+                    call.future.set_exception(e)
+            return
+
+        if not isinstance(response_json, list):
+            response_json = [response_json]
+        for entry in response_json:
+            call = pending.pop(entry.get('id'), None) if isinstance(entry, dict) else None
+            if call is None and isinstance(entry, dict) and entry.get('error') and entry.get('id') is None:
+                # An error with no ID (such as "still loading") applies to
+                # the whole request:
+                for call in pending.values():
+                    if not call.future.done():
+                        call.future.set_result(entry)
+                pending.clear()
+            elif call is None:
+                logger.warning('Ignoring unexpected entry in response: %r', entry)
+            elif not call.future.done():
+                call.future.set_result(entry)
+        for call in pending.values():
+            if not call.future.done():
+                call.future.set_result({'error': 'No response from bitcoind'})
+
+    def _enqueue(self, method, args):
+        """Queues a command, returning a future for its response entry."""
+
+        self._start()
+        future = self._loop.create_future()
+        self._queue.put_nowait(_PendingCall(method, args, future))
+        return future
+
+    async def _rpc_call(self, method, *args, timeout=None):
+        """
+        Performs a JSON-RPC command on the server and returns the result.
+        The *timeout* includes any retries.
+        """
+
+        return await asyncio.wait_for(self._rpc_retry(method, args), timeout)
+
+    async def _rpc_retry(self, method, args):
+        """
+        Performs a JSON-RPC command, retrying according to :attr:`retry`,
+        like :meth:`Bitcoind._rpc_retry`.
+        """
+
+        attempt = 1
+        while True:
+            try:
+                return await self._rpc_call_once(method, args)
+            except BitcoindException as e:
+                delay = None if self.retry is None else self.retry.delay((method,), attempt, e)
+                if delay is None:
+                    raise
+                logger.warning('Retrying %s in %.2f seconds (attempt %d failed)', method, delay, attempt)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _rpc_call_once(self, method, args):
+        """Performs a single attempt at :meth:`_rpc_call`."""
+
+        entry = await self._enqueue(method, args)
+        if entry.get('error'):
+            if self.metrics is not None:
+                self.metrics.record_error(method, entry['error'])
+            raise BitcoindException(entry['error'])
+        elif 'result' in entry:
+            return self._convert_result(method, entry['result'])
+        else:
+            raise BitcoindException('Invalid response from bitcoind')
+
+    async def call(self, method, *args, timeout=None):
+        """
+        Performs the JSON-RPC command *method*.  Equivalent to
+        ``await self.method(*args)``, for method names which aren't valid
+        Python identifiers.
+        """
+
+        return await self._rpc_call(method.lower(), *args, timeout=timeout)
+
+    def batch(self):
+        """
+        Returns an :class:`AsyncBitcoindBatch` for sending several commands
+        at once, e.g.::
+
+            async with conn.batch() as b:
+                hashes = [b.getblockhash(h) for h in range(1000)]
+            hashes = [h.result() for h in hashes]
+
+        """
+
+        return AsyncBitcoindBatch(self)
+
+    async def close(self):
+        """
+        Stops the connection workers and closes their connections.  Commands
+        which haven't been answered yet fail with
+        :exc:`BitcoindTransportError`.
+        """
+
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+        # Those in flight were failed by _send(); these never got that far:
+        while self._queue is not None and not self._queue.empty():
+            call = self._queue.get_nowait()
+            if not call.future.done():
+                call.future.set_exception(BitcoindTransportError('Connection closed'))
+        self._loop = self._queue = None
+        self._workers = []
+
+
+class AsyncBitcoindBatch(object):
+    """
+    Collects JSON-RPC commands to be sent to bitcoind together, like
+    :class:`pifkoin.bitcoind.BitcoindBatch`.  The batch is split into
+    requests of at most ``max_batch`` commands, which are sent concurrently
+    over all of the server's connections.
+    """
+
+    def __init__(self, server):
+        """Constructor."""
+
+        self.server = server
+        self._pending = []
+
+    def __getattr__(self, method):
+        """
+        Attribute getter.  Assumes the attribute being fetched is the name
+        of a JSON-RPC method.
+        """
+
+        return BitcoindCommand(method, self)
+
+    def __len__(self):
+        """Returns the number of commands waiting to be sent."""
+
+        return len(self._pending)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute()
+
+    def _rpc_call(self, method, *args):
+        """Queues a JSON-RPC command, returning its result placeholder."""
+
+        call = BitcoindResult(method, args)
+        self._pending.append(call)
+        return call
+
+    async def execute(self, timeout=None):
+        """
+        Sends all queued commands to the server, and returns their
+        :class:`BitcoindResult` placeholders in the order they were queued.
+
+        :param timeout:
+            Number of seconds to wait for the whole batch.
+
+        """
+
+        calls, self._pending = self._pending, []
+
+        # Everything is queued at once, so the workers pick the commands up
+        # in batches of up to max_batch, and send those concurrently.
+        futures = [self.server._enqueue(call.method, call.args) for call in calls]
+        entries = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), timeout)
+
+        for call, entry in zip(calls, entries):
+            if isinstance(entry, BaseException):
+                # Including CancelledError, whose message is empty:
+                call._set(error=str(entry) or type(entry).__name__)
+            elif entry.get('error'):
+                call._set(error=entry['error'])
+                if self.server.metrics is not None:
+                    self.server.metrics.record_error(call.method, entry['error'])
+            elif 'result' in entry:
+                call._set(result=self.server._convert_result(call.method, entry['result']))
+            else:
+                call._set(error='Invalid response from bitcoind')
+
+        return calls
+
+
+def _self_test():
+    """
+    Checks that a call which isn't idempotent is only resent after the
+    server cleanly closes a keep-alive connection, not after it resets it.
+    Run with ``--self-test``.
+    """
+
+    import socket
+    import struct
+
+    async def test(failure):
+        methods = []
+
+        async def handle(reader, writer):
+            # Answers the first request on each connection, and fails the
+            # second in the given way:
+            for count in range(2):
+                try:
+                    headers = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                length = int(headers.lower().split(b'content-length:')[1].split(b'\r\n')[0])
+                request = json.loads((await reader.readexactly(length)).decode('utf8'))
+                methods.append(request['method'])
+                if count:
+                    break
+                body = json.dumps({'result': 1, 'error': None, 'id': request['id']}).encode('utf8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+                await writer.drain()
+            if failure == 'reset':
+                writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                writer.transport.abort()
+            else:
+                writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncBitcoind('/dev/null', max_connections=1, rpcserver='127.0.0.1', rpcport=str(port), rpcuser='pifkoin', rpcpassword='pifkoin') as conn:
+            await conn.getblockcount()
+            try:
+                await conn.sendtoaddress('address', 1)
+            except BitcoindTransportError:
+                sent = False
+            else:
+                sent = True
+        server.close()
+        await server.wait_closed()
+        return sent, methods.count('sendtoaddress')
+
+    assert asyncio.run(test('reset')) == (False, 1), 'Resent a call after the connection was reset'
+    assert asyncio.run(test('close')) == (True, 2), 'Failed to resend a call after the connection was closed'
+    print('Only resent calls when safe')
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig()
+
+    if sys.argv[1:] == ['--self-test']:
+        _self_test()
+        sys.exit(0)
+
+    method_name = sys.argv[1] if len(sys.argv) > 1 else 'help'
+
+    async def main():
+        async with AsyncBitcoind() as conn:
+            return await conn.call(method_name, *sys.argv[2:])
+
+    try:
+        print(asyncio.run(main()))
+    except BitcoindException:
+        sys.exit(1)
+    else:
+        sys.exit(0)
+
+# eof
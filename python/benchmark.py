@@ -0,0 +1,667 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Dave Pifke.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Benchmarks for the Pifkoin library.  Run from the commandline, e.g.::
+
+    python -m pifkoin.benchmark decode
+    python -m pifkoin.benchmark rpc 5000
+    python -m pifkoin.benchmark retry 1000 [failure_pct]
+    python -m pifkoin.benchmark nonces 20000
+    python -m pifkoin.benchmark lanes 1000000
+    python -m pifkoin.benchmark update 1024
+    python -m pifkoin.benchmark variants 5000
+    python -m pifkoin.benchmark blockfiles 5000
+    python -m pifkoin.benchmark headerstore 100000
+    python -m pifkoin.benchmark validate 100000
+    python -m pifkoin.benchmark blockindex 100000 [latency_ms]
+
+Requires Python 3.7 or later.
+"""
+
+import asyncio
+import binascii
+import concurrent.futures
+import contextlib
+import decimal
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pifkoin.aiobitcoind
+import pifkoin.bitcoind
+import pifkoin.blockchain
+import pifkoin.blockfiles
+import pifkoin.blockindex
+import pifkoin.mockbitcoind
+import pifkoin.sha256
+
+
+def measure(func, *args):
+    """
+    Runs *func*, returning its result along with the elapsed time in
+    seconds and the peak memory allocated while it ran, in bytes.
+    """
+
+    tracemalloc.start()
+    try:
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+class _CannedResponse(object):
+    """Stands in for an HTTP response from bitcoind with a fixed body."""
+
+    def __init__(self, body):
+        self.status = 200
+        self.reason = 'OK'
+        self._body = memoryview(body)
+        self._pos = 0
+
+    def read(self, size=-1):
+        # Always returns a copy, like reading from a socket would.
+        end = len(self._body) if size < 0 else self._pos + size
+        data = self._body[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+
+
+def benchmark_decode(count=100000):
+    """
+    Compares the time and peak memory used to decode a large
+    ``listunspent``-style response, using each of the representations
+    supported by :class:`pifkoin.bitcoind.Bitcoind`, and :meth:`stream`.
+    """
+
+    body = json.dumps({
+        'result': [
+            {
+                'txid': '%064x' % i,
+                'vout': i % 4,
+                'address': '1BitcoinEaterAddressDontSendf59kuE',
+                'scriptPubKey': '76a914%040x88ac' % i,
+                'amount': (i % 100000) / 1e5,
+                'confirmations': i,
+                'spendable': True,
+            }
+            for i in range(count)
+        ],
+        'error': None,
+        'id': 1,
+    }).encode('utf8')
+    print('Decoding %d byte response with %d elements:' % (len(body), count))
+
+    def send(method, payload, stream=False):
+        response = _CannedResponse(body)
+        if not stream:
+            response.body = response.read()
+        return response
+
+    def original():
+        # How Bitcoind._rpc_call() used to do it, for comparison:
+        response = send(None, None)
+        return json.loads(response.body.decode('utf8'), parse_float=decimal.Decimal)['result']
+
+    def full(conn):
+        return conn.listunspent()
+
+    def streamed(conn):
+        # The point of streaming is not to keep every element around:
+        return sum(1 for element in conn.stream('listunspent'))
+
+    print('%-20s %10s %12s' % ('Mode', 'Seconds', 'Peak MB'))
+    result, elapsed, peak = measure(original)
+    print('%-20s %10.2f %12.1f' % ('original', elapsed, peak / 1e6))
+    del result
+
+    for amounts in (None, 'decimal', 'satoshi', 'float'):
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', amounts=amounts, rpcuser='benchmark', rpcpassword='benchmark')
+        conn._rpc_send = send
+        for func in (full, streamed):
+            result, elapsed, peak = measure(func, conn)
+            print('%-20s %10.2f %12.1f' % ('%s (%s)' % (func.__name__, amounts or 'default'), elapsed, peak / 1e6))
+            del result
+
+
+@contextlib.contextmanager
+def mock_server(*args):
+    """
+    Context manager which runs :mod:`pifkoin.mockbitcoind` in a separate
+    process (so it doesn't compete with the benchmark for the GIL), passing
+    it *args*, and returns :class:`pifkoin.bitcoind.Bitcoind` constructor
+    options for connecting to it.
+    """
+
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'pifkoin.mockbitcoind', '--port', '0'] + list(args),
+        stdout=subprocess.PIPE,
+    )
+    try:
+        host, port = proc.stdout.readline().decode('ascii').split()[-1].rsplit(':', 1)
+        yield {
+            'rpcserver': host,
+            'rpcport': port,
+            'rpcuser': 'pifkoin',
+            'rpcpassword': 'pifkoin',
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _percentile(latencies, fraction):
+    """Returns the given percentile of the sorted list *latencies*."""
+
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def benchmark_rpc(calls=2000, latency_ms=0, blocks=1000):
+    """
+    Measures throughput and latency of ``getblockhash`` calls against the
+    mock server, using each of the ways :mod:`pifkoin.bitcoind` can talk to
+    bitcoind.  *latency_ms* is added to every response by the server.
+    """
+
+    def timed(func, *args):
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+
+    def new_connection(config):
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', **config)
+        def call(height):
+            conn.close()
+            conn.getblockhash(height)
+        return [timed(call, i % blocks) for i in range(calls)]
+
+    def keep_alive(config):
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', **config)
+        return [timed(conn.getblockhash, i % blocks) for i in range(calls)]
+
+    def batch(config, size=100):
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', **config)
+        def call(start):
+            with conn.batch() as b:
+                for i in range(start, min(start + size, calls)):
+                    b.getblockhash(i % blocks)
+        # Latency is per request, rather than per command:
+        return [timed(call, i) for i in range(0, calls, size)]
+
+    def pool(config, threads=4):
+        conn = pifkoin.bitcoind.BitcoindPool('/dev/null', max_size=threads, **config)
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(lambda i: timed(conn.getblockhash, i % blocks), range(calls)))
+
+    def async_(config, connections=4):
+        async def call(conn, height):
+            start = time.perf_counter()
+            await conn.getblockhash(height)
+            return time.perf_counter() - start
+
+        async def main():
+            async with pifkoin.aiobitcoind.AsyncBitcoind('/dev/null', max_connections=connections, **config) as conn:
+                # Limit the number of calls in flight, so latency means
+                # something:
+                latencies = []
+                for start in range(0, calls, connections * 25):
+                    latencies.extend(await asyncio.gather(*[
+                        call(conn, i % blocks)
+                        for i in range(start, min(start + connections * 25, calls))
+                    ]))
+                return latencies
+
+        return asyncio.run(main())
+
+    def async_batch(config, size=100):
+        async def call(conn, start):
+            began = time.perf_counter()
+            async with conn.batch() as b:
+                results = [b.getblockhash(i % blocks) for i in range(start, min(start + size, calls))]
+            elapsed = time.perf_counter() - began
+            assert all(len(r.result()) == 64 for r in results), 'Batch returned the wrong results'
+            return elapsed
+
+        async def main():
+            async with pifkoin.aiobitcoind.AsyncBitcoind('/dev/null', **config) as conn:
+                return [await call(conn, i) for i in range(0, calls, size)]
+
+        return asyncio.run(main())
+
+    modes = (
+        ('new connection', new_connection),
+        ('keep-alive', keep_alive),
+        ('batch (100)', batch),
+        ('pool (4 threads)', pool),
+        ('async (4 conns)', async_),
+        ('async batch (100)', async_batch),
+    )
+
+    print('%d getblockhash calls, %d ms server latency:' % (calls, latency_ms))
+    print('%-20s %10s %10s %10s' % ('Mode', 'Calls/s', 'p50 ms', 'p99 ms'))
+    with mock_server('--blocks', str(blocks), '--latency', str(latency_ms / 1000.0)) as config:
+        for name, func in modes:
+            start = time.perf_counter()
+            latencies = sorted(func(config))
+            elapsed = time.perf_counter() - start
+            print('%-20s %10.0f %10.2f %10.2f' % (
+                name,
+                calls / elapsed,
+                _percentile(latencies, 0.5) * 1000.0,
+                _percentile(latencies, 0.99) * 1000.0,
+            ))
+
+
+def benchmark_retry(calls=1000, failure_pct=20, blocks=1000):
+    """
+    Makes *calls* ``getblockhash`` calls against the mock server, which
+    fails *failure_pct* percent of requests in each of the ways it can,
+    with the synchronous and asynchronous clients retrying according to a
+    :class:`pifkoin.bitcoind.RetryPolicy`.  Every call should succeed.
+    """
+
+    retry = pifkoin.bitcoind.RetryPolicy(attempts=20, backoff=0.001, max_backoff=0.01)
+
+    def sync(config):
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', retry=retry, **config)
+        results = [conn.getblockhash(i % blocks) for i in range(calls)]
+        conn.close()
+        return results
+
+    def async_(config):
+        async def main():
+            async with pifkoin.aiobitcoind.AsyncBitcoind('/dev/null', retry=retry, **config) as conn:
+                return await asyncio.gather(*[conn.getblockhash(i % blocks) for i in range(calls)])
+
+        return asyncio.run(main())
+
+    print('%d getblockhash calls, %d%% of requests failing:' % (calls, failure_pct))
+    print('%-10s %-8s %10s %10s' % ('Failure', 'Client', 'Seconds', 'Calls/s'))
+    # Otherwise every failed attempt is logged:
+    logging.getLogger('bitcoin').setLevel(logging.CRITICAL)
+    try:
+        for mode in pifkoin.mockbitcoind.MockBitcoind.FAILURE_MODES:
+            with mock_server(
+                '--blocks', str(blocks), '--failure-rate', str(failure_pct / 100.0), '--failure-modes', mode
+            ) as config:
+                for name, func in (('sync', sync), ('async', async_)):
+                    began = time.perf_counter()
+                    results = func(config)
+                    elapsed = time.perf_counter() - began
+                    assert all(len(h) == 64 for h in results), 'Calls failed despite retrying'
+                    print('%-10s %-8s %10.2f %10.0f' % (mode, name, elapsed, calls / elapsed))
+    finally:
+        logging.getLogger('bitcoin').setLevel(logging.NOTSET)
+
+
+# The genesis block, for mining benchmarks:
+GENESIS = pifkoin.blockchain.BlockHeader(
+    version=1,
+    previousblockhash=b'\x00' * 32,
+    merkleroot=binascii.unhexlify('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'),
+    time=1231006505,
+    bits=binascii.unhexlify('1d00ffff'),
+    nonce=2083236893,
+)
+
+
+def benchmark_nonces(count=20000, max_processes=None):
+    """
+    Measures the hash rate of :meth:`pifkoin.blockchain.BlockHeader.find_nonces`
+    searching *count* nonces around the genesis block's, using from one
+    process up to *max_processes* (by default, one per CPU).
+    """
+
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    start = GENESIS.nonce - count // 2
+    end = start + count - 1
+
+    print('Searching %d nonces (%d CPUs):' % (count, multiprocessing.cpu_count()))
+    print('%-10s %10s %10s %10s' % ('Processes', 'Seconds', 'H/s', 'Speedup'))
+    processes = 1
+    baseline = None
+    while processes <= max_processes:
+        began = time.perf_counter()
+        found = [
+            bh.nonce
+            for bh in GENESIS.find_nonces(start, end, processes=processes, chunk_size=max(1, count // (processes * 8)))
+        ]
+        elapsed = time.perf_counter() - began
+        assert found == [GENESIS.nonce], 'Expected to find %d, got %r' % (GENESIS.nonce, found)
+
+        rate = count / elapsed
+        baseline = baseline or rate
+        print('%-10d %10.2f %10.0f %9.1fx' % (processes, elapsed, rate, rate / baseline))
+        processes *= 2
+
+
+def benchmark_lanes(count=1000000, scalar_count=5000):
+    """
+    Compares the hash rate of the scalar and vectorized (``lanes``) nonce
+    search, with various numbers of lanes, using NumPy arrays and then
+    bit-slicing.  The scalar search is much slower, so it only tries
+    *scalar_count* nonces.  Every search is centered on the genesis block's
+    nonce, and must find it.
+    """
+
+    sha = pifkoin.sha256
+    print('%-16s %-10s %10s %10s %12s %10s' % ('Class', 'Lanes', 'Nonces', 'Seconds', 'H/s', 'Speedup'))
+    baseline = None
+    for sha_impl, lanes in (
+        (sha.SHA256, 1),
+        (sha.FastSHA256, 1),
+        (sha.SHA256, 64),
+        (sha.SHA256, 512),
+        (sha.SHA256, 4096),
+        (sha.SHA256, 32768),
+        (sha.BitslicedSHA256, 256),
+        (sha.BitslicedSHA256, 1024),
+        (sha.BitslicedSHA256, 4096),
+        (sha.BitslicedSHA256, 16384),
+    ):
+        n = scalar_count if lanes == 1 else count
+        start = GENESIS.nonce - n // 2
+        began = time.perf_counter()
+        found = [bh.hash for bh in GENESIS.find_nonces(start, start + n - 1, sha_impl=sha_impl, lanes=lanes)]
+        elapsed = time.perf_counter() - began
+        assert found == [GENESIS.calculate_hash()], 'Expected to find genesis block, got %r' % found
+
+        rate = n / elapsed
+        baseline = baseline or rate
+        print('%-16s %-10d %10d %10.2f %12.0f %9.0fx' % (sha_impl.__name__, lanes, n, elapsed, rate, rate / baseline))
+
+
+def benchmark_update(max_kb=256):
+    """
+    Hashes inputs of doubling size, up to *max_kb* kilobytes, with
+    :class:`pifkoin.sha256.FastSHA256`, to show that the time taken by
+    ``update()`` grows linearly.  Each input is read from a memory-mapped
+    file, like a raw block would be.
+    """
+
+    print('%-10s %10s %10s %10s' % ('KB', 'Seconds', 'KB/s', 'Peak MB'))
+    with tempfile.TemporaryFile() as f:
+        f.write(os.urandom(max_kb * 1024))
+        f.flush()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(data) as view:
+                kb = 16
+                while kb <= max_kb:
+                    def run():
+                        h = pifkoin.sha256.FastSHA256()
+                        h.update(view[:kb * 1024])
+                        return h.digest()
+
+                    result, elapsed, peak = measure(run)
+                    print('%-10d %10.2f %10.1f %10.2f' % (kb, elapsed, kb / elapsed, peak / 1e6))
+                    kb *= 2
+        finally:
+            data.close()
+
+
+def benchmark_variants(count=2000):
+    """
+    Compares the double SHA256 throughput of full hashes against variants
+    which give up after 61 rounds of the second hash (as miners do) if the
+    header can't meet the minimum difficulty, over *count* random headers.
+    Also reports the time spent in reduced-round hashes, for comparison.
+    """
+
+    sha = pifkoin.sha256
+    headers = [os.urandom(80) for i in range(count)]
+    exits = {61: lambda state: state.e == 0xa41f32e7}
+
+    def full(impl):
+        for header in headers:
+            impl(impl(header).digest(), 128).digest()
+
+    def early_exit(impl):
+        variant = impl.variant(exits=exits)
+        for header in headers:
+            try:
+                variant(impl(header).digest(), 128).digest()
+            except sha.EarlyTermination:
+                pass
+
+    def reduced(impl, rounds):
+        variant = impl.variant(rounds)
+        def run(impl):
+            for header in headers:
+                variant(variant(header).digest(), 128).digest()
+        return run
+
+    print('%-12s %-20s %10s %10s %10s' % ('Class', 'Double SHA256', 'Seconds', 'H/s', 'Speedup'))
+    for impl in (sha.SHA256, sha.FastSHA256):
+        baseline = None
+        for label, func in (
+            ('full', full),
+            ('exit after 61', early_exit),
+            ('32 rounds', reduced(impl, 32)),
+            ('16 rounds', reduced(impl, 16)),
+        ):
+            began = time.perf_counter()
+            func(impl)
+            elapsed = time.perf_counter() - began
+            baseline = baseline or elapsed
+            print('%-12s %-20s %10.2f %10.0f %9.2fx' % (impl.__name__, label, elapsed, count / elapsed, baseline / elapsed))
+
+
+def benchmark_blockfiles(blocks=5000, latency_ms=0):
+    """
+    Compares reading every header of a *blocks*-long chain from
+    ``blk*.dat`` files against fetching them from the mock server with
+    :meth:`pifkoin.blockchain.BlockHeader.range`.  Each synthetic block has
+    a kilobyte of transaction data after its header.
+    """
+
+    chain = pifkoin.mockbitcoind.MockChain(blocks)
+    directory = tempfile.mkdtemp()
+    try:
+        per_file = 1000
+        for i in range(0, blocks, per_file):
+            pifkoin.blockfiles.write_block_file(
+                os.path.join(directory, 'blk%05d.dat' % (i // per_file)),
+                [header + b'\x01' + os.urandom(1024) for header in chain.headers[i:i+per_file]],
+            )
+
+        print('%-12s %10s %10s %12s' % ('Source', 'Headers', 'Seconds', 'Headers/s'))
+
+        reader = pifkoin.blockfiles.BlockFileReader(directory)
+        began = time.perf_counter()
+        hashes = [header.hash for header in reader.headers()]
+        elapsed = time.perf_counter() - began
+        assert hashes == [h[::-1] for h in chain.hashes], 'Read the wrong headers from files'
+        print('%-12s %10d %10.2f %12.0f' % ('blk*.dat', len(hashes), elapsed, len(hashes) / elapsed))
+
+        with mock_server('--blocks', str(blocks), '--latency', str(latency_ms / 1000.0)) as config:
+            conn = pifkoin.bitcoind.Bitcoind('/dev/null', **config)
+            began = time.perf_counter()
+            hashes = [header.hash for header in pifkoin.blockchain.BlockHeader.range(bitcoind=conn)]
+            elapsed = time.perf_counter() - began
+            conn.close()
+        assert hashes == [h[::-1] for h in chain.hashes], 'Fetched the wrong headers'
+        print('%-12s %10d %10.2f %12.0f' % ('range()', len(hashes), elapsed, len(hashes) / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_headerstore(blocks=100000):
+    """
+    Compares the memory taken by *blocks* headers as a list of
+    :class:`pifkoin.blockchain.BlockHeader` instances and as a
+    :class:`pifkoin.blockchain.HeaderStore`, and times saving and loading
+    the store.
+    """
+
+    chain = pifkoin.mockbitcoind.MockChain(blocks)
+    from_bytes = pifkoin.blockchain.BlockHeader.from_bytes
+
+    def build_list():
+        return [from_bytes(header, height=height, hash=h[::-1]) for height, (header, h) in enumerate(zip(chain.headers, chain.hashes))]
+
+    def build_store():
+        store = pifkoin.blockchain.HeaderStore()
+        store.extend(chain.headers)
+        return store
+
+    print('%-24s %10s %10s %12s' % ('Operation', 'Seconds', 'Peak MB', 'Bytes/header'))
+    headers, elapsed, peak = measure(build_list)
+    print('%-24s %10.2f %10.1f %12.0f' % ('list of BlockHeader', elapsed, peak / 1e6, peak / blocks))
+    del headers
+
+    store, elapsed, peak = measure(build_store)
+    print('%-24s %10.2f %10.1f %12.0f' % ('HeaderStore.append()', elapsed, peak / 1e6, peak / blocks))
+
+    with tempfile.NamedTemporaryFile() as f:
+        result, elapsed, peak = measure(store.save, f.name)
+        print('%-24s %10.2f %10.1f %12.0f' % ('HeaderStore.save()', elapsed, peak / 1e6, peak / blocks))
+
+        loaded, elapsed, peak = measure(pifkoin.blockchain.HeaderStore.load, f.name)
+        print('%-24s %10.2f %10.1f %12.0f' % ('HeaderStore.load()', elapsed, peak / 1e6, peak / blocks))
+        assert loaded.hashes == store.hashes, 'Loaded the wrong headers'
+
+
+def benchmark_validate(blocks=100000, max_processes=None, fast_blocks=2000):
+    """
+    Measures how many headers per second
+    :meth:`pifkoin.blockchain.ChainValidator.validate` checks, from a
+    synthetic chain of *blocks* headers, hashing with :mod:`hashlib` and
+    then with :class:`pifkoin.sha256.FastSHA256` (on the first
+    *fast_blocks* only), using from one process up to *max_processes* (by
+    default, one per CPU).
+    """
+
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    chain = pifkoin.mockbitcoind.MockChain(blocks)
+    pow_limit = pifkoin.blockchain.uncompact(b'\x20\x7f\xff\xff')
+
+    print('Validating %d headers (%d CPUs):' % (blocks, multiprocessing.cpu_count()))
+    print('%-12s %10s %10s %12s %10s' % ('SHA256', 'Processes', 'Seconds', 'Headers/s', 'Speedup'))
+    for name, sha_impl, count in (
+        ('hashlib', hashlib.sha256, blocks),
+        ('FastSHA256', pifkoin.sha256.FastSHA256, min(blocks, fast_blocks)),
+    ):
+        processes = 1
+        baseline = None
+        while processes <= max_processes:
+            # The MockChain's timestamps are regularly spaced, and its
+            # target never changes, like regtest:
+            validator = pifkoin.blockchain.ChainValidator(pow_limit=pow_limit, retarget=False)
+            headers = (pifkoin.blockchain.BlockHeader.from_bytes(header) for header in chain.headers[:count])
+
+            began = time.perf_counter()
+            checked = sum(1 for header in validator.validate(
+                headers, sha_impl=sha_impl, processes=processes, chunk_size=max(1, min(2000, count // (processes * 8)))
+            ))
+            elapsed = time.perf_counter() - began
+            assert checked == count and validator.hash == chain.hashes[count - 1][::-1], 'Validated the wrong chain'
+
+            rate = count / elapsed
+            baseline = baseline or rate
+            print('%-12s %10d %10.2f %12.0f %9.1fx' % (name, processes, elapsed, rate, rate / baseline))
+            processes *= 2
+
+
+def benchmark_blockindex(blocks=100000, latency_ms=0, lookups=10000):
+    """
+    Times building a :class:`pifkoin.blockindex.BlockIndex` of a
+    *blocks*-long chain from the mock server, updating it when nothing has
+    changed, and looking up the hashes of *lookups* random heights in the
+    index and from the server.
+    """
+
+    heights = [random.randrange(blocks) for i in range(lookups)]
+    directory = tempfile.mkdtemp()
+    try:
+        with mock_server('--blocks', str(blocks), '--latency', str(latency_ms / 1000.0)) as config:
+            conn = pifkoin.bitcoind.Bitcoind('/dev/null', **config)
+            index = pifkoin.blockindex.BlockIndex(os.path.join(directory, 'index.db'))
+
+            print('%-24s %10s %10s' % ('Operation', 'Count', 'Seconds'))
+            for name in ('update() (new index)', 'update() (no change)'):
+                began = time.perf_counter()
+                index.update(bitcoind=conn)
+                print('%-24s %10d %10.3f' % (name, blocks, time.perf_counter() - began))
+            assert len(index) == blocks, 'Indexed the wrong number of blocks'
+
+            print()
+            print('%-24s %10s %10s %10s' % ('Lookup', 'Count', 'Seconds', 'us/lookup'))
+            for name, lookup in (
+                ('BlockIndex.hash()', index.hash),
+                ('getblockhash', conn.getblockhash),
+            ):
+                began = time.perf_counter()
+                for height in heights:
+                    lookup(height)
+                elapsed = time.perf_counter() - began
+                print('%-24s %10d %10.3f %10.1f' % (name, lookups, elapsed, elapsed / lookups * 1e6))
+
+            index.close()
+            conn.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    'blockfiles': benchmark_blockfiles,
+    'blockindex': benchmark_blockindex,
+    'decode': benchmark_decode,
+    'headerstore': benchmark_headerstore,
+    'lanes': benchmark_lanes,
+    'nonces': benchmark_nonces,
+    'retry': benchmark_retry,
+    'rpc': benchmark_rpc,
+    'update': benchmark_update,
+    'validate': benchmark_validate,
+    'variants': benchmark_variants,
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: %s {%s} [args...]' % (sys.argv[0], ','.join(sorted(BENCHMARKS))))
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
+
+# eof
@@ -24,22 +24,129 @@
 """JSON-RPC implementation for talking to bitcoind."""
 
 import base64
+import bisect
+import codecs
 import collections
+import contextlib
+import copy
 import decimal
 try:
     import http.client as httplib
 except ImportError:
     import httplib
+import itertools
 import json
 import logging
 import os
+import random
+import re
+import select
+import shelve
 import socket
 import sys
+import threading
 import time
 
+if sys.version > '3':
+    long = int
+
 logger = logging.getLogger('bitcoin')
 
 
+# Fields in JSON-RPC results which hold bitcoin amounts:
+AMOUNT_FIELDS = frozenset((
+    'amount',
+    'balance',
+    'fee',
+    'fees',
+    'immature_balance',
+    'modifiedfee',
+    'paytxfee',
+    'relayfee',
+    'unconfirmed_balance',
+    'value',
+))
+
+# JSON-RPC methods whose result is an amount:
+AMOUNT_RESULTS = frozenset((
+    'getbalance',
+    'getreceivedbyaccount',
+    'getreceivedbyaddress',
+    'getunconfirmedbalance',
+    'listaccounts',
+))
+
+# JSON-RPC methods which don't change anything on the server, and so can be
+# sent again if there's no response:
+IDEMPOTENT_METHODS = frozenset((
+    'decoderawtransaction',
+    'decodescript',
+    'estimatefee',
+    'estimatesmartfee',
+    'getbalance',
+    'getbestblockhash',
+    'getblock',
+    'getblockchaininfo',
+    'getblockcount',
+    'getblockhash',
+    'getblockheader',
+    'getchaintips',
+    'getconnectioncount',
+    'getdifficulty',
+    'getinfo',
+    'getmempoolentry',
+    'getmempoolinfo',
+    'getmininginfo',
+    'getnettotals',
+    'getnetworkinfo',
+    'getpeerinfo',
+    'getrawmempool',
+    'getrawtransaction',
+    'getreceivedbyaddress',
+    'gettransaction',
+    'gettxout',
+    'gettxoutsetinfo',
+    'getunconfirmedbalance',
+    'getwalletinfo',
+    'listsinceblock',
+    'listtransactions',
+    'listunspent',
+    'validateaddress',
+))
+
+# Cheap JSON-RPC methods whose result is the same on any up-to-date node, for
+# which it makes sense to hedge requests:
+HEDGE_METHODS = frozenset((
+    'getbestblockhash',
+    'getblock',
+    'getblockcount',
+    'getblockhash',
+    'getblockheader',
+    'getdifficulty',
+    'getrawtransaction',
+))
+
+
+def _btc_to_satoshi(value):
+    """Converts a bitcoin amount (as decoded from JSON) to satoshis."""
+
+    return long(round(value * 100000000))
+
+_AMOUNT_CONVERTERS = {
+    'decimal': lambda value: decimal.Decimal(_btc_to_satoshi(value)).scaleb(-8),
+    'float': float,
+    'satoshi': _btc_to_satoshi,
+}
+
+
+def _convert_amount(value, amounts):
+    """Converts *value* to the representation named by *amounts*."""
+
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return _AMOUNT_CONVERTERS[amounts](value)
+    return value
+
+
 class BitcoindException(Exception):
     """Exception thrown for errors talking to bitcoind."""
 
@@ -50,6 +157,100 @@ class BitcoindException(Exception):
         logger.error(value)
 
 
+class BitcoindTransportError(BitcoindException):
+    """
+    Exception thrown when a command could not be completed because of a
+    problem communicating with bitcoind, rather than an error reported by
+    it.  The command may or may not have been carried out.
+    """
+
+    def __init__(self, value, status=None):
+        """
+        Constructor.
+
+        :param status:
+            The HTTP status returned by the server, if it got that far.
+
+        """
+
+        super(BitcoindTransportError, self).__init__(value)
+        self.status = status
+
+
+class RetryPolicy(object):
+    """
+    Describes which failed commands :class:`Bitcoind` should send again, and
+    how long to wait in between.  Only commands which are safe to repeat are
+    retried, and only after errors which are likely to be temporary: transport
+    errors (including timeouts), ``503`` responses (bitcoind's work queue is
+    full), and bitcoind still warming up.
+
+    The wait doubles after each attempt, starting from *backoff* seconds and
+    up to *max_backoff*, less a random fraction of up to *jitter*, so that
+    many clients don't all retry in lockstep.
+    """
+
+    # bitcoind's RPC_IN_WARMUP error, returned while loading the block index:
+    TRANSIENT_ERROR_CODES = frozenset((-28,))
+
+    # Work queue depth exceeded:
+    TRANSIENT_STATUSES = frozenset((503,))
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30.0, jitter=0.5, methods=IDEMPOTENT_METHODS):
+        """
+        Constructor.
+
+        :param attempts:
+            Maximum number of times to send a command, including the first.
+
+        :param backoff:
+            Number of seconds to wait before the first retry.
+
+        :param max_backoff:
+            Maximum number of seconds to wait between attempts.
+
+        :param jitter:
+            Fraction of each wait which is randomized.
+
+        :param methods:
+            The JSON-RPC methods which may be retried.  Defaults to
+            :data:`IDEMPOTENT_METHODS`.
+
+        """
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.methods = frozenset(methods)
+
+    def is_transient(self, error):
+        """
+        Returns :const:`True` if the :class:`BitcoindException` *error* is
+        worth retrying.
+        """
+
+        if isinstance(error, BitcoindTransportError):
+            return error.status is None or error.status in self.TRANSIENT_STATUSES
+        value = error.args[0] if error.args else None
+        return isinstance(value, dict) and value.get('code') in self.TRANSIENT_ERROR_CODES
+
+    def delay(self, methods, attempt, error):
+        """
+        Returns the number of seconds to wait before sending *methods* again,
+        after *attempt* attempts failed with *error*, or :const:`None` if
+        they shouldn't be retried.
+        """
+
+        if attempt >= self.attempts or not self.is_transient(error):
+            return None
+        if not all(method in self.methods for method in methods):
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1.0 - self.jitter * random.random())
+
+
 class BitcoindCommand(object):
     """Callable object representing a bitcoind JSON-RPC method."""
 
@@ -63,12 +264,293 @@ class BitcoindCommand(object):
         """JSON-RPC wrapper."""
 
         server = self.server
-        if not server:
-            server = Bitcoind()
+        if server is None:
+            server = get_default_server()
 
         return server._rpc_call(self.method, *args)
 
 
+class BitcoindResult(object):
+    """
+    Placeholder for the result of a command sent as part of a
+    :class:`BitcoindBatch`, which is filled in once the batch is executed.
+    """
+
+    def __init__(self, method, args):
+        """Constructor."""
+
+        self.method = method
+        self.args = args
+        self.error = None
+        self._done = False
+        self._result = None
+
+    def _set(self, result=None, error=None):
+        """Records the server's response to this command."""
+
+        self._result = result
+        self.error = error
+        self._done = True
+
+    def done(self):
+        """Returns :const:`True` if the batch has been executed."""
+
+        return self._done
+
+    def result(self):
+        """
+        Returns the result of the command.  Raises :class:`BitcoindException`
+        if the server returned an error, or if the batch hasn't been executed
+        yet.
+        """
+
+        if not self._done:
+            raise BitcoindException('"%s" has not been sent to bitcoind yet' % self.method)
+        if self.error:
+            raise BitcoindException(self.error)
+        return self._result
+
+    def __repr__(self):
+        """Return a string representation of the object."""
+
+        if not self._done:
+            status = 'pending'
+        elif self.error:
+            status = 'error=%r' % (self.error,)
+        else:
+            status = 'result=%r' % (self._result,)
+        return '%s(%s%r, %s)' % (type(self).__name__, self.method, tuple(self.args), status)
+
+
+class BitcoindBatch(object):
+    """
+    Collects JSON-RPC commands to be sent to bitcoind together.  Methods of
+    instances of this object correspond to server commands, like
+    :class:`Bitcoind`, but return :class:`BitcoindResult` placeholders which
+    are filled in by :meth:`execute`, or upon leaving a ``with`` block.
+
+    Errors are kept with each result, so one failed command does not affect
+    the others in the batch.
+    """
+
+    DEFAULT_SIZE = 500
+
+    def __init__(self, server, size=None):
+        """
+        Constructor.
+
+        :param server:
+            The :class:`Bitcoind` instance to send commands to.
+
+        :param size:
+            Maximum number of commands to send per request.  Larger batches
+            are split up.
+
+        """
+
+        self.server = server
+        self.size = size or self.DEFAULT_SIZE
+        self._pending = []
+
+    def __getattr__(self, method):
+        """
+        Attribute getter.  Assumes the attribute being fetched is the name
+        of a JSON-RPC method.
+        """
+
+        return BitcoindCommand(method, self)
+
+    def __len__(self):
+        """Returns the number of commands waiting to be sent."""
+
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def _rpc_call(self, method, *args):
+        """Queues a JSON-RPC command, returning its result placeholder."""
+
+        call = BitcoindResult(method, args)
+        self._pending.append(call)
+        return call
+
+    def execute(self):
+        """
+        Sends all queued commands to the server, and returns their
+        :class:`BitcoindResult` placeholders in the order they were queued.
+        """
+
+        calls, self._pending = self._pending, []
+        for i in range(0, len(calls), self.size):
+            self.server._rpc_batch(calls[i:i+self.size])
+
+        return calls
+
+
+class BitcoindMetrics(object):
+    """
+    Collects statistics about JSON-RPC requests in memory: per-method counts,
+    latency histograms, bytes sent and received, errors, and connections.
+
+    An instance can be shared between several :class:`Bitcoind` instances
+    (such as those in a :class:`BitcoindPool`), and used from multiple
+    threads.
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds:
+    LATENCY_BUCKETS = (
+        0.001, 0.002, 0.005,
+        0.01, 0.02, 0.05,
+        0.1, 0.2, 0.5,
+        1, 2, 5,
+        10, 20, 50,
+        float('inf'),
+    )
+
+    def __init__(self, callback=None):
+        """
+        Constructor.
+
+        :param callback:
+            Optional function to call with every event as it's recorded, for
+            forwarding to other monitoring systems.  It's called as
+            ``callback(event, **fields)``, where *event* is ``'request'``,
+            ``'error'`` or ``'connect'``, and *fields* are the arguments to
+            the corresponding ``record_*()`` method.
+
+        """
+
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discards all statistics collected so far."""
+
+        with self._lock:
+            self.methods = collections.defaultdict(lambda: {
+                'requests': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'bytes_out': 0,
+                'bytes_in': 0,
+                'histogram': [0] * len(self.LATENCY_BUCKETS),
+            })
+            self.connects = 0
+            self.reconnects = 0
+            self.connect_seconds = 0.0
+
+    def record_request(self, method, seconds, bytes_out, bytes_in):
+        """
+        Records a successful HTTP request to the server.
+
+        :param method:
+            Name of the JSON-RPC method, or ``'batch'``.
+
+        :param seconds:
+            Time from sending the request until the response was read,
+            excluding time spent connecting.
+
+        :param bytes_out:
+            Size of the request body.
+
+        :param bytes_in:
+            Size of the response body.
+
+        """
+
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self._lock:
+            stats = self.methods[method]
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['bytes_out'] += bytes_out
+            stats['bytes_in'] += bytes_in
+            stats['histogram'][bucket] += 1
+
+        if self.callback is not None:
+            self.callback('request', method=method, seconds=seconds, bytes_out=bytes_out, bytes_in=bytes_in)
+
+    def record_error(self, method, error):
+        """
+        Records a failed command, whether the error was reported by the
+        server or occurred talking to it.
+        """
+
+        with self._lock:
+            self.methods[method]['errors'] += 1
+
+        if self.callback is not None:
+            self.callback('error', method=method, error=error)
+
+    def record_connect(self, seconds, reconnect=False):
+        """
+        Records a new connection to the server.
+
+        :param reconnect:
+            :const:`True` if this replaces a connection which had already
+            been used.
+
+        """
+
+        with self._lock:
+            self.connects += 1
+            self.reconnects += int(reconnect)
+            self.connect_seconds += seconds
+
+        if self.callback is not None:
+            self.callback('connect', seconds=seconds, reconnect=reconnect)
+
+    def percentile(self, method, fraction):
+        """
+        Returns an estimate of the given latency percentile for *method*, in
+        seconds.  Since only the histogram is kept, this is the upper bound
+        of the bucket the percentile falls in.
+        """
+
+        with self._lock:
+            histogram = list(self.methods[method]['histogram']) if method in self.methods else []
+
+        remaining = fraction * sum(histogram)
+        for bound, count in zip(self.LATENCY_BUCKETS, histogram):
+            remaining -= count
+            if remaining <= 0:
+                return bound
+        return None
+
+    def summary(self):
+        """Returns a human-readable table of the statistics collected."""
+
+        lines = ['%-24s %8s %6s %9s %9s %9s %12s %12s' % (
+            'Method', 'Requests', 'Errors', 'Mean ms', 'p50 ms', 'p99 ms', 'Bytes out', 'Bytes in',
+        )]
+        with self._lock:
+            methods = dict((method, dict(stats)) for method, stats in self.methods.items())
+
+        for method in sorted(methods):
+            stats = methods[method]
+            lines.append('%-24s %8d %6d %9.1f %9s %9s %12d %12d' % (
+                method,
+                stats['requests'],
+                stats['errors'],
+                stats['seconds'] / stats['requests'] * 1000.0 if stats['requests'] else 0.0,
+                '<%g' % (self.percentile(method, 0.5) * 1000.0) if stats['requests'] else '-',
+                '<%g' % (self.percentile(method, 0.99) * 1000.0) if stats['requests'] else '-',
+                stats['bytes_out'],
+                stats['bytes_in'],
+            ))
+        lines.append('%d connections (%d reconnects), %.1f ms spent connecting' % (
+            self.connects, self.reconnects, self.connect_seconds * 1000.0,
+        ))
+
+        return '\n'.join(lines)
+
+
 class Bitcoind(object):
     """
     JSON-RPC wrapper for talking to bitcoind.  Methods of instances of this
@@ -144,12 +626,65 @@ class Bitcoind(object):
         config.update(options)
         return config
 
-    def __init__(self, config_filename=DEFAULT_CONFIG_FILENAME, **config_options):
+    def __init__(self, config_filename=DEFAULT_CONFIG_FILENAME, amounts=None, metrics=None,
+                 retry=None, hedge=None, hedge_delay=0.05, hedge_methods=HEDGE_METHODS, **config_options):
         """
         Constructor.  Parses RPC communication details from ``bitcoin.conf``
-        and opens a connection to the server.
+        and sets up a persistent connection to the server, which will be
+        established on first use.
+
+        :param config_filename:
+            The filename from which the configuration should be read.
+
+        :param amounts:
+            How to decode numbers in responses.  By default, every
+            non-integer is decoded as a :class:`decimal.Decimal`, which is
+            exact but slow.  Alternately, non-integers can be decoded as
+            floats, and only bitcoin amounts (fields named in
+            :data:`AMOUNT_FIELDS`, and results of the methods in
+            :data:`AMOUNT_RESULTS`) converted, to either ``'decimal'``,
+            ``'satoshi'`` (integers) or ``'float'``.  The latter two are
+            the fastest.
+
+        :param metrics:
+            A :class:`BitcoindMetrics` instance (or anything with the same
+            ``record_*()`` methods) to collect statistics about requests.
+            Nothing is recorded by default.
+
+        :param retry:
+            A :class:`RetryPolicy` for resending commands which failed
+            because the server was unreachable or busy.  By default,
+            commands are not retried.
+
+        :param hedge:
+            Another :class:`Bitcoind` instance, talking to a second server.
+            Commands in *hedge_methods* which haven't started to get a
+            response within *hedge_delay* seconds are sent there as well,
+            and whichever response arrives first is used.  This trims the
+            long tail of response times, at the cost of some extra
+            requests.
+
+        Any other arguments override values from the configuration file.
+
         """
 
+        if amounts is None:
+            self._json_decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+        elif amounts == 'float':
+            # bitcoind always formats amounts with a decimal point, so
+            # there's nothing to convert.
+            self._json_decoder = json.JSONDecoder()
+        elif amounts in _AMOUNT_CONVERTERS:
+            self._json_decoder = json.JSONDecoder(object_hook=self._amount_hook)
+        else:
+            raise ValueError('Unknown amounts representation %r' % amounts)
+        self.amounts = amounts
+        self.metrics = metrics
+        self.retry = retry
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_methods = frozenset(hedge_methods)
+
         config = self._parse_config(config_filename, **config_options)
 
         try:
@@ -166,17 +701,27 @@ class Bitcoind(object):
         try:
             self._rpc_port = int(config.get('rpcport', 8332))
             timeout = int(config.get('rpctimeout', 30))
+            # The server drops connections that have been idle this long, so
+            # there's no point trying to reuse one that's been idle longer.
+            self._rpc_idle_timeout = int(config.get('rpcservertimeout', 30))
         except ValueError:
             raise BitcoindException('Error parsing RPC connection information from %s' % config_filename)
 
-        if config.get('rpcssl', '').lower() in ('1', 'yes', 'true', 'y', 't'):
-            logger.debug('Making HTTPS connection to %s:%d', self._rpc_host, self._rpc_port)
+        self._rpc_timeout = timeout
+        self._rpc_ssl = config.get('rpcssl', '').lower() in ('1', 'yes', 'true', 'y', 't')
+        if self._rpc_ssl:
+            logger.debug('Using HTTPS connection to %s:%d', self._rpc_host, self._rpc_port)
             self._rpc_conn = httplib.HTTPSConnection(self._rpc_host, self._rpc_port, timeout=timeout)
         else:
-            logger.debug('Making HTTP connection to %s:%d', self._rpc_host, self._rpc_port)
+            logger.debug('Using HTTP connection to %s:%d', self._rpc_host, self._rpc_port)
             self._rpc_conn = httplib.HTTPConnection(self._rpc_host, self._rpc_port, timeout=timeout)
 
-        self._rpc_id = 0
+        self._rpc_last_used = None
+        self._rpc_pending = None
+        # The bitcoin protocol specifies a incrementing sequence for each
+        # command.  Taking the next value from a count() is atomic, so the
+        # sequence can be shared between connections in a BitcoindPool.
+        self._rpc_ids = itertools.count(1)
 
     def __getattr__(self, method):
         """
@@ -186,24 +731,91 @@ class Bitcoind(object):
 
         return BitcoindCommand(method, self)
 
-    def _rpc_call(self, method, *args):
-        """Performs a JSON-RPC command on the server and returns the result."""
+    def close(self):
+        """
+        Closes the connection to the server.  It will be re-established if
+        another command is sent.
+        """
 
-        # The bitcoin protocol specifies a incrementing sequence for each
-        # command.
-        self._rpc_id += 1
+        self._rpc_conn.close()
+
+    def _drop_connections(self):
+        """
+        Closes this process's copy of the connection, after a fork, so it
+        isn't shared with the parent.
+        """
+
+        self._rpc_pending = None
+        self._rpc_conn.close()
+        if self.hedge is not None:
+            self.hedge._drop_connections()
+
+    def _clone(self):
+        """
+        Returns a new instance with the same settings as this one, but with
+        its own connection to the server.  The request id sequence is shared
+        between the two.
+        """
+
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone._rpc_conn = self._rpc_conn.__class__(self._rpc_host, self._rpc_port, timeout=self._rpc_timeout)
+        clone._rpc_last_used = None
+        clone._rpc_pending = None
+        if self.hedge is not None:
+            clone.hedge = self.hedge._clone()
+        return clone
+
+    def _close_clone(self):
+        """
+        Closes the connections of an instance returned by :meth:`_clone`,
+        including that of its own copy of :attr:`hedge`.
+        """
+
+        self._rpc_conn.close()
+        if self.hedge is not None:
+            self.hedge._close_clone()
+
+    def _rpc_connect(self):
+        """
+        (Re-)establishes the connection to the server.  Returns the number of
+        seconds it took.
+        """
+
+        self._rpc_conn.close()
+
+        start = time.time()
+        try:
+            self._rpc_conn.connect()
+            # Requests are small and latency-sensitive:
+            self._rpc_conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, httplib.HTTPException) as e:
+            raise BitcoindTransportError('Error connecting to bitcoind: %s' % str(e))
+
+        elapsed = time.time() - start
+        if self.metrics is not None:
+            self.metrics.record_connect(elapsed, reconnect=self._rpc_last_used is not None)
+        return elapsed
+
+    def _rpc_is_stale(self):
+        """
+        Returns :const:`True` if the connection needs to be (re-)established
+        before sending another request.
+        """
+
+        return (
+            self._rpc_conn.sock is None or
+            self._rpc_last_used is None or
+            time.time() - self._rpc_last_used >= self._rpc_idle_timeout
+        )
+
+    def _rpc_write(self, body):
+        """Sends *body* to the server over the current connection."""
 
-        logger.debug('Starting "%s" JSON-RPC request', method)
-        self._rpc_conn.connect()
         self._rpc_conn.request(
             method='POST',
             url='/',
-            body=json.dumps({
-                'version': '1.1',
-                'method': method,
-                'params': args,
-                'id': self._rpc_id,
-            }),
+            body=body,
             headers={
                 'Host': '%s:%d' % (self._rpc_host, self._rpc_port),
                 'Authorization': ''.join(('Basic ', self._rpc_auth)),
@@ -211,33 +823,1034 @@ class Bitcoind(object):
             }
         )
 
+    def _rpc_read(self, response, stream=False):
+        """
+        Finishes reading the :class:`httplib.HTTPResponse` *response*.
+        Unless *stream* is :const:`True`, the response is read to completion
+        and its contents stored in its ``body`` attribute.
+        """
+
+        if response and (not stream or response.status != 200):
+            # The body has to be consumed before the connection can be
+            # reused, even if it's an error.
+            response.body = response.read()
+        return response
+
+    @staticmethod
+    def _rpc_nothing_read(error):
+        """
+        Returns :const:`True` if *error*, raised while waiting for the status
+        line of a response, means the server cleanly closed the connection
+        before sending any of the response.  Other socket errors, such as a
+        reset, may come from a server which failed after acting on the
+        request, so don't count.
+        """
+
+        if isinstance(error, httplib.BadStatusLine):
+            # Python 3 raises RemoteDisconnected (a subclass) if the server
+            # closed the connection without sending anything; Python 2 a
+            # BadStatusLine with an empty line.
+            return type(error).__name__ == 'RemoteDisconnected' or not error.line
+        return False
+
+    def _rpc_start(self, body, methods=()):
+        """
+        First half of :meth:`_rpc_send`: (re-)connects if necessary and sends
+        *body*, without waiting for the response.  Must be followed by
+        :meth:`_rpc_finish`.
+
+        :param methods:
+            The JSON-RPC methods in *body*.  If they're all in
+            :data:`IDEMPOTENT_METHODS`, the request may be sent again if the
+            connection fails while waiting for the response.
+
+        """
+
+        reused = not self._rpc_is_stale()
+        connect_time = 0.0 if reused else self._rpc_connect()
+
         start = time.time()
-        response = self._rpc_conn.getresponse()
+        try:
+            try:
+                self._rpc_write(body)
+            except socket.error as e:
+                # The server won't have acted on a request it didn't
+                # receive all of, so this is always safe to send again:
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                logger.debug('Connection to %s:%d was closed, reconnecting', self._rpc_host, self._rpc_port)
+                reused = False
+                connect_time += self._rpc_connect()
+                start = time.time()
+                self._rpc_write(body)
+        except (socket.error, httplib.HTTPException) as e:
+            self._rpc_conn.close()
+            raise BitcoindTransportError('Error talking to bitcoind: %s' % str(e))
+
+        resendable = bool(methods) and all(method in IDEMPOTENT_METHODS for method in methods)
+        self._rpc_pending = (body, resendable, reused, connect_time, start)
+
+    def _rpc_finish(self, method, stream=False):
+        """
+        Second half of :meth:`_rpc_send`: waits for the response to the
+        request sent by :meth:`_rpc_start` and returns it.
+        """
+
+        body, resendable, reused, connect_time, start = self._rpc_pending
+        self._rpc_pending = None
+
+        try:
+            try:
+                response = self._rpc_conn.getresponse()
+            except (httplib.BadStatusLine, socket.error) as e:
+                # A keep-alive connection can be closed by the server at any
+                # time, in which case the request was never processed and
+                # it's safe to send it again over a new connection.  But the
+                # server may also have failed after processing it, which
+                # can't be told apart, so that's only done if sending it
+                # twice is harmless, or if the server closed the connection
+                # without sending anything (as when an idle connection is
+                # closed), rather than resetting it.  Timeouts are never
+                # retried, since the server may still be working on the
+                # request.
+                if not reused or isinstance(e, socket.timeout) or not (resendable or self._rpc_nothing_read(e)):
+                    raise
+                logger.debug('Connection to %s:%d was closed, reconnecting', self._rpc_host, self._rpc_port)
+                reused = False
+                connect_time += self._rpc_connect()
+                start = time.time()
+                self._rpc_write(body)
+                response = self._rpc_conn.getresponse()
+            self._rpc_read(response, stream)
+        except (socket.error, httplib.HTTPException) as e:
+            self._rpc_conn.close()
+            raise BitcoindTransportError('Error talking to bitcoind: %s' % str(e))
+
+        self._rpc_last_used = time.time()
         if not response:
-            raise BitcoindException('No response from bitcoind')
+            raise BitcoindTransportError('No response from bitcoind')
         if response.status != 200:
-            raise BitcoindException('%d (%s) response from bitcoind' % (response.status, response.reason))
+            # Newer versions of bitcoind report errors with a 500 status,
+            # but still include the JSON-RPC error in the body.
+            try:
+                error = json.loads(response.body.decode('utf8')).get('error')
+            except (ValueError, AttributeError):
+                error = None
+            if error:
+                raise BitcoindException(error)
+            raise BitcoindTransportError('%d (%s) response from bitcoind' % (response.status, response.reason), response.status)
+
+        logger.debug(
+            'Got %s from server in %d ms (%s %d ms)',
+            'streaming response' if stream else '%d byte response' % len(response.body),
+            (self._rpc_last_used - start) * 1000.0,
+            'reused connection,' if reused else 'connected in', connect_time * 1000.0
+        )
+        if stream:
+            response.bytes_out = len(body)
+            response.start = start
+        elif self.metrics is not None:
+            self.metrics.record_request(method, self._rpc_last_used - start, len(body), len(response.body))
+        return response
+
+    def _rpc_send(self, method, payload, stream=False):
+        """
+        Sends *payload* to the server as JSON and returns the successful
+        :class:`httplib.HTTPResponse`.  Transport-level errors raise
+        :class:`BitcoindTransportError`.
+
+        :param method:
+            Name of the JSON-RPC method, or ``'batch'``, for logging and
+            metrics.
+
+        :param payload:
+            JSON-serializable request object (or list of request objects,
+            for a batch).
+
+        :param stream:
+            If :const:`True`, the response body is left for the caller to
+            read.  Otherwise it is read into the ``body`` attribute.
+
+        """
+
+        body = json.dumps(payload).encode('utf8')
+
+        if isinstance(payload, list):
+            description = '%d-command batch' % len(payload)
+        else:
+            description = '"%s"' % method
+        if stream:
+            description += ' streaming'
+        logger.debug('Starting %s JSON-RPC request', description)
+
+        if self.hedge is not None and not stream and method in self.hedge_methods:
+            return self._rpc_send_hedged(method, body)
+
+        methods = [request['method'] for request in payload] if isinstance(payload, list) else [payload['method']]
+        self._rpc_start(body, methods)
+        return self._rpc_finish(method, stream)
+
+    def _rpc_send_hedged(self, method, body):
+        """
+        Sends *body* to this server and, if it hasn't started to respond
+        within :attr:`hedge_delay` seconds, to :attr:`hedge` as well.  Returns
+        whichever response arrives first.  The connection the other response
+        was going to arrive on has to be closed.
+        """
 
-        response_body = response.read().decode('utf8')
-        logger.debug('Got %d byte response from server in %d ms', len(response_body), (time.time() - start) * 1000.0)
+        pending = []
+        error = None
+        for server in (self, self.hedge):
+            if pending:
+                if select.select([pending[0]._rpc_conn.sock], [], [], self.hedge_delay)[0]:
+                    break
+                logger.debug('No response after %d ms, hedging "%s" request', self.hedge_delay * 1000.0, method)
+            try:
+                server._rpc_start(body, (method,))
+            except BitcoindTransportError as e:
+                error = e
+            else:
+                pending.append(server)
+
+        response = None
         try:
-            response_json = json.loads(response_body, parse_float=decimal.Decimal)
+            while pending and response is None:
+                winner = pending[0]
+                if len(pending) > 1:
+                    ready = select.select([server._rpc_conn.sock for server in pending], [], [], self._rpc_timeout)[0]
+                    if not ready:
+                        break
+                    winner = [server for server in pending if server._rpc_conn.sock in ready][0]
+                pending.remove(winner)
+
+                try:
+                    response = winner._rpc_finish(method)
+                except BitcoindTransportError as e:
+                    error = e
+
+        finally:
+            # The response to an abandoned request would otherwise be read
+            # as the response to the next one.
+            for server in pending:
+                server._rpc_pending = None
+                server._rpc_conn.close()
+
+        if response is None:
+            raise error or BitcoindTransportError('Error talking to bitcoind: timed out')
+        if winner is self.hedge:
+            logger.debug('Hedged "%s" request was answered by %s:%d', method, winner._rpc_host, winner._rpc_port)
+        return response
+
+    def _rpc_post(self, method, payload):
+        """
+        Sends *payload* to the server as JSON and returns the decoded
+        response.  Transport-level errors raise :class:`BitcoindException`;
+        errors reported by the server in the response are left for the
+        caller to deal with.  Arguments are the same as for
+        :meth:`_rpc_send`.
+        """
+
+        response = self._rpc_send(method, payload)
+
+        # Only keep one copy of the response around at a time; these can be
+        # tens of megabytes.
+        response_body = response.body.decode('utf8')
+        response.body = None
+
+        try:
+            return self._json_decoder.decode(response_body)
         except ValueError as e:
             raise BitcoindException('Error parsing bitcoind response: %s' % str(e))
 
-        if response_json.get('error'):
-            raise BitcoindException(response_json['error'])
-        elif 'result' in response_json:
-            return response_json['result']
+    def _rpc_retry(self, methods, func, *args):
+        """
+        Calls *func* with *args*, which sends *methods* to the server, and
+        returns the result.  If it fails, it's retried according to
+        :attr:`retry`.
+        """
+
+        attempt = 1
+        while True:
+            try:
+                return func(*args)
+            except BitcoindException as e:
+                delay = None if self.retry is None else self.retry.delay(methods, attempt, e)
+                if delay is None:
+                    raise
+                logger.warning('Retrying %s in %.2f seconds (attempt %d failed)', ', '.join(sorted(set(methods))), delay, attempt)
+                time.sleep(delay)
+                attempt += 1
+
+    def _rpc_call(self, method, *args):
+        """Performs a JSON-RPC command on the server and returns the result."""
+
+        return self._rpc_retry((method,), self._rpc_call_once, method, args)
+
+    def _rpc_call_once(self, method, args):
+        """Performs a single attempt at :meth:`_rpc_call`."""
+
+        try:
+            response_json = self._rpc_post(method, {
+                'version': '1.1',
+                'method': method,
+                'params': args,
+                'id': next(self._rpc_ids),
+            })
+
+            if not isinstance(response_json, dict):
+                raise BitcoindException('Invalid response from bitcoind')
+            elif response_json.get('error'):
+                raise BitcoindException(response_json['error'])
+            elif 'result' in response_json:
+                return self._convert_result(method, response_json['result'])
+            else:
+                raise BitcoindException('Invalid response from bitcoind')
+
+        except BitcoindException as e:
+            if self.metrics is not None:
+                self.metrics.record_error(method, e.args[0])
+            raise
+
+    def _rpc_batch(self, calls):
+        """
+        Performs several JSON-RPC commands on the server using a single
+        request, filling in the result (or error) of each.
+
+        :param calls:
+            List of :class:`BitcoindResult` instances, as returned by
+            :class:`BitcoindBatch`.
+
+        """
+
+        requests = []
+        pending = {}
+        for call in calls:
+            rpc_id = next(self._rpc_ids)
+            pending[rpc_id] = call
+            requests.append({
+                'version': '1.1',
+                'method': call.method,
+                'params': call.args,
+                'id': rpc_id,
+            })
+
+        try:
+            response_json = self._rpc_retry([call.method for call in calls], self._rpc_post, 'batch', requests)
+            if not isinstance(response_json, list):
+                raise BitcoindException('Invalid response from bitcoind')
+        except BitcoindException as e:
+            if self.metrics is not None:
+                self.metrics.record_error('batch', e.args[0])
+            raise
+
+        # The server is allowed to answer in any order, so responses are
+        # matched back up with requests by id.
+        for entry in response_json:
+            call = pending.pop(entry.get('id'), None) if isinstance(entry, dict) else None
+            if call is None:
+                logger.warning('Ignoring unexpected entry in batch response: %r', entry)
+            elif entry.get('error'):
+                call._set(error=entry['error'])
+            elif 'result' in entry:
+                call._set(result=self._convert_result(call.method, entry['result']))
+            else:
+                call._set(error='Invalid response from bitcoind')
+
+        for call in pending.values():
+            call._set(error='No response from bitcoind')
+
+        if self.metrics is not None:
+            for call in calls:
+                if call.error:
+                    self.metrics.record_error(call.method, call.error)
+
+    def stream(self, method, *args):
+        """
+        Generator which performs a JSON-RPC command whose result is an array,
+        yielding each element as it is parsed from the response.  Only a
+        small part of the response is held in memory at once, which makes
+        this suitable for very large results such as ``getrawmempool``.
+
+        The connection can't be used for anything else until the generator
+        is exhausted.  If it's abandoned early, the connection is closed.
+
+        :param method:
+            Name of the JSON-RPC method.
+
+        Any remaining arguments are passed to the method.
+
+        """
+
+        finished = False
+        try:
+            response = self._rpc_send(method, {
+                'version': '1.1',
+                'method': method,
+                'params': args,
+                'id': next(self._rpc_ids),
+            }, stream=True)
+
+            try:
+                for element in self._iter_result(response):
+                    yield element
+                finished = True
+            except (socket.error, httplib.HTTPException) as e:
+                raise BitcoindTransportError('Error talking to bitcoind: %s' % str(e))
+
+        except BitcoindException as e:
+            if self.metrics is not None:
+                self.metrics.record_error(method, e.args[0])
+            raise
+
+        finally:
+            if finished:
+                self._rpc_last_used = time.time()
+                if self.metrics is not None:
+                    self.metrics.record_request(method, self._rpc_last_used - response.start, response.bytes_out, response.bytes_in)
+            else:
+                self._rpc_conn.close()
+
+    # Matches the start of a response whose result is an array.  bitcoind
+    # always puts the result first.
+    _STREAM_PREFIX = re.compile(r'\s*\{\s*"result"\s*:\s*\[')
+
+    def _iter_result(self, response, chunk_size=65536):
+        """
+        Generator which incrementally parses the JSON-RPC response read from
+        the file-like *response*, yielding the elements of its result array.
+        """
+
+        utf8 = codecs.getincrementaldecoder('utf8')()
+        buf = ''
+        eof = False
+        response.bytes_in = 0
+
+        def fill(buf):
+            chunk = response.read(chunk_size)
+            response.bytes_in += len(chunk)
+            return buf + utf8.decode(chunk, final=not chunk), not chunk
+
+        # Read enough to see whether the result is an array:
+        while not eof and len(buf) < 64:
+            buf, eof = fill(buf)
+        match = self._STREAM_PREFIX.match(buf)
+        if not match:
+            # Probably an error; parse the whole thing to find out.
+            while not eof:
+                buf, eof = fill(buf)
+            try:
+                response_json = self._json_decoder.decode(buf)
+            except ValueError as e:
+                raise BitcoindException('Error parsing bitcoind response: %s' % str(e))
+            if not isinstance(response_json, dict):
+                raise BitcoindException('Invalid response from bitcoind')
+            elif response_json.get('error'):
+                raise BitcoindException(response_json['error'])
+            raise BitcoindException('Result from bitcoind is not an array')
+
+        pos = match.end()
+        expect_element = True
+        while True:
+            # Skip whitespace, making sure there's something left to look
+            # at:
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = buf[pos:], 0
+                buf, eof = fill(buf)
+
+            if pos >= len(buf):
+                raise BitcoindException('Truncated response from bitcoind')
+            elif buf[pos] == ']':
+                break
+            elif buf[pos] == ',' and not expect_element:
+                pos += 1
+                expect_element = True
+                continue
+
+            # Decode the next element.  Only accept it if it's followed by a
+            # separator, since e.g. a number could be cut off partway.
+            try:
+                element, end = self._json_decoder.raw_decode(buf, pos)
+                after = end
+                while after < len(buf) and buf[after] in ' \t\r\n':
+                    after += 1
+                complete = after < len(buf) and buf[after] in ',]'
+            except ValueError:
+                complete = False
+            if not complete:
+                if eof:
+                    raise BitcoindException('Error parsing bitcoind response')
+                buf, pos = buf[pos:], 0
+                buf, eof = fill(buf)
+                continue
+
+            yield element
+            pos = end
+            expect_element = False
+
+        # The rest of the response has to be consumed before the connection
+        # can be reused.
+        while not eof:
+            eof = fill('')[1]
+
+    def _convert_result(self, method, result):
+        """
+        Converts a result consisting of a bare amount (or, for
+        ``listaccounts``, a dictionary of them) per :attr:`amounts`.  Amounts
+        within objects are handled while decoding.
+        """
+
+        if self.amounts is None or method not in AMOUNT_RESULTS:
+            return result
+        elif isinstance(result, dict):
+            return dict((k, _convert_amount(v, self.amounts)) for k, v in result.items())
         else:
-            raise BitcoindException('Invalid response from bitcoind')
+            return _convert_amount(result, self.amounts)
+
+    def _amount_hook(self, obj):
+        """``object_hook`` for decoding JSON which converts amount fields."""
+
+        for key in AMOUNT_FIELDS.intersection(obj):
+            value = obj[key]
+            if isinstance(value, dict):
+                # getrawmempool's "fees" object
+                obj[key] = dict((k, _convert_amount(v, self.amounts)) for k, v in value.items())
+            else:
+                obj[key] = _convert_amount(value, self.amounts)
+        return obj
+
+    def batch(self, size=None):
+        """
+        Returns a :class:`BitcoindBatch` for sending several commands to
+        this server at once, e.g.::
+
+            with conn.batch() as b:
+                hashes = [b.getblockhash(h) for h in range(1000)]
+            hashes = [h.result() for h in hashes]
+
+        :param size:
+            Maximum number of commands to send per request.  Larger batches
+            are split up.
+
+        """
+
+        return BitcoindBatch(self, size)
+
+
+class BitcoindPool(object):
+    """
+    Thread-safe pool of connections to bitcoind.  Methods of instances of this
+    object correspond to server commands, like :class:`Bitcoind`; each command
+    borrows an idle connection from the pool for its duration, opening a new
+    one if none are idle and the pool is not yet full.
+    """
+
+    def __init__(self, config_filename=Bitcoind.DEFAULT_CONFIG_FILENAME, max_size=None, **config_options):
+        """
+        Constructor.  The configuration is parsed once and shared by every
+        connection in the pool.
+
+        :param config_filename:
+            The filename from which the configuration should be read.
+
+        :param max_size:
+            The maximum number of connections to open.  Defaults to the
+            ``rpcthreads`` setting from the configuration file (or 4, the
+            bitcoind default), since the server won't service more requests
+            than that at once.
+
+        Any other arguments override values from the configuration file, as
+        with :class:`Bitcoind`.
+
+        """
+
+        self._template = Bitcoind(config_filename, **config_options)
+
+        if max_size is None:
+            config = self._template._parse_config(config_filename, **config_options)
+            try:
+                max_size = int(config.get('rpcthreads', 4))
+            except ValueError:
+                raise BitcoindException('Error parsing rpcthreads from %s' % config_filename)
+        self.max_size = max_size
+
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """
+        Forgets the connections inherited from the parent process, if this
+        process has forked since the pool was last used.  Idle ones are
+        closed now; those which were borrowed at the time of the fork are
+        closed when they're returned, rather than going back in the pool.
+        """
+
+        if self._pid != os.getpid():
+            self._drop_connections()
+
+    def _drop_connections(self):
+        """
+        Forgets every connection the pool has opened, as after a fork.  See
+        :meth:`_check_fork`.
+        """
+
+        logger.debug('Dropping %d inherited bitcoind connections', self._size)
+        for conn in self._idle:
+            conn._close_clone()
+        self._idle = []
+        self._size = 0
+        # Another thread may have been holding the lock at the time of the
+        # fork, in which case it would never be released:
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def __getattr__(self, method):
+        """
+        Attribute getter.  Assumes the attribute being fetched is the name
+        of a JSON-RPC method.
+        """
+
+        return BitcoindCommand(method, self)
+
+    def _acquire(self, timeout=None):
+        """Returns an idle connection, waiting for one if necessary."""
+
+        self._check_fork()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise BitcoindException('Timed out waiting for a connection to bitcoind')
+                self._cond.wait(remaining)
+
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+
+        try:
+            return self._template._clone()
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, conn, pid):
+        """
+        Returns *conn*, which was borrowed by process *pid*, to the pool.
+        """
+
+        if pid != os.getpid():
+            # Borrowed before a fork; the socket is shared with the parent.
+            conn._close_clone()
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager which borrows a :class:`Bitcoind` connection from the
+        pool for the duration of the ``with`` block.
+
+        :param timeout:
+            Number of seconds to wait for a connection to become available
+            before raising :class:`BitcoindException`.  By default, waits
+            forever.
+
+        """
+
+        conn = self._acquire(timeout)
+        pid = os.getpid()
+        try:
+            yield conn
+        except BitcoindException:
+            # Either the server returned an error, in which case the
+            # connection is fine, or the connection was already closed
+            # and will be re-established on next use.
+            raise
+        except:
+            # Anything else may have interrupted a request halfway through,
+            # so start afresh next time.
+            conn._close_clone()
+            raise
+        finally:
+            self._release(conn, pid)
+
+    def _rpc_call(self, method, *args):
+        """Performs a JSON-RPC command using a connection from the pool."""
+
+        with self.connection() as conn:
+            return conn._rpc_call(method, *args)
+
+    def _rpc_batch(self, calls):
+        """Sends a batch of commands using a connection from the pool."""
+
+        with self.connection() as conn:
+            conn._rpc_batch(calls)
+
+    def batch(self, size=None):
+        """
+        Returns a :class:`BitcoindBatch` for sending several commands at
+        once.  See :meth:`Bitcoind.batch`.
+        """
+
+        return BitcoindBatch(self, size)
+
+    def stream(self, method, *args):
+        """
+        Generator which performs a JSON-RPC command using a connection from
+        the pool, yielding the elements of its array result as they are
+        parsed.  See :meth:`Bitcoind.stream`.
+        """
+
+        with self.connection() as conn:
+            for element in conn.stream(method, *args):
+                yield element
+
+    def close(self):
+        """
+        Closes all idle connections in the pool, and the connection to the
+        hedge server, if any.
+        """
+
+        self._check_fork()
+        with self._cond:
+            for conn in self._idle:
+                conn._close_clone()
+        if self._template.hedge is not None:
+            self._template.hedge.close()
+
+
+class BitcoindCache(object):
+    """
+    Caching layer in front of a :class:`Bitcoind` (or :class:`BitcoindPool`),
+    for results which can never change: blocks looked up by hash, and block
+    hashes by height, once they're deep enough in the chain that a
+    reorganization is practically impossible.  Methods of instances of this
+    object correspond to server commands, like :class:`Bitcoind`; anything
+    which can't be cached is passed straight through.
+
+    Results are kept in memory, up to a maximum number, discarding the least
+    recently used.  Optionally, they're also saved to disk using
+    :mod:`shelve`, so they survive between runs.
+
+    Since the number of confirmations keeps changing, it's left out of
+    cached ``getblock`` and ``getblockheader`` results.  An instance may be
+    shared between threads if the server it wraps can be.
+    """
+
+    # Methods whose result depends only on their arguments:
+    PURE_METHODS = frozenset((
+        'decoderawtransaction',
+        'decodescript',
+    ))
+
+    # Methods which take a block hash, whose result only changes (aside from
+    # the number of confirmations) if the block is reorganized out of the
+    # chain:
+    BLOCK_METHODS = frozenset((
+        'getblock',
+        'getblockheader',
+    ))
+
+    # Methods which take a block height, whose result only changes if the
+    # block at that height is reorganized out of the chain:
+    HEIGHT_METHODS = frozenset((
+        'getblockhash',
+    ))
+
+    # How often to ask the server how long the chain is, when a result may
+    # or may not be deep enough to cache, in seconds:
+    TIP_CHECK_INTERVAL = 10
+
+    def __init__(self, server, size=10000, filename=None, confirmations=100):
+        """
+        Constructor.
+
+        :param server:
+            The :class:`Bitcoind` or :class:`BitcoindPool` to send commands
+            to.
+
+        :param size:
+            Maximum number of results to keep in memory.
+
+        :param filename:
+            If specified, results are also stored in (and read from) a
+            :mod:`shelve` database with this name.
+
+        :param confirmations:
+            Number of confirmations a block needs before results about it
+            are cached.
+
+        """
+
+        self.server = server
+        self.size = size
+        self.confirmations = confirmations
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = collections.OrderedDict()
+        self._disk = shelve.open(filename) if filename else None
+        self._lock = threading.Lock()
+        self._tip = None
+        self._tip_checked = 0
+
+    def __getattr__(self, method):
+        """
+        Attribute getter.  Assumes the attribute being fetched is the name
+        of a JSON-RPC method.
+        """
+
+        return BitcoindCommand(method, self)
+
+    def _key(self, method, args):
+        """
+        Returns the cache key for *method* called with *args*, or
+        :const:`None` if the result might not be cacheable.
+        """
+
+        if method in self.PURE_METHODS or method in self.BLOCK_METHODS or method in self.HEIGHT_METHODS:
+            try:
+                return json.dumps([method, args])
+            except (TypeError, ValueError):
+                pass
+        return None
+
+    def _get(self, key):
+        """Returns the cached result for *key*, or raises :exc:`KeyError`."""
+
+        with self._lock:
+            try:
+                result = self._memory.pop(key)
+            except KeyError:
+                if self._disk is None:
+                    raise
+                result = self._disk[key]
+            self._memory[key] = result
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+            self.hits += 1
+
+        # The caller is free to modify what we return:
+        return copy.deepcopy(result) if isinstance(result, (dict, list)) else result
+
+    def _put(self, key, method, args, result):
+        """
+        Caches *result* for *key*, if it can't change.  Returns the result
+        to pass back to the caller, which has any volatile fields removed if
+        it was cached.
+        """
+
+        if method in self.BLOCK_METHODS and isinstance(result, dict):
+            confirmations = result.get('confirmations')
+            if isinstance(confirmations, int) and 'height' in result:
+                self._saw_tip(result['height'] + confirmations - 1)
+            if not isinstance(confirmations, int) or confirmations < self.confirmations:
+                return result
+            result = dict(result)
+            del result['confirmations']
+
+        elif method in self.HEIGHT_METHODS:
+            height = args[0] if args else None
+            if not isinstance(height, (int, long)) or isinstance(height, bool):
+                return result
+            if self._tip is None or (height > self._tip - self.confirmations + 1 and time.time() - self._tip_checked > self.TIP_CHECK_INTERVAL):
+                self._tip_checked = time.time()
+                self._saw_tip(self.server._rpc_call('getblockcount'))
+            if height > self._tip - self.confirmations + 1:
+                return result
+
+        with self._lock:
+            self._memory[key] = result
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+            if self._disk is not None:
+                self._disk[key] = result
+
+        return copy.deepcopy(result) if isinstance(result, (dict, list)) else result
+
+    def _saw_tip(self, height):
+        """Records that the chain is at least *height* blocks long."""
+
+        if self._tip is None or height > self._tip:
+            self._tip = height
+
+    def _rpc_call(self, method, *args):
+        """
+        Returns the cached result of a JSON-RPC command, if there is one, or
+        else performs it on the server (and caches the result if possible).
+        """
+
+        key = self._key(method, args)
+        if key is not None:
+            try:
+                return self._get(key)
+            except KeyError:
+                pass
+
+        with self._lock:
+            self.misses += 1
+        result = self.server._rpc_call(method, *args)
+        if method == 'getblockcount':
+            self._saw_tip(result)
+        elif key is not None:
+            result = self._put(key, method, args, result)
+        return result
+
+    def _rpc_batch(self, calls):
+        """
+        Fills in the results of a batch of commands from the cache, where
+        possible, and sends the rest to the server.
+        """
+
+        keys = {}
+        uncached = []
+        for call in calls:
+            key = self._key(call.method, call.args)
+            if key is not None:
+                try:
+                    call._set(result=self._get(key))
+                    continue
+                except KeyError:
+                    keys[id(call)] = key
+            uncached.append(call)
+
+        with self._lock:
+            self.misses += len(uncached)
+        if uncached:
+            self.server._rpc_batch(uncached)
+
+        for call in uncached:
+            if call.error:
+                continue
+            if call.method == 'getblockcount':
+                self._saw_tip(call._result)
+            elif id(call) in keys:
+                call._result = self._put(keys[id(call)], call.method, call.args, call._result)
+
+    def batch(self, size=None):
+        """
+        Returns a :class:`BitcoindBatch` for sending several commands at
+        once, only sending those which aren't cached.  See
+        :meth:`Bitcoind.batch`.
+        """
+
+        return BitcoindBatch(self, size)
+
+    def stream(self, method, *args):
+        """Passes :meth:`Bitcoind.stream` through to the server, uncached."""
+
+        return self.server.stream(method, *args)
+
+    def _drop_connections(self):
+        """
+        Drops the server's connections, after a fork.  The cache itself is
+        kept.
+        """
+
+        # Another thread may have been holding the lock at the time of the
+        # fork:
+        self._lock = threading.Lock()
+        self.server._drop_connections()
+
+    def close(self):
+        """
+        Writes out and closes the on-disk cache, if any.  The server is left
+        open.
+        """
+
+        with self._lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
+
+
+_default_server = None
+_default_server_pid = None
+_default_server_is_custom = False
+_default_server_lock = threading.Lock()
+
+
+def get_default_server():
+    """
+    Returns the connection used by the module-level shortcuts.  Unless one
+    has been provided via :func:`set_default_server`, this is a
+    :class:`BitcoindPool` created from ``bitcoin.conf`` on first use, so the
+    shortcuts are safe to call from multiple threads.
+
+    Sockets can't be shared between processes, so after a fork the child
+    process closes its copies of the parent's connections.  A default created
+    here is replaced with a new one; a custom default is kept (along with
+    any cache it has), and will reconnect when next used.  Custom defaults
+    other than :class:`Bitcoind`, :class:`BitcoindPool` and
+    :class:`BitcoindCache` need a ``_drop_connections()`` method for this,
+    or are closed instead.
+    """
+
+    global _default_server, _default_server_pid
+
+    with _default_server_lock:
+        if _default_server is not None and _default_server_pid != os.getpid():
+            logger.debug('Process forked, closing inherited bitcoind connections')
+            # Looked up on the class, since instances treat any unknown
+            # attribute as a JSON-RPC method:
+            if getattr(type(_default_server), '_drop_connections', None) is not None:
+                _default_server._drop_connections()
+            else:
+                _default_server.close()
+            if not _default_server_is_custom:
+                _default_server = None
+
+        if _default_server is None:
+            _default_server = BitcoindPool()
+        _default_server_pid = os.getpid()
+
+        return _default_server
+
+
+def set_default_server(server):
+    """
+    Replaces the connection used by the module-level shortcuts.
+
+    :param server:
+        A :class:`Bitcoind`, :class:`BitcoindPool`, or anything else with
+        the same interface.  If :const:`None`, a new default will be
+        created from ``bitcoin.conf`` when next needed.
+
+    """
+
+    global _default_server, _default_server_pid, _default_server_is_custom
+
+    with _default_server_lock:
+        _default_server = server
+        _default_server_pid = os.getpid()
+        _default_server_is_custom = server is not None
+
+
+if hasattr(os, 'register_at_fork'):
+    # Another thread may have been holding the lock when the process forked,
+    # in which case it would never be released in the child.
+    def _reinit_default_server_lock():
+        global _default_server_lock
+        _default_server_lock = threading.Lock()
+    os.register_at_fork(after_in_child=_reinit_default_server_lock)
 
 
 # There are two ways to use this module: either instantiate a Bitcoind and
 # call the JSON-RPC methods as methods of the instance, or use the
-# module-level shortcuts below.  The former reuses the same connection,
-# while the latter creates a new connection on each call.  The latter is also
-# dependent upon the following list being up-to-date.
+# module-level shortcuts below.  The latter share a connection (see
+# get_default_server()) and are dependent upon the following list being
+# up-to-date.
 addmultisigaddress = BitcoindCommand('addmultisigaddress')
 backupwallet = BitcoindCommand('backupwallet')
 dumpprivkey = BitcoindCommand('dumpprivkey')
@@ -282,11 +1895,90 @@ validateaddress = BitcoindCommand('validateaddress')
 verifymessage = BitcoindCommand('verifymessage')
 
 
+def _self_test():
+    """
+    Checks that connections aren't shared with a forked child process,
+    against :mod:`pifkoin.mockbitcoind`.  Run with ``--self-test``.
+    """
+
+    import shutil
+    import tempfile
+
+    import pifkoin.mockbitcoind
+
+    def in_child(func):
+        # Runs *func* in a forked child, returning whether it succeeded:
+        pid = os.fork()
+        if not pid:
+            try:
+                func()
+            except BaseException:
+                logger.exception('Failed in child process')
+                os._exit(1)
+            os._exit(0)
+        return os.waitpid(pid, 0)[1] == 0
+
+    directory = tempfile.mkdtemp()
+    try:
+        with pifkoin.mockbitcoind.MockBitcoind(pifkoin.mockbitcoind.MockChain(200)) as server:
+            # A custom default, with an on-disk cache:
+            conn = Bitcoind('/dev/null', **server.config)
+            cache = BitcoindCache(conn, filename=os.path.join(directory, 'cache'), confirmations=10)
+            set_default_server(cache)
+            first = getblockhash(1)
+            sock = conn._rpc_conn.sock
+            assert sock is not None and cache.misses == 1, 'Expected an open connection and a cache miss'
+
+            def child():
+                assert get_default_server() is cache, 'Custom default was replaced'
+                assert conn._rpc_conn.sock is None, "Parent's connection wasn't dropped"
+                assert cache._disk is not None, 'On-disk cache was closed'
+                assert getblockhash(1) == first and cache.hits == 1, 'Cache was lost'
+                assert getblockcount() == 199 and conn._rpc_conn.sock is not sock, 'Failed to reconnect'
+            assert in_child(child), 'Cache default check failed in child'
+            assert conn._rpc_conn.sock is sock and getblockcount() == 199, "Parent's connection was disturbed"
+            cache.close()
+
+            # A pool, with one connection borrowed and one idle at the time
+            # of the fork:
+            pool = BitcoindPool('/dev/null', max_size=2, **server.config)
+            with pool.connection() as borrowed:
+                with pool.connection() as idle:
+                    idle.getblockcount()
+                borrowed.getblockcount()
+
+                def child():
+                    assert pool.getblockcount() == 199 and pool._size == 1, 'Pool reused an inherited connection'
+                    assert idle not in pool._idle and borrowed not in pool._idle
+                assert in_child(child), 'Pool check failed in child'
+            assert pool.getblockcount() == 199 and pool._size == 2, "Parent's pool was disturbed"
+
+            # Closing a pool should close its connections to the hedge
+            # server as well:
+            hedge = Bitcoind('/dev/null', **server.config)
+            pool = BitcoindPool('/dev/null', hedge=hedge, **server.config)
+            with pool.connection() as conn:
+                assert conn.hedge is not hedge and conn.hedge.getblockcount() == 199
+            assert hedge.getblockcount() == 199
+            pool.close()
+            assert conn._rpc_conn.sock is None and conn.hedge._rpc_conn.sock is None, "Pooled connection's hedge wasn't closed"
+            assert hedge._rpc_conn.sock is None, 'Hedge connection was not closed'
+
+        set_default_server(None)
+        print('Connections dropped after fork')
+    finally:
+        shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
     logging.basicConfig()
     # Uncomment for verbosity:
     #logging.getLogger().setLevel(logging.DEBUG)
 
+    if sys.argv[1:] == ['--self-test']:
+        _self_test()
+        sys.exit(0)
+
     if len(sys.argv) > 1:
         method_name = sys.argv[1]
     else:
@@ -24,16 +24,26 @@
 """Utilities for parsing and interacting with the Bitcoin blockchain."""
 
 import binascii
+import calendar
+import collections
 import contextlib
 import datetime
 import decimal
+import array
 import hashlib
 import inspect
+import multiprocessing
+import os
 import pifkoin.bitcoind
 import pifkoin.sha256
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import socket
 import struct
 import sys
+import threading
 import time
 
 if sys.version > '3':
@@ -128,11 +138,44 @@ def difficulty_to_target(difficulty):
     return uncompact(difficulty_to_bits(difficulty))
 
 
+def _header_field(name, doc):
+    """
+    Returns a property for the block header field *name*, which clears the
+    values derived from the header whenever it's changed.
+    """
+
+    attr = '_' + name
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._bytes = self._target = self._difficulty = self._hash = None
+
+    return property(fget, fset, doc=doc)
+
+
 class BlockHeader(object):
-    """Data structure for working with block header information."""
+    """
+    Data structure for working with block header information.
+
+    The serialized header, target, difficulty and hash are computed at most
+    once, and cleared when any of the header's fields are changed.
+    """
 
     PARAMETERS = ('height', 'version', 'previousblockhash', 'merkleroot', 'time', 'bits', 'nonce', 'hash')
 
+    __slots__ = (
+        'height', '_version', '_previousblockhash', '_merkleroot', '_timestamp', '_bits', '_nonce',
+        '_hash', '_bytes', '_target', '_difficulty',
+    )
+
+    version = _header_field('version', 'The block version number.')
+    previousblockhash = _header_field('previousblockhash', 'Hash of the previous block, as a 32-byte string.')
+    merkleroot = _header_field('merkleroot', 'Merkle root of the block\'s transactions, as a 32-byte string.')
+    nonce = _header_field('nonce', 'The nonce, an integer.')
+
     @staticmethod
     def _get_bitcoind(**bitcoind_args):
         """
@@ -147,7 +190,7 @@ class BlockHeader(object):
         """
 
         if 'bitcoind' in bitcoind_args:
-            conn = pifkoin.bitcoind.args.pop('bitcoind')
+            conn = bitcoind_args.pop('bitcoind')
             assert not bitcoind_args, 'Can specify bitcoind connection or options, not both'
         else:
             conn = pifkoin.bitcoind.Bitcoind(**bitcoind_args)
@@ -155,10 +198,11 @@ class BlockHeader(object):
         return conn
 
     @classmethod
-    def from_blockchain(cls, height=None, hash=None, **bitcoind_args):
+    def from_blockchain(cls, height=None, hash=None, index=None, blocks=None, **bitcoind_args):
         """
         Static factory method that returns a new object instance for the
-        specified block, which will be retrieved from the running bitcoind.
+        specified block, which will be retrieved from the running bitcoind
+        (or from its block files, if *index* and *blocks* are given).
 
         :param height:
             The block number to return.  If negative, is regarded as an offset
@@ -168,23 +212,155 @@ class BlockHeader(object):
         :param hash:
             The block hash to return.
 
+        :param index:
+            Optional :class:`pifkoin.blockindex.BlockIndex` to look up the
+            hash of *height* in, instead of asking bitcoind.  Negative
+            heights are then relative to the tip of the index.  Heights
+            which aren't indexed are still looked up by bitcoind.
+
+        :param blocks:
+            Optional :class:`pifkoin.blockfiles.BlockFileReader` for
+            bitcoind's block files.  If the block's location has been
+            recorded in *index* by :meth:`~pifkoin.blockindex.BlockIndex.locate`,
+            the header is read from the file there, without contacting
+            bitcoind at all.  Otherwise, it's fetched with ``getblock``.
+
         """
 
-        assert height or hash, 'Must specify either height or hash'
+        assert height is not None or hash is not None, 'Must specify either height or hash'
 
-        conn = cls._get_bitcoind(**bitcoind_args)
+        conn = None
 
         # Look up the block hash if not specified in the method args
         h = hash
-        if not hash:
-            if height < 0:
-                height = conn.getblockcount() + height + 1
-            h = conn.getblockhash(height)
+        if hash is None:
+            indexed = index.hash(height) if index is not None else None
+            if indexed is not None:
+                h = binascii.hexlify(indexed).decode('ascii')
+            else:
+                conn = cls._get_bitcoind(**bitcoind_args)
+                if height < 0:
+                    height = conn.getblockcount() + height + 1
+                h = conn.getblockhash(height)
         assert hash is None or h == hash, 'Must specify height or hash, not both'
 
+        location = index.location(h) if index is not None and blocks is not None else None
+        if location is not None:
+            header = blocks.header(*location, header_class=cls)
+            header.height = index.height(h)
+            return header
+
         # Construct a new object from the JSON-RPC response
+        if conn is None:
+            conn = cls._get_bitcoind(**bitcoind_args)
         return cls.from_dict(conn.getblock(h))
 
+    @classmethod
+    def range(cls, start=0, end=None, batch_size=500, prefetch=2, method='getblockheader', **bitcoind_args):
+        """
+        Generator which yields the headers of blocks *start* through
+        *end* - 1 from the running bitcoind, in height order.  This is much
+        faster than calling from_blockchain() for each block.
+
+        Lookups are made over a single connection, in JSON-RPC batches of
+        *batch_size* blocks.  Each batch fetches the headers of one set of
+        blocks along with the hashes of the next set, so walking the chain
+        takes one round trip per batch.  A background thread fetches up to
+        *prefetch* batches ahead of the caller.
+
+        If a :class:`pifkoin.bitcoind.Bitcoind` is passed as *bitcoind*, the
+        background thread uses a copy of it with its own connection, so the
+        caller can keep using it while iterating.  Anything else passed as
+        *bitcoind* (such as a :class:`pifkoin.bitcoind.BitcoindPool`) is used
+        from the background thread as-is, so must be safe to share between
+        threads.
+
+        :param start:
+            The first block number to return.  If negative, is regarded as
+            an offset from the next block, as with from_blockchain().
+
+        :param end:
+            The block number to stop before, which may also be negative.
+            By default, continues through the most recent block.
+
+        :param batch_size:
+            Number of blocks to look up per request.
+
+        :param prefetch:
+            Maximum number of batches to fetch before the caller is ready
+            for them.
+
+        :param method:
+            The JSON-RPC method which returns the header for a hash.
+            ``getblockheader`` requires bitcoind 0.12 or later; pass
+            ``getblock`` for older servers.
+
+        """
+
+        conn = cls._get_bitcoind(**bitcoind_args)
+
+        if start < 0 or end is None or end < 0:
+            count = conn.getblockcount()
+            if start < 0:
+                start = count + start + 1
+            if end is None:
+                end = count + 1
+            elif end < 0:
+                end = count + end + 1
+
+        # The caller's connection can't be used from two threads at once:
+        close = conn.close if 'bitcoind' not in bitcoind_args else None
+        if close is None and isinstance(conn, pifkoin.bitcoind.Bitcoind):
+            conn = conn._clone()
+            close = conn._close_clone
+
+        results = queue.Queue(prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # Gives up if the caller stops iterating while the queue's full:
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                hashes = []
+                for first in xrange(start, end + batch_size, batch_size):
+                    with conn.batch(len(hashes) + batch_size) as b:
+                        headers = [getattr(b, method)(h) for h in hashes]
+                        hashes = [b.getblockhash(height) for height in xrange(first, min(first + batch_size, end))]
+                    hashes = [h.result() for h in hashes]
+                    if headers and not put([cls.from_dict(header.result()) for header in headers]):
+                        return
+            except Exception as e:
+                put(e)
+            else:
+                put(None)
+
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                headers = results.get()
+                if headers is None:
+                    break
+                elif isinstance(headers, Exception):
+                    raise headers
+                for header in headers:
+                    yield header
+        finally:
+            stop.set()
+            thread.join()
+            if close is not None:
+                close()
+
     @classmethod
     def from_dict(cls, d):
         """
@@ -196,11 +372,16 @@ class BlockHeader(object):
 
         """
 
-        return cls(**dict([
+        values = dict([
             (k, cls._cond_unhexlify(v))
             for k, v in d.items()
             if k in cls.PARAMETERS
-        ]))
+        ])
+        if values.get('height') == 0:
+            # bitcoind leaves out the genesis block's previous hash, which is
+            # all zeros in its serialization:
+            values.setdefault('previousblockhash', b'\x00' * 32)
+        return cls(**values)
 
     @classmethod
     def from_getwork(cls, **bitcoind_args):
@@ -218,37 +399,50 @@ class BlockHeader(object):
         ]))
 
     @classmethod
-    def from_bytes(cls, data):
+    def from_bytes(cls, data, offset=0, **kwargs):
         """
         Static factory method which returns a new object instance with the
         decoded parameters from *data*.
 
         :param data:
-            Bytestring to decode.
+            Bytestring to decode, or any other object supporting the buffer
+            protocol (such as a :class:`memoryview` of a memory-mapped
+            file).  The values are copied out, so the new instance doesn't
+            hold a reference to *data*.
+
+        :param offset:
+            Position of the header within *data*.
+
+        Any other keyword arguments (such as *height* or *hash*) are passed
+        to the constructor.
 
         """
 
+        version, previousblockhash, merkleroot, timestamp, bits, nonce = struct.unpack_from('<L32s32sL4sL', data, offset)
         return cls(
-            version=struct.unpack('<L', data[:4])[0],
-            previousblockhash=data[4:36][::-1],
-            merkleroot=data[36:68][::-1],
-            time=struct.unpack('<L', data[68:72])[0],
-            bits=data[72:76][::-1],
-            nonce=struct.unpack('<L', data[76:80])[0]
+            version=version,
+            previousblockhash=previousblockhash[::-1],
+            merkleroot=merkleroot[::-1],
+            time=timestamp,
+            bits=bits[::-1],
+            nonce=nonce,
+            **kwargs
         )
 
     @property
     def bytes(self):
         """The block header as a bytestring, suitable for hashing."""
 
-        return b''.join((
-            struct.pack('<L', self.version),
-            self.previousblockhash[::-1],
-            self.merkleroot[::-1],
-            struct.pack('<L', time.mktime(self.time.timetuple())),
-            self.bits[::-1],
-            struct.pack('<L', self.nonce),
-        ))
+        if self._bytes is None:
+            self._bytes = b''.join((
+                struct.pack('<L', self.version),
+                self.previousblockhash[::-1],
+                self.merkleroot[::-1],
+                struct.pack('<L', self.timestamp),
+                self.bits[::-1],
+                struct.pack('<L', self.nonce),
+            ))
+        return self._bytes
 
     @staticmethod
     def _cond_unhexlify(value):
@@ -263,7 +457,14 @@ class BlockHeader(object):
         return value
 
     def __init__(self, height=None, version=1, previousblockhash=None, merkleroot=None, time=None, bits=None, difficulty=None, nonce=None, hash=None):
-        """Constructor."""
+        """
+        Constructor.
+
+        :param time:
+            The block's timestamp, as a :class:`datetime.datetime` or
+            seconds since the epoch.
+
+        """
 
         self.height = height
         self.version = version
@@ -271,8 +472,6 @@ class BlockHeader(object):
         self.previousblockhash = previousblockhash
         assert merkleroot is None or len(merkleroot) == 32, 'Merkle root should be 256 bits long (got %d)' % (len(merkleroot) * 8)
         self.merkleroot = merkleroot
-        if time and not isinstance(time, datetime.datetime):
-            time = datetime.datetime.fromtimestamp(time)
         self.time = time
         if bits:
             assert not difficulty, 'Can specify bits or difficulty, not both'
@@ -282,17 +481,80 @@ class BlockHeader(object):
         else:
             self.bits = None
         self.nonce = nonce
-        assert hash is None or len(hash) == 32, 'Block hash should be 256 bits long (got %d)' % (len(hash) * 8)
         self.hash = hash
 
+    @property
+    def timestamp(self):
+        """The block's timestamp, in seconds since the epoch."""
+
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = None if value is None else int(value)
+        self._bytes = self._hash = None
+
+    @property
+    def time(self):
+        """The block's timestamp, as a :class:`datetime.datetime` in local time."""
+
+        if self._timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(self._timestamp)
+
+    @time.setter
+    def time(self, value):
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                value = time.mktime(value.timetuple())
+            else:
+                value = calendar.timegm(value.utctimetuple())
+        self.timestamp = value
+
+    @property
+    def bits(self):
+        """The target, in compact form, as a 4-byte string."""
+
+        return self._bits
+
+    @bits.setter
+    def bits(self, value):
+        # Copied, in case it's a bytearray which changes under the cache:
+        self._bits = None if value is None else bytes(value)
+        self._bytes = self._target = self._difficulty = self._hash = None
+
+    @property
+    def target(self):
+        """The target, as an integer, which the block's hash must not exceed."""
+
+        if self._target is None and self._bits is not None:
+            self._target = uncompact(self._bits)
+        return self._target
+
     @property
     def difficulty(self):
-        return bits_to_difficulty(self.bits)
+        if self._difficulty is None:
+            self._difficulty = bits_to_difficulty(self.bits)
+        return self._difficulty
 
     @difficulty.setter
     def difficulty(self, difficulty):
         self.bits = difficulty_to_bits(difficulty)
 
+    @property
+    def hash(self):
+        """
+        The block's hash, as a 32-byte string.  Set from bitcoind's data or
+        by calculate_hash(), and cleared if the header changes.
+        """
+
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        assert value is None or len(value) == 32, 'Block hash should be 256 bits long (got %d)' % (len(value) * 8)
+        self._hash = value
+
     def __repr__(self):
         """Return a string representation of the object."""
 
@@ -320,7 +582,7 @@ class BlockHeader(object):
 
         """
 
-        assert (self.version and self.previousblockhash and self.merkleroot and self.time and self.bits and self.nonce is not None), 'Must define all block header values prior to hashing'
+        assert (self.version and self.previousblockhash and self.merkleroot and self.timestamp is not None and self.bits and self.nonce is not None), 'Must define all block header values prior to hashing'
 
         # Our SHA256 implementation takes a "round offset" constructor argument
         # for reporting purposes, which we don't want to include if using
@@ -330,13 +592,13 @@ class BlockHeader(object):
         # See https://en.bitcoin.it/wiki/Block_hashing_algorithm:
         h = sha_impl(sha_impl(self.bytes).digest(), **args).digest()[::-1]
 
-        if bytes_to_long(h) > uncompact(self.bits):
-            raise ValueError, 'Hash does not meet required difficulty'
+        if bytes_to_long(h) > self.target:
+            raise ValueError('Hash does not meet required difficulty')
 
         self.hash = h
         return self.hash
 
-    def find_nonces(self, start=0, end=0xffffffff, difficulty=1, sha_impl=pifkoin.sha256.SHA256):
+    def find_nonces(self, start=0, end=0xffffffff, difficulty=1, sha_impl=pifkoin.sha256.SHA256, processes=1, ordered=True, chunk_size=0x10000, progress=None, lanes=1):
         """
         Generator which yields additional instances of this block header
         with nonces that meet *difficulty*.
@@ -361,14 +623,44 @@ class BlockHeader(object):
             run individual rounds via the same API as our implementation,
             probably because it's a subclass of it.
 
+        :param processes:
+            Number of processes to search with.  If more than 1, the nonces
+            are split into chunks which are handed out to a
+            :class:`multiprocessing.Pool`; :const:`None` uses one process per
+            CPU.  *sha_impl* must then be picklable, i.e. defined at module
+            level.
+
+        :param ordered:
+            When searching with multiple processes, whether to yield results
+            in nonce order.  If :const:`False`, results are yielded as soon as
+            any chunk is finished.
+
+        :param chunk_size:
+            Number of nonces per chunk.
+
+        :param progress:
+            Optional function to call after each chunk, with the total number
+            of nonces tried so far and the number of seconds elapsed, e.g. to
+            report the hash rate.
+
+        :param lanes:
+            Number of nonces to try at once.  If more than 1, every 32-bit
+            word of the hash state is replaced with a NumPy array holding
+            its value for each nonce, so that each call to *sha_impl*'s
+            round functions does the work of many.  Our implementation's
+            operations work on arrays unmodified, but subclasses of it
+            might not.  Thousands of lanes are much faster than one.
+            Subclasses can use another representation for lanes, such as
+            the bit-planes of :class:`pifkoin.sha256.BitslicedSHA256`.
+
         """
 
-        assert (self.version and self.previousblockhash and self.merkleroot and self.time and self.bits), 'Must define all block header values prior to hashing'
+        assert (self.version and self.previousblockhash and self.merkleroot and self.timestamp is not None and self.bits), 'Must define all block header values prior to hashing'
 
         target = difficulty_to_target(difficulty)
 
         # The first block of the first hash gets processed normally:
-        midstate = sha_impl._process_block(self.bytes[:64])
+        midstate = sha_impl(self.bytes[:64]).midstate()
 
         # For the second block, the first few rounds are loop-invariant, so we
         # need to work at a lower level.  Construct the message array with the
@@ -377,7 +669,7 @@ class BlockHeader(object):
         message2 = (
             [
                 struct.unpack('<L', self.merkleroot[:4])[0],
-                socket.htonl(int(time.mktime(self.time.timetuple()))),
+                socket.htonl(self.timestamp),
                 struct.unpack('<L', self.bits)[0],
                 0, # to be filled in later
                 0x80000000, # terminating 1 bit plus padding
@@ -392,60 +684,693 @@ class BlockHeader(object):
         for i in xrange(3):
             midstate2 = sha_impl._round(64+i, message2[i], midstate2)
 
-        # Now we loop over every nonce:
-        for nonce in xrange(start, end+1):
-            # We can now insert the nonce into the message to be hashed and
-            # expand the message into the w array
-            message2[3] = socket.htonl(nonce)
-            w = sha_impl._expand_message(message2)
-
-            # Calculate the remainder of the first hash
-            state = midstate2
-            for i in xrange(3, 64):
-                state = sha_impl._round(64+i, w[i], state)
-            state = sha_impl._finalize(state, midstate)
-
-            # Now we want the hash of the hash:
-            w = sha_impl._expand_message(
-                list(state) +
-                [ 0x80000000 ] + # terminating 1 bit plus padding
-                [ 0 ] * 5 + # padding
-                [
-                    0, # length in bits (MSB)
-                    256, # length in bits (LSB)
-                ]
-            )
-
-            # The final 3 rounds will shift the e register down to h without
-            # modifying it, and h must be all zeros post-_finalize(), so in
-            # most cases we can bypass those rounds.  Calculate the second
-            # hash up until that point:
-            state = sha_impl.INITIAL_STATE
-            for i in xrange(61):
-                state = sha_impl._round(128+i, w[i], state)
-
-            # Go no further if we don't meet the minimum difficulty
-            if state[4] != 0xa41f32e7: # 0xa41f32e7 + INITIAL_STATE.h == 0
-                continue
-
-            # Calculate the remainder of the second hash:
-            for i in xrange(61, 64):
-                state = sha_impl._round(128+i, w[i], state)
-            state = sha_impl._finalize(state)
-            h = struct.pack('>LLLLLLLL', *state)[::-1]
-
-            # We know we meet the minimum difficulty, but target may be more
-            # stringent, so only yield this hash if it's desired:
-            if bytes_to_long(h) < target:
-                yield type(self)(
-                    version=self.version,
-                    previousblockhash=self.previousblockhash,
-                    merkleroot=self.merkleroot,
-                    time=self.time,
-                    bits=self.bits,
-                    nonce=nonce,
-                    hash=h
-                )
+        # Everything the search needs, as plain tuples so it can be pickled:
+        chunks = (
+            (sha_impl, tuple(midstate), tuple(midstate2), message2, chunk_start, min(chunk_start + chunk_size - 1, end), target, lanes)
+            for chunk_start in xrange(start, end + 1, chunk_size)
+        )
+
+        if processes == 1:
+            # Yield results as soon as they're found, rather than at the end
+            # of each chunk:
+            results = ((_iter_nonces(*chunk), chunk[5] - chunk[4] + 1) for chunk in chunks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = (pool.imap if ordered else pool.imap_unordered)(_search_nonces, chunks)
+
+        tried = 0
+        started = time.time()
+        try:
+            for found, count in results:
+                for nonce, h in found:
+                    yield type(self)(
+                        version=self.version,
+                        previousblockhash=self.previousblockhash,
+                        merkleroot=self.merkleroot,
+                        time=self.timestamp,
+                        bits=self.bits,
+                        nonce=nonce,
+                        hash=h
+                    )
+
+                tried += count
+                if progress is not None:
+                    progress(tried, time.time() - started)
+
+        finally:
+            # Stops the workers if the caller stopped iterating early:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+class HeaderStore(object):
+    """
+    Compact, in-memory store for a chain of block headers, such as the
+    whole blockchain.
+
+    Rather than keeping a :class:`BlockHeader` instance per block, the
+    fields are kept in columns: arrays of 32-bit integers for the version,
+    time, bits and nonce, and a contiguous buffer of 32-byte hashes.  Each
+    header's previous block hash is the hash of the header before it, so
+    only the first is stored separately.  That's 80 bytes per header, a
+    small fraction of what instances take.
+
+    Indexing returns a new :class:`BlockHeader` built from the columns.
+    Stores can be saved to and loaded from a flat file of 80-byte headers,
+    in the same format that's hashed, which can also be memory-mapped.
+    """
+
+    HEADER_SIZE = 80
+
+    def __init__(self, start=0):
+        """
+        Constructor.
+
+        :param start:
+            Height of the first header to be stored.
+
+        """
+
+        self.start = start
+        self.versions = array.array('I')
+        self.times = array.array('I')
+        self.bits = array.array('I')
+        self.nonces = array.array('I')
+        # In the byte order they're hashed in, i.e. reversed from how
+        # they're usually displayed:
+        self.hashes = bytearray()
+        self._merkleroots = bytearray()
+        self.first_previousblockhash = None
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _index(self, i):
+        """Returns the position of the *i*th header, which may be negative."""
+
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('Header index out of range')
+        return i
+
+    def __getitem__(self, i):
+        """Returns a :class:`BlockHeader` for the *i*th header."""
+
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+
+        i = self._index(i)
+        return BlockHeader(
+            height=self.start + i,
+            version=self.versions[i],
+            previousblockhash=self._previousblockhash(i)[::-1],
+            merkleroot=bytes(self._merkleroots[i * 32:i * 32 + 32][::-1]),
+            time=self.times[i],
+            bits=struct.pack('>L', self.bits[i]),
+            nonce=self.nonces[i],
+            hash=bytes(self.hashes[i * 32:i * 32 + 32][::-1]),
+        )
+
+    def _previousblockhash(self, i):
+        """Returns the previous block hash of the *i*th header, unreversed."""
+
+        if i == 0:
+            return self.first_previousblockhash
+        return bytes(self.hashes[i * 32 - 32:i * 32])
+
+    def header_bytes(self, i):
+        """Returns the *i*th header as a bytestring, suitable for hashing."""
+
+        i = self._index(i)
+        return b''.join((
+            struct.pack('<L', self.versions[i]),
+            self._previousblockhash(i),
+            bytes(self._merkleroots[i * 32:i * 32 + 32]),
+            struct.pack('<LLL', self.times[i], self.bits[i], self.nonces[i]),
+        ))
+
+    def hash(self, i):
+        """Returns the hash of the *i*th header, in the usual byte order."""
+
+        i = self._index(i)
+        return bytes(self.hashes[i * 32:i * 32 + 32][::-1])
+
+    def append(self, header):
+        """
+        Adds a header to the end of the store.  Raises ValueError if it
+        doesn't follow the last header.
+
+        :param header:
+            A :class:`BlockHeader`, or its 80-byte serialization.
+
+        """
+
+        data = header.bytes if isinstance(header, BlockHeader) else bytes(header)
+        if len(data) != self.HEADER_SIZE:
+            raise ValueError('Block header should be %d bytes long (got %d)' % (self.HEADER_SIZE, len(data)))
+
+        version, previousblockhash, merkleroot, timestamp, bits, nonce = struct.unpack('<L32s32sLLL', data)
+        if not len(self):
+            self.first_previousblockhash = previousblockhash
+        elif previousblockhash != self.hashes[-32:]:
+            raise ValueError('Block header does not follow header %d' % (self.start + len(self) - 1))
+
+        self.versions.append(version)
+        self.times.append(timestamp)
+        self.bits.append(bits)
+        self.nonces.append(nonce)
+        self._merkleroots.extend(merkleroot)
+        self.hashes.extend(hashlib.sha256(hashlib.sha256(data).digest()).digest())
+
+    def extend(self, headers):
+        """Adds each of *headers* to the end of the store."""
+
+        for header in headers:
+            self.append(header)
+
+    def truncate(self, length):
+        """Removes headers from the end, leaving the first *length*."""
+
+        for column in (self.versions, self.times, self.bits, self.nonces):
+            del column[length:]
+        del self._merkleroots[length * 32:]
+        del self.hashes[length * 32:]
+        if not length:
+            self.first_previousblockhash = None
+
+    @property
+    def nbytes(self):
+        """Number of bytes of memory used by the columns."""
+
+        return (
+            sum(column.itemsize * len(column) for column in (self.versions, self.times, self.bits, self.nonces)) +
+            len(self._merkleroots) + len(self.hashes)
+        )
+
+    def save(self, filename):
+        """Writes the headers to *filename*, one after another."""
+
+        count = len(self)
+        words = array.array(self.versions.typecode, [0]) * (count * 20)
+        if count:
+            # The reverse of load(), spreading each column out to every
+            # 20th word:
+            previous = self._words(self.first_previousblockhash + bytes(self.hashes[:-32]))
+            merkleroots = self._words(bytes(self._merkleroots))
+            for i in xrange(8):
+                words[1 + i::20] = previous[i::8]
+                words[9 + i::20] = merkleroots[i::8]
+            words[0::20] = self.versions
+            words[17::20] = self.times
+            words[18::20] = self.bits
+            words[19::20] = self.nonces
+            if sys.byteorder != 'little':
+                words.byteswap()
+
+        with open(filename, 'wb') as f:
+            words.tofile(f)
+
+    @staticmethod
+    def _words(data):
+        """Returns the bytestring *data* as an array of little-endian 32-bit words."""
+
+        words = array.array('I' if array.array('I').itemsize == 4 else 'L')
+        if sys.version > '3':
+            words.frombytes(data)
+        else:
+            words.fromstring(data)
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words
+
+    @classmethod
+    def load(cls, filename, start=0, verify=False):
+        """
+        Static factory method which returns a new instance with the headers
+        from a file written by save() (or any other file of consecutive
+        80-byte headers).
+
+        Only the last header is hashed; the others' hashes are taken from
+        the previous block hash of the header after, which is much faster.
+
+        :param filename:
+            The file to read.
+
+        :param start:
+            Height of the first header in the file.
+
+        :param verify:
+            If :const:`True`, hashes every header, and raises ValueError if
+            they aren't linked together.
+
+        """
+
+        # Each header is 20 little-endian words, so every 20th word
+        # starting from the right one makes a column:
+        words = array.array('I' if array.array('I').itemsize == 4 else 'L')
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % cls.HEADER_SIZE:
+                raise ValueError('%s is not a whole number of block headers' % filename)
+            words.fromfile(f, size // 4)
+        if sys.byteorder != 'little':
+            words.byteswap()
+
+        store = cls(start)
+        count = size // cls.HEADER_SIZE
+        if not count:
+            return store
+
+        store.versions = words[0::20]
+        store.times = words[17::20]
+        store.bits = words[18::20]
+        store.nonces = words[19::20]
+
+        def to_bytes(values):
+            # Back to the byte order they were read in:
+            if sys.byteorder != 'little':
+                values.byteswap()
+            return values.tobytes() if sys.version > '3' else values.tostring()
+
+        def hashes(words, first, skip=0):
+            # Interleaves the 8 columns of *words* starting at *first* back
+            # into consecutive 32-byte values, leaving out the first *skip*
+            # headers.  (Passed in rather than closed over, so *words* can
+            # be deleted below.)
+            result = array.array(words.typecode, [0]) * ((count - skip) * 8)
+            for i in xrange(8):
+                result[i::8] = words[skip * 20 + first + i::20]
+            return bytearray(to_bytes(result))
+
+        store.first_previousblockhash = to_bytes(words[1:9])
+        store._merkleroots = hashes(words, 9)
+        store.hashes = hashes(words, 1, 1)
+        last = to_bytes(words[-20:])
+        store.hashes.extend(hashlib.sha256(hashlib.sha256(last).digest()).digest())
+        del words
+
+        if verify:
+            for i in xrange(count):
+                data = store.header_bytes(i)
+                if hashlib.sha256(hashlib.sha256(data).digest()).digest() != store.hashes[i * 32:i * 32 + 32]:
+                    raise ValueError('Block header %d in %s does not follow header %d' % (start + i + 1, filename, start + i))
+
+        return store
+
+
+class ChainValidationError(ValueError):
+    """Raised by :class:`ChainValidator` when a header is invalid."""
+
+    def __init__(self, height, message):
+        super(ChainValidationError, self).__init__('Block %s: %s' % (height, message))
+        self.height = height
+
+
+class ChainValidator(object):
+    """
+    Checks a chain of block headers, as they arrive.
+
+    Each header must follow the one before it, meet its own target, have a
+    timestamp after the median of the previous 11 and not too far in the
+    future, and have the target given by the retargeting rules: unchanged
+    except every 2016 blocks, when it's adjusted by the time the previous
+    2016 blocks took (clamped to a factor of 4).
+
+    The validator only remembers what's needed to check the next header,
+    so checking new headers takes time proportional to their number, not
+    the length of the chain.  That state can be saved with checkpoint() and
+    restored with from_checkpoint().
+    """
+
+    RETARGET_INTERVAL = 2016
+    TARGET_TIMESPAN = 14 * 24 * 60 * 60
+    MEDIAN_TIME_SPAN = 11
+    MAX_FUTURE = 2 * 60 * 60
+
+    def __init__(self, pow_limit=MAX_TARGET, retarget=True, max_future=MAX_FUTURE):
+        """
+        Constructor.  The first header checked must be the genesis block,
+        unless the validator is resumed from a checkpoint.
+
+        :param pow_limit:
+            The easiest target allowed.
+
+        :param retarget:
+            Whether to check the target changes.  Should be :const:`False`
+            for regtest (where it's fixed) and testnet (where it can reset
+            to *pow_limit*, which isn't supported).
+
+        :param max_future:
+            Number of seconds a timestamp may be ahead of the local clock,
+            or :const:`None` to not check.
+
+        """
+
+        self.pow_limit = pow_limit
+        self.retarget = retarget
+        self.max_future = max_future
+
+        # Everything about the chain so far that's needed to check the next
+        # header:
+        self.height = -1
+        self.hash = b'\x00' * 32
+        self.bits = None
+        self.timestamps = collections.deque(maxlen=self.MEDIAN_TIME_SPAN)
+        self.period_start_time = None
+
+    def checkpoint(self):
+        """
+        Returns the validator's state as a dictionary, which can be encoded
+        as JSON and passed to from_checkpoint() to carry on later.
+        """
+
+        return {
+            'height': self.height,
+            'hash': binascii.hexlify(self.hash).decode('ascii'),
+            'bits': binascii.hexlify(self.bits).decode('ascii') if self.bits is not None else None,
+            'timestamps': list(self.timestamps),
+            'period_start_time': self.period_start_time,
+        }
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, **kwargs):
+        """
+        Static factory method which returns a new instance which continues
+        from a checkpoint() of another.  Any keyword arguments are passed
+        to the constructor.
+        """
+
+        validator = cls(**kwargs)
+        validator.height = checkpoint['height']
+        validator.hash = binascii.unhexlify(checkpoint['hash'])
+        validator.bits = binascii.unhexlify(checkpoint['bits']) if checkpoint['bits'] is not None else None
+        validator.timestamps.extend(checkpoint['timestamps'])
+        validator.period_start_time = checkpoint['period_start_time']
+        return validator
+
+    def _expected_bits(self, height):
+        """Returns the bits the header at *height* must have, or None if unknown."""
+
+        if not self.retarget or self.bits is None:
+            return None
+        if height % self.RETARGET_INTERVAL:
+            return self.bits
+        if self.period_start_time is None:
+            # Resumed from partway through a period without its start:
+            return None
+
+        timespan = self.timestamps[-1] - self.period_start_time
+        timespan = max(self.TARGET_TIMESPAN // 4, min(self.TARGET_TIMESPAN * 4, timespan))
+        target = min(uncompact(self.bits) * timespan // self.TARGET_TIMESPAN, self.pow_limit)
+        return bytes(compact(target))
+
+    def check(self, header, h):
+        """
+        Checks that *header*, whose hash has been calculated as *h*, can
+        follow the headers checked so far, and if so, adds it to the chain.
+        Raises :exc:`ChainValidationError` if it can't.
+        """
+
+        height = self.height + 1
+        if header.previousblockhash != self.hash:
+            raise ChainValidationError(height, 'does not follow %s' % binascii.hexlify(self.hash).decode('ascii'))
+        if header.hash is not None and header.hash != h:
+            raise ChainValidationError(height, 'hash should be %s' % binascii.hexlify(h).decode('ascii'))
+
+        target = header.target
+        if target > self.pow_limit:
+            raise ChainValidationError(height, 'target is above the limit')
+        if bytes_to_long(h) > target:
+            raise ChainValidationError(height, 'hash does not meet target')
+
+        expected = self._expected_bits(height)
+        if expected is not None and header.bits != expected:
+            raise ChainValidationError(height, 'bits should be %s' % binascii.hexlify(expected).decode('ascii'))
+
+        timestamp = header.timestamp
+        if self.timestamps:
+            median = sorted(self.timestamps)[len(self.timestamps) // 2]
+            if timestamp <= median:
+                raise ChainValidationError(height, 'timestamp is not after the median of the previous %d' % len(self.timestamps))
+        if self.max_future is not None and timestamp > time.time() + self.max_future:
+            raise ChainValidationError(height, 'timestamp is too far in the future')
+
+        header.height = height
+        header.hash = h
+        self.height = height
+        self.hash = h
+        self.bits = header.bits
+        self.timestamps.append(timestamp)
+        if not height % self.RETARGET_INTERVAL:
+            self.period_start_time = timestamp
+
+    def validate(self, headers, sha_impl=hashlib.sha256, processes=1, chunk_size=2000, progress=None):
+        """
+        Generator which checks each of *headers* (an iterable of
+        :class:`BlockHeader`), yielding each after it passes with its
+        height and hash set.  Raises :exc:`ChainValidationError` at the
+        first which doesn't.
+
+        :param sha_impl:
+            SHA256 implementation to hash with, as for
+            :meth:`BlockHeader.calculate_hash`.
+
+        :param processes:
+            Number of processes to hash with.  If more than 1, the headers
+            are hashed in chunks by a :class:`multiprocessing.Pool`, a few
+            chunks ahead of the checks, which are still made in order.
+            :const:`None` uses one process per CPU.  *sha_impl* must then be
+            picklable.
+
+        :param chunk_size:
+            Number of headers per chunk.
+
+        :param progress:
+            Optional function to call after each chunk, with the number of
+            headers checked so far and the number of seconds elapsed, e.g.
+            to report headers per second.
+
+        """
+
+        def chunks():
+            chunk = []
+            for header in headers:
+                chunk.append(header)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        if processes == 1:
+            pool = None
+            hashed = ((chunk, _hash_headers((sha_impl, [header.bytes for header in chunk]))) for chunk in chunks())
+        else:
+            pool = multiprocessing.Pool(processes)
+            hashed = self._hash_in_pool(pool, chunks(), sha_impl, 2 * (processes or multiprocessing.cpu_count()))
+
+        checked = 0
+        started = time.time()
+        try:
+            for chunk, hashes in hashed:
+                for header, h in zip(chunk, hashes):
+                    self.check(header, h)
+                    yield header
+
+                checked += len(chunk)
+                if progress is not None:
+                    progress(checked, time.time() - started)
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    @staticmethod
+    def _hash_in_pool(pool, chunks, sha_impl, window):
+        """
+        Generator which hands *chunks* of headers to *pool* to be hashed,
+        yielding each chunk with its hashes, in order.  Only *window*
+        chunks are outstanding at once, so a long stream of headers isn't
+        read into memory.
+        """
+
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(_hash_headers, ((sha_impl, [header.bytes for header in chunk]),))))
+            if len(pending) >= window:
+                chunk, result = pending.popleft()
+                yield chunk, result.get()
+
+        while pending:
+            chunk, result = pending.popleft()
+            yield chunk, result.get()
+
+
+def _hash_headers(args):
+    """
+    Returns the hashes (in the usual byte order) of a list of serialized
+    block headers, using *sha_impl*.  Takes the tuple (sha_impl, headers),
+    so it can be run by a :class:`multiprocessing.Pool` worker.
+    """
+
+    sha_impl, headers = args
+    kwargs = {'round_offset': 128} if inspect.isclass(sha_impl) and issubclass(sha_impl, pifkoin.sha256.SHA256) else {}
+    return [sha_impl(sha_impl(header).digest(), **kwargs).digest()[::-1] for header in headers]
+
+
+def _iter_nonces(sha_impl, midstate, midstate2, message2, start, end, target, lanes=1):
+    """
+    Generator which searches a range of nonces for ones which produce a
+    block hash meeting the target, yielding (nonce, hash) pairs.  This is
+    the inner loop of :meth:`BlockHeader.find_nonces`.
+
+    :param sha_impl:
+        SHA256 implementation to use.
+
+    :param midstate:
+        The hash state after the first block of the header.
+
+    :param midstate2:
+        The hash state after the first 3 rounds of the second block.
+
+    :param message2:
+        The second block's message words.
+
+    :param start:
+        The first nonce to try.
+
+    :param end:
+        The final nonce to try.
+
+    :param target:
+        The largest acceptable hash.
+
+    :param lanes:
+        If more than 1, the search is handed off to
+        :func:`_iter_nonces_vectorized`.
+
+    """
+
+    if lanes > 1:
+        for result in _iter_nonces_vectorized(sha_impl, midstate, midstate2, message2, start, end, target, lanes):
+            yield result
+        return
+
+    midstate = sha_impl.State(*midstate)
+    midstate2 = sha_impl.State(*midstate2)
+    message2 = list(message2)
+
+    # Now we loop over every nonce:
+    for nonce in xrange(start, end+1):
+        # We can now insert the nonce into the message to be hashed and
+        # expand the message into the w array
+        message2[3] = socket.htonl(nonce)
+        w = sha_impl._expand_message(message2)
+
+        # Calculate the remainder of the first hash
+        state = midstate2
+        for i in xrange(3, 64):
+            state = sha_impl._round(64+i, w[i], state)
+        state = sha_impl._finalize(state, midstate)
+
+        # Now we want the hash of the hash:
+        w = sha_impl._expand_message(
+            list(state) +
+            [ 0x80000000 ] + # terminating 1 bit plus padding
+            [ 0 ] * 5 + # padding
+            [
+                0, # length in bits (MSB)
+                256, # length in bits (LSB)
+            ]
+        )
+
+        # The final 3 rounds will shift the e register down to h without
+        # modifying it, and h must be all zeros post-_finalize(), so in
+        # most cases we can bypass those rounds.  Calculate the second
+        # hash up until that point:
+        state = sha_impl.INITIAL_STATE
+        for i in xrange(61):
+            state = sha_impl._round(128+i, w[i], state)
+
+        # Go no further if we don't meet the minimum difficulty
+        if state[4] != 0xa41f32e7: # 0xa41f32e7 + INITIAL_STATE.h == 0
+            continue
+
+        # Calculate the remainder of the second hash:
+        for i in xrange(61, 64):
+            state = sha_impl._round(128+i, w[i], state)
+        state = sha_impl._finalize(state)
+        h = struct.pack('>LLLLLLLL', *state)[::-1]
+
+        # We know we meet the minimum difficulty, but target may be more
+        # stringent, so only yield this hash if it's desired:
+        if bytes_to_long(h) < target:
+            yield nonce, h
+
+
+def _iter_nonces_vectorized(sha_impl, midstate, midstate2, message2, start, end, target, lanes):
+    """
+    Like :func:`_iter_nonces`, but tries *lanes* nonces at a time, each word
+    holding its value for every nonce (a NumPy array of uint32, with our
+    implementation) rather than an int.  Only nonces which make it past the
+    early-out after round 61 are finished off, by :func:`_iter_nonces`; at
+    difficulty 1 or more, that's about one in four billion.
+    """
+
+    # Every word has to be converted, even those which are the same for
+    # every lane, or adding up ints could overflow before they're combined
+    # with an array.  Single-element arrays are broadcast as needed.
+    def words(values):
+        return [sha_impl._lanes_constant(value) for value in values]
+
+    scalar = (tuple(midstate), tuple(midstate2), list(message2))
+    initial_state = sha_impl.State(*words(sha_impl.INITIAL_STATE))
+    midstate = sha_impl.State(*words(midstate))
+    midstate2 = sha_impl.State(*words(midstate2))
+    message2 = words(message2)
+    padding = words([0x80000000, 0, 0, 0, 0, 0, 0, 256])
+
+    for lane_start in xrange(start, end+1, lanes):
+        lane_end = min(lane_start + lanes, end + 1)
+        message2[3] = sha_impl._lanes_from([socket.htonl(nonce) for nonce in xrange(lane_start, lane_end)])
+        w = sha_impl._expand_message(message2)
+
+        # The rest is the same as _iter_nonces(), on every lane at once:
+        state = midstate2
+        for i in xrange(3, 64):
+            state = sha_impl._round(64+i, w[i], state)
+        state = sha_impl._finalize(state, midstate)
+
+        w = sha_impl._expand_message(list(state) + padding)
+
+        state = initial_state
+        for i in xrange(61):
+            state = sha_impl._round(128+i, w[i], state)
+
+        # The early-out becomes a mask:
+        for lane in sha_impl._lanes_matching(state[4], 0xa41f32e7, lane_end - lane_start):
+            nonce = lane_start + lane
+            for result in _iter_nonces(sha_impl, scalar[0], scalar[1], scalar[2], nonce, nonce, target):
+                yield result
+
+
+def _search_nonces(chunk):
+    """
+    Runs :func:`_iter_nonces` with the tuple of arguments *chunk*, in a
+    :class:`multiprocessing.Pool` worker.  Returns a list of the (nonce,
+    hash) pairs found, and the number of nonces tried.
+    """
+
+    return list(_iter_nonces(*chunk)), chunk[5] - chunk[4] + 1
 
 
 if __name__ == '__main__':
@@ -464,6 +1389,27 @@ if __name__ == '__main__':
     else:
         hash = None
 
+    # Validate a synthetic chain served by pifkoin.mockbitcoind, from the
+    # genesis block:
+    import pifkoin.mockbitcoind
+
+    with pifkoin.mockbitcoind.MockBitcoind(pifkoin.mockbitcoind.MockChain(50)) as server:
+        conn = pifkoin.bitcoind.Bitcoind('/dev/null', **server.config)
+        validator = ChainValidator(retarget=False, pow_limit=2 ** 256 - 1)
+        headers = list(validator.validate(BlockHeader.range(0, 50, bitcoind=conn)))
+        assert validator.height == 49 and validator.hash == headers[-1].hash, 'Failed to validate from the genesis block'
+
+        # The caller's connection can be used while iterating:
+        for header in BlockHeader.range(0, 50, batch_size=5, bitcoind=conn):
+            assert BlockHeader.from_dict(conn.getblock(binascii.hexlify(header.hash).decode('ascii'))).bytes == header.bytes, 'Fetched the wrong header'
+
+        store = HeaderStore()
+        store.extend(BlockHeader.range(0, 50, bitcoind=conn))
+        for original, stored in zip(headers, store):
+            assert all(getattr(stored, k) == getattr(original, k) for k in BlockHeader.PARAMETERS), 'Stored header differs from original'
+            assert stored.bytes == original.bytes, 'Stored header serializes differently'
+            assert type(stored.merkleroot) is type(original.merkleroot), 'Stored merkle root should be immutable'
+
     bh = BlockHeader.from_blockchain(height, hash)
     print(bh)
 
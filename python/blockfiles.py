@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Dave Pifke.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Reads blocks directly from bitcoind's ``blocks/blk*.dat`` files, without
+going through JSON-RPC.  The files are memory-mapped, so headers can be
+read as fast as the disk allows.
+
+Run from the commandline to print every header in a directory, e.g.::
+
+    python -m pifkoin.blockfiles ~/.bitcoin/blocks
+
+"""
+
+import binascii
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+
+import pifkoin.blockchain
+
+logger = logging.getLogger('bitcoin')
+
+if sys.version > '3':
+    long = int
+
+
+# The 4 bytes which start every block in the files, which differ by network:
+MAINNET_MAGIC = b'\xf9\xbe\xb4\xd9'
+TESTNET_MAGIC = b'\x0b\x11\x09\x07'
+REGTEST_MAGIC = b'\xfa\xbf\xb5\xda'
+
+
+def write_block_file(filename, blocks, magic=MAINNET_MAGIC):
+    """
+    Writes *blocks* (a sequence of byte strings, each starting with its
+    80-byte header) to *filename* in the same format bitcoind uses.  Useful
+    for creating test data.
+    """
+
+    with open(filename, 'wb') as f:
+        for block in blocks:
+            f.write(magic)
+            f.write(struct.pack('<L', len(block)))
+            f.write(block)
+
+
+class BlockFileReader(object):
+    """
+    Iterates over the blocks stored in a directory of ``blk*.dat`` files.
+
+    Each file is a sequence of records, consisting of the network's magic
+    bytes, the length of the block, and the block itself (starting with its
+    header).  The records are in the order bitcoind downloaded them, which
+    isn't necessarily height order.  Files are read one at a time, so the
+    whole chain can be scanned without mapping it all at once.
+
+    Newer versions of bitcoind obfuscate the files by XORing them with the
+    key in ``xor.dat``, which is handled automatically.  Only the headers
+    need to be decoded, so this doesn't cost much.
+    """
+
+    HEADER_SIZE = 80
+
+    def __init__(self, directory, magic=MAINNET_MAGIC, xor_key=None):
+        """
+        Constructor.
+
+        :param directory:
+            The directory containing the files, usually ``blocks`` under
+            bitcoind's data directory.
+
+        :param magic:
+            The magic bytes of the network whose blocks are stored.
+
+        :param xor_key:
+            The 8-byte key the files are obfuscated with.  By default, it's
+            read from ``xor.dat`` in *directory*, if that exists.
+
+        """
+
+        self.directory = directory
+        self.magic = magic
+
+        if xor_key is None:
+            try:
+                with open(os.path.join(directory, 'xor.dat'), 'rb') as f:
+                    xor_key = f.read()
+            except (IOError, OSError):
+                pass
+        # An all-zero key is the same as no key:
+        self.xor_key = bytearray(xor_key) if xor_key and any(bytearray(xor_key)) else None
+
+    def files(self):
+        """Returns the names of the block files, in order."""
+
+        return sorted(glob.glob(os.path.join(self.directory, 'blk[0-9][0-9][0-9][0-9][0-9].dat')))
+
+    def _decode(self, data, offset, length):
+        """
+        Returns *length* bytes of *data* starting at *offset*.  This is a
+        slice of *data* unless the files are obfuscated, in which case it's
+        a de-obfuscated copy.
+        """
+
+        if self.xor_key is None:
+            return data[offset:offset+length]
+        return self._unxor(data[offset:offset+length], offset)
+
+    def _unxor(self, chunk, offset):
+        """De-obfuscates *chunk*, which was read from *offset* in its file."""
+
+        # The key repeats from the start of the file.  XORing the bytes as
+        # one big number is much faster than doing so one at a time:
+        key = self.xor_key
+        length = len(chunk)
+        start = offset % len(key)
+        stream = bytes((key[start:] + key[:start]) * (length // len(key) + 1))[:length]
+        decoded = long(binascii.hexlify(chunk), 16) ^ long(binascii.hexlify(stream), 16)
+        return binascii.unhexlify('%0*x' % (length * 2, decoded))
+
+    def _scan(self, start):
+        """
+        Generator which maps each file in turn, starting with the *start*th,
+        and yields (filename, data, offset, length) for each block, where
+        *data* is a :class:`memoryview` of the whole file (on Python 2, the
+        :class:`mmap.mmap` itself).
+        """
+
+        for filename in self.files()[start:]:
+            with open(filename, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    continue
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # Python 2's mmap doesn't support memoryview, but slicing it
+            # copies just the slice:
+            view = memoryview(data) if sys.version > '3' else data
+            try:
+                for offset, length in self._records(filename, data):
+                    yield filename, view, offset, length
+            finally:
+                if view is not data:
+                    view.release()
+                try:
+                    data.close()
+                except BufferError:
+                    # The caller kept a slice; the mapping is closed once
+                    # that's garbage collected.
+                    pass
+
+    def blocks(self, start=0):
+        """
+        Generator which yields (filename, offset, block) for each block,
+        where *offset* is the position of the block within the file.
+
+        *block* is a :class:`memoryview` of the memory-mapped file, which is
+        only valid until the generator moves on to the next file; copy it
+        (e.g. with ``bytes()``) to keep it longer.  If the files are
+        obfuscated, or on Python 2, it's a copy instead.
+
+        :param start:
+            Index of the first file to read, for resuming a scan.
+
+        """
+
+        for filename, data, offset, length in self._scan(start):
+            if self.xor_key is None:
+                yield filename, offset, data[offset:offset+length]
+            else:
+                yield filename, offset, memoryview(self._decode(data, offset, length))
+
+    def _records(self, filename, data):
+        """
+        Generator which yields the (offset, length) of each block in the
+        memory-mapped file *data*.
+        """
+
+        offset = 0
+        size = len(data)
+        magic = self.magic
+        while offset + 8 <= size:
+            prefix = bytes(self._decode(data, offset, 8))
+            if prefix[:4] != magic:
+                # bitcoind preallocates the files, so the end is zeros:
+                if not any(bytearray(prefix)):
+                    break
+
+                # Otherwise, something's corrupt; skip to the next block:
+                found = offset + 1
+                if self.xor_key is None:
+                    found = data.find(magic, found)
+                    if found < 0:
+                        found = size
+                else:
+                    while found < size and bytes(self._decode(data, found, 4)) != magic:
+                        found += 1
+                logger.warning('Skipping %d bytes at offset %d of %s', found - offset, offset, filename)
+                offset = found
+                continue
+
+            length = struct.unpack('<L', prefix[4:])[0]
+            if length < self.HEADER_SIZE or offset + 8 + length > size:
+                # Probably still being written:
+                logger.warning('Truncated block at offset %d of %s', offset, filename)
+                break
+
+            yield offset + 8, length
+            offset += 8 + length
+
+    def headers(self, start=0, header_class=pifkoin.blockchain.BlockHeader):
+        """
+        Generator which yields a :class:`pifkoin.blockchain.BlockHeader`
+        (or an instance of *header_class*) for each block, with its hash
+        filled in.  Heights aren't stored in the files, so are left unset.
+
+        :param start:
+            Index of the first file to read.
+
+        """
+
+        sha256 = hashlib.sha256
+        size = self.HEADER_SIZE
+        for filename, data, offset, length in self._scan(start):
+            header = self._decode(data, offset, size)
+            yield header_class.from_bytes(
+                header,
+                hash=sha256(sha256(header).digest()).digest()[::-1]
+            )
+
+    def header(self, filename, offset, header_class=pifkoin.blockchain.BlockHeader):
+        """
+        Returns the :class:`pifkoin.blockchain.BlockHeader` (or instance of
+        *header_class*) of the block at *offset* in *filename*, with its hash
+        filled in, as found by :meth:`blocks` or
+        :meth:`pifkoin.blockindex.BlockIndex.location`.  Only the header is
+        read, rather than mapping the whole file.
+        """
+
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            header = f.read(self.HEADER_SIZE)
+        if len(header) != self.HEADER_SIZE:
+            raise ValueError('No block header at offset %d of %s' % (offset, filename))
+        if self.xor_key is not None:
+            header = self._unxor(header, offset)
+
+        sha256 = hashlib.sha256
+        return header_class.from_bytes(
+            header,
+            hash=sha256(sha256(header).digest()).digest()[::-1]
+        )
+
+
+if __name__ == '__main__':
+    # Can be called from commandline to print the headers in a directory.
+    # Without arguments, reads synthetic files written to a temporary
+    # directory, as a test.
+
+    import shutil
+    import tempfile
+
+    if len(sys.argv) > 1:
+        for header in BlockFileReader(sys.argv[1]).headers():
+            print(header)
+        sys.exit(0)
+
+    import pifkoin.mockbitcoind
+
+    chain = pifkoin.mockbitcoind.MockChain(200)
+    blocks = [header + b'\x01' + os.urandom(i % 300) for i, header in enumerate(chain.headers)]
+    directory = tempfile.mkdtemp()
+    try:
+        # Split across files, with preallocated space at the end of one and
+        # garbage in the middle of another:
+        write_block_file(os.path.join(directory, 'blk00000.dat'), blocks[:50])
+        with open(os.path.join(directory, 'blk00000.dat'), 'ab') as f:
+            f.write(b'\x00' * 4096)
+        write_block_file(os.path.join(directory, 'blk00001.dat'), blocks[50:100] + [b'garbage'] + blocks[100:])
+        with open(os.path.join(directory, 'blk00001.dat'), 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'garbage') - 8)
+            f.write(b'\x00\x00\x00\x00garbage')
+
+        reader = BlockFileReader(directory)
+        headers = list(reader.headers())
+        assert [h.hash for h in headers] == [h[::-1] for h in chain.hashes], 'Read the wrong headers'
+        assert [h.bytes for h in headers] == chain.headers, 'Failed to decode headers'
+        assert [bytes(block) for filename, offset, block in reader.blocks()] == blocks, 'Read the wrong blocks'
+
+        # The same, obfuscated:
+        key = os.urandom(8)
+        for name in ('blk00000.dat', 'blk00001.dat'):
+            with open(os.path.join(directory, name), 'r+b') as f:
+                data = bytearray(f.read())
+                for i in range(len(data)):
+                    data[i] ^= bytearray(key)[i % 8]
+                f.seek(0)
+                f.write(data)
+        with open(os.path.join(directory, 'xor.dat'), 'wb') as f:
+            f.write(key)
+
+        reader = BlockFileReader(directory)
+        headers = list(reader.headers())
+        assert [h.hash for h in headers] == [h[::-1] for h in chain.hashes], 'Failed to de-obfuscate headers'
+        assert [reader.header(filename, offset).bytes for filename, offset, block in reader.blocks()] == chain.headers, 'Failed to read headers by offset'
+        print('Read %d headers from %d files' % (len(headers), len(reader.files())))
+    finally:
+        shutil.rmtree(directory)
+
+# eof
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Dave Pifke.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+A local, persistent index of the main chain, mapping block heights to
+hashes and back, and to where each block is stored in bitcoind's
+``blocks/blk*.dat`` files.  Looking a block up in the index takes a few
+microseconds, rather than a round trip to bitcoind.
+
+The index is kept in an SQLite database, and brought up to date with
+bitcoind's chain by calling :meth:`BlockIndex.update` now and then.
+
+Run from the commandline to update an index and print its tip, e.g.::
+
+    python -m pifkoin.blockindex ~/.pifkoin-index.db
+
+"""
+
+import binascii
+import hashlib
+import logging
+import sqlite3
+import sys
+import threading
+
+import pifkoin.blockchain
+
+logger = logging.getLogger('bitcoin')
+
+if sys.version > '3':
+    xrange = range
+
+
+class BlockIndex(object):
+    """
+    Maps the height of each block in the main chain to its hash, and
+    optionally its location in bitcoind's block files.
+
+    Hashes are in the usual (reversed) byte order, as for
+    :attr:`pifkoin.blockchain.BlockHeader.hash`.  Methods which take a hash
+    also accept it hex-encoded, as returned by bitcoind.
+
+    Instances can be shared between threads.  Other processes can read the
+    same database while one updates it.
+    """
+
+    def __init__(self, filename=':memory:'):
+        """
+        Constructor.  Opens the index stored in *filename*, creating it if
+        it doesn't exist.  By default, the index is only kept in memory.
+        """
+
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._db:
+            # Lets readers in other processes carry on during updates:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS blocks (
+                    height INTEGER PRIMARY KEY,
+                    hash BLOB NOT NULL UNIQUE,
+                    file TEXT,
+                    offset INTEGER
+                )
+            ''')
+
+    def close(self):
+        """Closes the database."""
+
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _query(self, sql, *args):
+        """Returns the first row returned by *sql*, or :const:`None`."""
+
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    @staticmethod
+    def _hash_arg(h):
+        """Returns the hash *h* as a byte string, un-hexlifying it if needed."""
+
+        if len(h) == 64:
+            return binascii.unhexlify(h)
+        return bytes(h)
+
+    def __len__(self):
+        """Returns the number of blocks indexed, which is one more than the height of the tip."""
+
+        row = self._query('SELECT MAX(height) FROM blocks')
+        return 0 if row[0] is None else row[0] + 1
+
+    def tip(self):
+        """Returns the (height, hash) of the last block indexed, or :const:`None`."""
+
+        row = self._query('SELECT height, hash FROM blocks ORDER BY height DESC LIMIT 1')
+        return row and (row[0], bytes(row[1]))
+
+    def hash(self, height):
+        """
+        Returns the hash of the block at *height*, or :const:`None` if it
+        isn't indexed.
+
+        :param height:
+            The block number.  If negative, is regarded as an offset from
+            the block after the tip of the index.
+
+        """
+
+        if height < 0:
+            height += len(self)
+        row = self._query('SELECT hash FROM blocks WHERE height = ?', height)
+        return row and bytes(row[0])
+
+    def height(self, h):
+        """Returns the height of the block with hash *h*, or :const:`None` if it isn't indexed."""
+
+        row = self._query('SELECT height FROM blocks WHERE hash = ?', sqlite3.Binary(self._hash_arg(h)))
+        return row and row[0]
+
+    def location(self, h):
+        """
+        Returns the (filename, offset) of the block with hash *h* in
+        bitcoind's block files, or :const:`None` if it hasn't been found by
+        :meth:`locate`.  *offset* is where the block starts, after the
+        magic bytes and length which precede it.
+        """
+
+        row = self._query('SELECT file, offset FROM blocks WHERE hash = ? AND file IS NOT NULL', sqlite3.Binary(self._hash_arg(h)))
+        return row and tuple(row)
+
+    def truncate(self, height):
+        """Removes the blocks at *height* and above from the index."""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM blocks WHERE height >= ?', (height,))
+
+    def extend(self, hashes, start=None):
+        """
+        Adds the blocks with *hashes* to the index, in order, as a single
+        transaction.
+
+        :param start:
+            The height of the first block.  Any blocks already indexed at
+            or above it are replaced, as after a reorg.  By default, the
+            blocks are added after the tip.
+
+        """
+
+        with self._lock, self._db:
+            row = self._db.execute('SELECT MAX(height) FROM blocks').fetchone()
+            length = 0 if row[0] is None else row[0] + 1
+            if start is None:
+                start = length
+            elif start > length:
+                raise ValueError('Block %d does not follow the %d blocks indexed' % (start, length))
+            else:
+                self._db.execute('DELETE FROM blocks WHERE height >= ?', (start,))
+            self._db.executemany(
+                'INSERT INTO blocks (height, hash) VALUES (?, ?)',
+                ((height, sqlite3.Binary(self._hash_arg(h))) for height, h in enumerate(hashes, start))
+            )
+
+    def _fork_height(self, conn, count):
+        """
+        Returns the height of the first indexed block which isn't in the
+        chain of the bitcoind connection *conn*, whose tip is at *count*.
+
+        Blocks are compared from the tip of the index backwards, in batches
+        which double in size, so the usual case of no reorg takes a single
+        request, and a reorg of *n* blocks about log2(*n*).
+        """
+
+        top = min(len(self), count + 1)
+        size = 1
+        while top > 0:
+            first = max(0, top - size)
+            with conn.batch() as b:
+                theirs = [b.getblockhash(height) for height in xrange(first, top)]
+            with self._lock:
+                ours = dict(self._db.execute(
+                    'SELECT height, hash FROM blocks WHERE height >= ? AND height < ?', (first, top)
+                ))
+
+            for height in xrange(top - 1, first - 1, -1):
+                if bytes(ours[height]) == binascii.unhexlify(theirs[height - first].result()):
+                    return height + 1
+
+            top = first
+            size *= 2
+
+        return 0
+
+    def update(self, batch_size=2000, **bitcoind_args):
+        """
+        Brings the index up to date with the running bitcoind's chain.  If
+        there's been a reorg since the last update, the blocks which are no
+        longer in the chain are replaced.  Returns the height of the first
+        block added or replaced.
+
+        New blocks are added in transactions of *batch_size* blocks, so an
+        interrupted update of a new index isn't lost.  Other arguments are
+        as for :meth:`pifkoin.blockchain.BlockHeader.from_blockchain`.
+        """
+
+        conn = pifkoin.blockchain.BlockHeader._get_bitcoind(**bitcoind_args)
+        try:
+            count = conn.getblockcount()
+            fork = self._fork_height(conn, count)
+            if fork < len(self):
+                logger.info('Reorg: replacing blocks %d through %d', fork, len(self) - 1)
+                self.truncate(fork)
+
+            for first in xrange(fork, count + 1, batch_size):
+                with conn.batch() as b:
+                    hashes = [b.getblockhash(height) for height in xrange(first, min(first + batch_size, count + 1))]
+                self.extend((h.result() for h in hashes), first)
+
+        finally:
+            if 'bitcoind' not in bitcoind_args:
+                conn.close()
+
+        return fork
+
+    def locate(self, reader, start=0):
+        """
+        Records where each indexed block is in bitcoind's block files, so
+        :meth:`location` can find them.  Blocks which aren't in the index
+        (such as those orphaned by a reorg) are skipped.  Returns the number
+        of blocks located.
+
+        :param reader:
+            A :class:`pifkoin.blockfiles.BlockFileReader` for the files.
+
+        :param start:
+            Index of the first file to read, for resuming.
+
+        """
+
+        sha256 = hashlib.sha256
+        located = 0
+        rows = []
+        for filename, offset, block in reader.blocks(start):
+            h = sha256(sha256(block[:reader.HEADER_SIZE]).digest()).digest()[::-1]
+            rows.append((filename, offset, sqlite3.Binary(h)))
+            if len(rows) == 10000:
+                located += self._set_locations(rows)
+                rows = []
+        return located + self._set_locations(rows)
+
+    def _set_locations(self, rows):
+        """Stores (filename, offset, hash) *rows*, returning how many were indexed."""
+
+        with self._lock, self._db:
+            return self._db.executemany('UPDATE blocks SET file = ?, offset = ? WHERE hash = ?', rows).rowcount
+
+
+if __name__ == '__main__':
+    # Can be called from commandline to update an index and print its tip.
+    # Without arguments, indexes a synthetic chain served by
+    # pifkoin.mockbitcoind, as a test.
+
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    logging.basicConfig()
+
+    if len(sys.argv) > 1:
+        with BlockIndex(sys.argv[1]) as index:
+            index.update()
+            height, h = index.tip()
+            print('%d %s' % (height, binascii.hexlify(h).decode('ascii')))
+        sys.exit(0)
+
+    import pifkoin.bitcoind
+    import pifkoin.blockfiles
+    import pifkoin.mockbitcoind
+
+    chain = pifkoin.mockbitcoind.MockChain(500)
+    directory = tempfile.mkdtemp()
+    try:
+        with pifkoin.mockbitcoind.MockBitcoind(chain) as server:
+            conn = pifkoin.bitcoind.Bitcoind('/dev/null', **server.config)
+            index = BlockIndex(os.path.join(directory, 'index.db'))
+
+            assert index.update(bitcoind=conn) == 0, 'New index should start at the genesis block'
+            assert len(index) == 500 and index.hash(-1) == chain.hashes[-1][::-1], 'Failed to index chain'
+
+            # The tip advancing, then a reorg of the last few blocks:
+            chain.reorg(0, 10)
+            assert index.update(bitcoind=conn) == 500, 'Should only have added new blocks'
+            chain.reorg(5)
+            assert index.update(bitcoind=conn) == 505, 'Should have replaced the reorged blocks'
+            assert [index.hash(height) for height in range(len(chain.hashes))] == [h[::-1] for h in chain.hashes], 'Index differs from chain'
+
+            # A deeper reorg, to a shorter chain, seen by a reopened index:
+            index.close()
+            chain.reorg(300, 200)
+            index = BlockIndex(os.path.join(directory, 'index.db'))
+            assert index.update(bitcoind=conn) == 211, 'Should have found the fork'
+            assert len(index) == 411 and index.height(chain.hashes[-1][::-1]) == 410, 'Index differs from chain'
+
+        # Hex-encoded hashes, and unknown heights and hashes:
+        assert index.height(binascii.hexlify(chain.hashes[123][::-1]).decode('ascii')) == 123
+        assert index.hash(411) is None and index.height(b'\x00' * 32) is None
+
+        # Locations from block files, including a block no longer in the chain:
+        blocks = [header + b'\x01' for header in chain.headers] + [b'\x00' * 81]
+        pifkoin.blockfiles.write_block_file(os.path.join(directory, 'blk00000.dat'), blocks)
+        reader = pifkoin.blockfiles.BlockFileReader(directory)
+        assert index.locate(reader) == 411, 'Failed to locate blocks'
+        assert index.location(chain.hashes[2][::-1]) == (os.path.join(directory, 'blk00000.dat'), 8 + 89 * 2)
+
+        # Which can then be read without bitcoind (whose mock has stopped):
+        header = pifkoin.blockchain.BlockHeader.from_blockchain(-1, index=index, blocks=reader)
+        assert header.height == 410 and header.bytes == chain.headers[-1], 'Failed to read located header'
+
+        began = time.time()
+        for i in range(1000):
+            pifkoin.blockchain.BlockHeader.from_blockchain(i % 411, index=index, blocks=reader)
+        print('Read %d located headers, %.1f microseconds per header' % (1000, (time.time() - began) * 1000))
+
+        began = time.time()
+        for i in range(10000):
+            index.hash(i % 411)
+        print('Indexed %d blocks, %.1f microseconds per lookup' % (len(index), (time.time() - began) * 100))
+        index.close()
+    finally:
+        shutil.rmtree(directory)
+
+# eof
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Dave Pifke.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Stand-in for bitcoind's JSON-RPC server, for testing and benchmarking
+without a real node.  It serves a synthetic chain of block headers with
+valid (if very easy) proof of work, and can be told to respond slowly or
+fail some fraction of requests.
+
+Run from the commandline, e.g.::
+
+    python -m pifkoin.mockbitcoind --port 18443 --blocks 10000 --latency 0.005
+
+or start one in a background thread::
+
+    with MockBitcoind(MockChain(1000)) as server:
+        conn = Bitcoind('/dev/null', **server.config)
+
+"""
+
+import argparse
+import base64
+import binascii
+import hashlib
+import inspect
+import json
+import logging
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import pifkoin.sha256
+
+logger = logging.getLogger('bitcoin')
+
+if sys.version > '3':
+    xrange = range
+    long = int
+    basestring = str
+
+
+def _sha256d(data):
+    """Bitcoin's double SHA256."""
+
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def _hex(data):
+    """Hex-encodes *data*, returning a native string."""
+
+    return binascii.hexlify(data).decode('ascii')
+
+
+def _bits_to_target(bits):
+    """Expands the compact representation *bits* (an integer)."""
+
+    return (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+
+
+class MockRPCError(Exception):
+    """Raised by :class:`MockChain` methods to return a JSON-RPC error."""
+
+    def __init__(self, code, message):
+        super(MockRPCError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _check_type(value, kind):
+    """
+    Raises the same error as bitcoind if the JSON-RPC parameter *value* isn't
+    of *kind*: ``'integer'``, ``'boolean'`` or ``'string'``.
+    """
+
+    if kind == 'integer':
+        ok = isinstance(value, (int, long)) and not isinstance(value, bool)
+    elif kind == 'boolean':
+        ok = isinstance(value, bool)
+    else:
+        ok = isinstance(value, basestring)
+    if not ok:
+        raise MockRPCError(-3, 'JSON value is not %s as expected' % ('an integer' if kind == 'integer' else 'a %s' % kind))
+
+
+def _check_hash(value, name='blockhash'):
+    """Raises the same error as bitcoind if *value* isn't a hex-encoded hash."""
+
+    _check_type(value, 'string')
+    if len(value) != 64:
+        raise MockRPCError(-8, '%s must be of length 64 (not %d, for \'%s\')' % (name, len(value), value))
+    try:
+        binascii.unhexlify(value)
+    except (TypeError, ValueError, binascii.Error):
+        raise MockRPCError(-8, '%s must be hexadecimal string (not \'%s\')' % (name, value))
+
+
+class MockChain(object):
+    """
+    A synthetic chain of block headers.  Each block has a single (fictional)
+    transaction, and is spaced ten minutes after the previous one.
+
+    Methods named ``rpc_*`` implement the JSON-RPC commands of the same name,
+    with bitcoind's argument and result formats.  They can be called from
+    several threads at once.
+    """
+
+    # Regtest's difficulty, where one hash in two meets the target:
+    DEFAULT_BITS = 0x207fffff
+
+    # The genesis block's timestamp:
+    DEFAULT_START_TIME = 1231006505
+
+    def __init__(self, blocks=1000, bits=DEFAULT_BITS, start_time=DEFAULT_START_TIME, version=1):
+        """
+        Constructor.  Mines *blocks* blocks (including the genesis block)
+        with the compact difficulty target *bits*.
+        """
+
+        self.bits = bits
+        self.target = _bits_to_target(bits)
+        self.start_time = start_time
+        self.version = version
+
+        self.headers = []
+        self.hashes = []
+        self.heights = {}
+        self.reorgs = 0
+        self._lock = threading.Lock()
+
+        for height in range(blocks):
+            self._append(self._mine(height))
+
+    def _merkleroot(self, height):
+        """Returns the merkle root for the block at *height*."""
+
+        return _sha256d(('pifkoin mock coinbase %d' % height).encode('ascii'))
+
+    def _template(self, height, timestamp=None):
+        """
+        Returns the first 76 bytes (everything but the nonce) of a header
+        which would extend the chain at *height*.
+        """
+
+        return b''.join((
+            struct.pack('<L', self.version),
+            self.hashes[height - 1] if height else b'\x00' * 32,
+            self._merkleroot(height),
+            struct.pack('<LL', timestamp or self.start_time + 600 * height, self.bits),
+        ))
+
+    def _mine(self, height, timestamp=None):
+        """Returns a valid header for the block at *height*."""
+
+        prefix = self._template(height, timestamp)
+        for nonce in xrange(0x100000000):
+            header = prefix + struct.pack('<L', nonce)
+            if self._meets_target(header):
+                return header
+        raise ValueError('No nonce found at height %d' % height)
+
+    def _meets_target(self, header):
+        """Returns :const:`True` if *header* has enough proof of work."""
+
+        return int(_hex(_sha256d(header)[::-1]), 16) <= self.target
+
+    def _append(self, header):
+        """Adds *header* to the end of the chain."""
+
+        h = _sha256d(header)
+        self.heights[h] = len(self.headers)
+        self.headers.append(header)
+        self.hashes.append(h)
+
+    def reorg(self, depth, blocks=None):
+        """
+        Replaces the last *depth* blocks with *blocks* new ones (by default,
+        one more than were replaced), as if a competing chain had overtaken
+        the current one.  With a *depth* of 0, just extends the chain.
+        """
+
+        if blocks is None:
+            blocks = depth + 1
+        with self._lock:
+            first = len(self.headers) - depth
+            for h in self.hashes[first:]:
+                del self.heights[h]
+            del self.headers[first:]
+            del self.hashes[first:]
+
+            if depth:
+                self.reorgs += 1
+
+            # Later than the blocks replaced, so they differ:
+            for height in range(first, first + blocks):
+                self._append(self._mine(height, self.start_time + 600 * height + self.reorgs))
+
+    def _lookup(self, blockhash):
+        """Returns the height of the block with the hex-encoded *blockhash*."""
+
+        try:
+            return self.heights[binascii.unhexlify(blockhash)[::-1]]
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            raise MockRPCError(-5, 'Block not found')
+
+    def _difficulty(self, bits):
+        """Returns the difficulty corresponding to *bits*."""
+
+        return float(_bits_to_target(0x1d00ffff)) / _bits_to_target(bits)
+
+    def rpc_getblockcount(self):
+        return len(self.headers) - 1
+
+    def rpc_getbestblockhash(self):
+        return _hex(self.hashes[-1][::-1])
+
+    def rpc_getblockhash(self, height):
+        _check_type(height, 'integer')
+        if not 0 <= height < len(self.headers):
+            raise MockRPCError(-8, 'Block height out of range')
+        return _hex(self.hashes[height][::-1])
+
+    def rpc_getdifficulty(self):
+        return self._difficulty(self.bits)
+
+    def rpc_getblockheader(self, blockhash, verbose=True):
+        _check_hash(blockhash)
+        _check_type(verbose, 'boolean')
+        height = self._lookup(blockhash)
+        header = self.headers[height]
+        if not verbose:
+            return _hex(header)
+
+        version, timestamp, bits, nonce = struct.unpack('<L64xLLL', header)
+        result = {
+            'hash': _hex(self.hashes[height][::-1]),
+            'confirmations': len(self.headers) - height,
+            'height': height,
+            'version': version,
+            'merkleroot': _hex(header[36:68][::-1]),
+            'time': timestamp,
+            'nonce': nonce,
+            'bits': '%08x' % bits,
+            'difficulty': self._difficulty(bits),
+        }
+        if height:
+            result['previousblockhash'] = _hex(self.hashes[height - 1][::-1])
+        if height + 1 < len(self.hashes):
+            result['nextblockhash'] = _hex(self.hashes[height + 1][::-1])
+        return result
+
+    def rpc_getblock(self, blockhash, verbose=True):
+        _check_hash(blockhash)
+        _check_type(verbose, 'boolean')
+        if not verbose:
+            raise MockRPCError(-8, 'Raw blocks are not supported')
+
+        result = self.rpc_getblockheader(blockhash)
+        result['size'] = 81
+        result['tx'] = [result['merkleroot']]
+        return result
+
+    def rpc_getwork(self, data=None):
+        """
+        Without arguments, returns work extending the current tip.  With
+        *data*, checks the solved block and, if it's valid, adds it to the
+        chain.
+        """
+
+        if data is None:
+            with self._lock:
+                header = self._template(len(self.headers), int(time.time())) + b'\x00' * 4
+            padded = header + b'\x80' + b'\x00' * 39 + struct.pack('>Q', 640)
+            midstate = pifkoin.sha256.SHA256._process_block(padded[:64])
+            return {
+                # getwork reverses the byte order of every 4-byte word:
+                'data': _hex(b''.join(padded[i:i+4][::-1] for i in range(0, len(padded), 4))),
+                'midstate': _hex(struct.pack('<8L', *midstate)),
+                'hash1': '00000000000000000000000000000000000000000000000000000000000000000000008000000000000000000000000000000000000000000000000000010000',
+                'target': _hex(binascii.unhexlify('%064x' % self.target)[::-1]),
+            }
+
+        _check_type(data, 'string')
+        try:
+            padded = binascii.unhexlify(data)
+        except (TypeError, ValueError, binascii.Error):
+            raise MockRPCError(-8, 'Invalid parameter')
+        header = b''.join(padded[i:i+4][::-1] for i in range(0, 80, 4))
+        with self._lock:
+            if header[4:36] != self.hashes[-1] or not self._meets_target(header):
+                return False
+            self._append(header)
+        return True
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    """Handles JSON-RPC requests for :class:`MockBitcoind`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def _reply(self, status, body):
+        """Sends a response with *body* (which is JSON-encoded)."""
+
+        body = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, request):
+        """Performs a single JSON-RPC request, returning its response."""
+
+        rpc_id = request.get('id')
+        try:
+            try:
+                method = getattr(self.server.chain, 'rpc_%s' % request['method'])
+            except (AttributeError, KeyError, TypeError):
+                raise MockRPCError(-32601, 'Method not found')
+            params = request.get('params', [])
+            if not isinstance(params, list):
+                raise MockRPCError(-32600, 'Params must be an array')
+            try:
+                spec = inspect.getfullargspec(method)
+            except AttributeError:
+                spec = inspect.getargspec(method)
+            required = len(spec.args) - 1 - len(spec.defaults or ())
+            if not required <= len(params) <= len(spec.args) - 1:
+                raise MockRPCError(-1, 'Wrong number of parameters')
+            result = method(*params)
+        except MockRPCError as e:
+            return {'result': None, 'error': {'code': e.code, 'message': e.message}, 'id': rpc_id}
+        except Exception as e:
+            # A bug in the mock, rather than a bad request:
+            logger.exception('Error performing %r', request)
+            return {'result': None, 'error': {'code': -32603, 'message': 'Internal error: %s' % e}, 'id': rpc_id}
+        return {'result': result, 'error': None, 'id': rpc_id}
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.headers.get('Authorization') != 'Basic %s' % server.auth:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        if server.failure_rate and random.random() < server.failure_rate:
+            failure = random.choice(server.failure_modes)
+            if failure == 'reset':
+                self.close_connection = True
+                self.request.shutdown(socket.SHUT_RDWR)
+            elif failure == 'busy':
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif failure == 'warmup':
+                self._reply(500, {'result': None, 'error': {'code': -28, 'message': 'Loading block index...'}, 'id': None})
+            return
+
+        try:
+            request = json.loads(body.decode('utf8'))
+        except ValueError:
+            self._reply(500, {'result': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None})
+            return
+
+        if isinstance(request, list):
+            self._reply(200, [self._dispatch(entry) for entry in request])
+            return
+
+        response = self._dispatch(request)
+        if response['error'] is None:
+            self._reply(200, response)
+        elif response['error']['code'] == -32601:
+            self._reply(404, response)
+        else:
+            self._reply(500, response)
+
+
+class MockBitcoind(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server which answers JSON-RPC requests like bitcoind, using a
+    :class:`MockChain`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Ways in which a request can be made to fail: closing the connection
+    # without a response, a 503 ("work queue depth exceeded") response, or
+    # a "still loading" error.
+    FAILURE_MODES = ('reset', 'busy', 'warmup')
+
+    def __init__(self, chain=None, host='127.0.0.1', port=0, rpcuser='pifkoin', rpcpassword='pifkoin',
+                 latency=0.0, jitter=0.0, failure_rate=0.0, failure_modes=FAILURE_MODES):
+        """
+        Constructor.
+
+        :param chain:
+            The :class:`MockChain` to serve.  By default, one with 1000
+            blocks is created.
+
+        :param port:
+            The port to listen on.  By default, any free port is used; see
+            :attr:`config`.
+
+        :param latency:
+            Number of seconds to wait before answering each request.
+
+        :param jitter:
+            Maximum number of seconds to wait in addition to *latency*,
+            chosen at random for each request.
+
+        :param failure_rate:
+            Fraction of requests which should fail, in one of the ways
+            listed in *failure_modes* (chosen at random).
+
+        """
+
+        HTTPServer.__init__(self, (host, port), _MockRequestHandler)
+        self.chain = chain if chain is not None else MockChain()
+        self.rpcuser = rpcuser
+        self.rpcpassword = rpcpassword
+        self.auth = base64.b64encode(('%s:%s' % (rpcuser, rpcpassword)).encode('utf8')).decode('ascii')
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_modes = tuple(failure_modes)
+        self._thread = None
+
+    @property
+    def config(self):
+        """
+        Options to pass to the :class:`pifkoin.bitcoind.Bitcoind` constructor
+        to connect to this server.
+        """
+
+        host, port = self.server_address[:2]
+        return {
+            'rpcserver': host,
+            'rpcport': str(port),
+            'rpcuser': self.rpcuser,
+            'rpcpassword': self.rpcpassword,
+        }
+
+    def start(self):
+        """Starts serving requests in a background thread."""
+
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread started by :meth:`start`."""
+
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18443, help='0 to pick any free port')
+    parser.add_argument('--rpcuser', default='pifkoin')
+    parser.add_argument('--rpcpassword', default='pifkoin')
+    parser.add_argument('--blocks', type=int, default=1000, help='length of the chain to serve')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum additional random wait')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests which fail')
+    parser.add_argument('--failure-modes', default=','.join(MockBitcoind.FAILURE_MODES), help='comma-separated ways in which requests fail')
+    args = parser.parse_args()
+
+    server = MockBitcoind(
+        MockChain(args.blocks),
+        host=args.host,
+        port=args.port,
+        rpcuser=args.rpcuser,
+        rpcpassword=args.rpcpassword,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        failure_modes=args.failure_modes.split(','),
+    )
+    # Scripts starting us with --port 0 read the port from this line:
+    print('Listening on %s:%d' % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# eof
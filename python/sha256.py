@@ -23,15 +23,37 @@
 
 """SHA256 (FIPS 180-3) implementation for experimentation."""
 
+import array
 import binascii
 import codecs
 import collections
 import struct
 import sys
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 if sys.version > '3':
     long = int
 
+# array typecode for unsigned 32-bit words, used by TraceRecorder:
+_WORD = 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+class EarlyTermination(Exception):
+    """
+    Raised by a hash built with :meth:`SHA256.variant` when one of its
+    early-exit predicates rejects the working state.
+    """
+
+    def __init__(self, round, state):
+        super(EarlyTermination, self).__init__('Hash abandoned after round %d' % round)
+        self.round = round
+        self.state = state
+
 
 class SHA256(object):
     """
@@ -72,6 +94,11 @@ class SHA256(object):
         0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
     )
 
+    # Number of rounds per block, and early-exit predicates, which variant()
+    # can change:
+    ROUNDS = 64
+    _exits = {}
+
     # Abstract bitwise operations, which can be overridden to provide tracing
     # or alternate implementations:
     @staticmethod
@@ -199,10 +226,20 @@ class SHA256(object):
         assert len(message) == 64, '_process_block() got %d bytes, expected 64' % len(message)
         assert not round_offset % 64, 'round_offset should be a multiple of 64'
 
-        w = cls._expand_message(struct.unpack('>LLLLLLLLLLLLLLLL', message))
+        return cls._process_words(struct.unpack('>LLLLLLLLLLLLLLLL', message), state, round_offset)
+
+    @classmethod
+    def _process_words(cls, message, state=INITIAL_STATE, round_offset=0):
+        """
+        Like _process_block(), but takes the block as 16 32-bit words.  The
+        words (and state) can also be NumPy arrays, to process many blocks
+        at once; see hash_many().
+        """
+
+        w = cls._expand_message(message)
 
         midstate = state
-        for i in range(64):
+        for i in range(cls.ROUNDS):
             midstate = cls._round(round_offset + i, w[i], midstate)
 
         return cls._finalize(midstate, state)
@@ -249,6 +286,282 @@ class SHA256(object):
                 )),
             ]
 
+    # Conversions between ints and the words used when hashing many
+    # messages in lockstep, such as by find_nonces() with lanes.  Here a
+    # word is a NumPy array with one element per lane (or a single element,
+    # which is broadcast), but subclasses can use other representations:
+    @staticmethod
+    def _lanes_constant(value):
+        """Returns a word holding *value* in every lane."""
+
+        if numpy is None:
+            raise ImportError('NumPy is required to hash in lanes')
+        return numpy.array([value], dtype=numpy.uint32)
+
+    @staticmethod
+    def _lanes_from(values):
+        """Returns a word holding each of *values* in its own lane."""
+
+        if numpy is None:
+            raise ImportError('NumPy is required to hash in lanes')
+        return numpy.array(values, dtype=numpy.uint32)
+
+    @staticmethod
+    def _lanes_matching(word, value, count):
+        """Returns the indexes of the first *count* lanes of *word* equal to *value*."""
+
+        return [int(lane) for lane in numpy.flatnonzero(word[:count] == value)]
+
+    @classmethod
+    def hash_many(cls, messages, round_offset=0, lanes=65536):
+        """
+        Returns a list of the digests of *messages*, which must all be the
+        same length.
+
+        If NumPy is available, the messages are hashed in lockstep: each
+        32-bit word passed to _round() and the other operations is an array
+        holding that word for every message, rather than an int.  This goes
+        through the same overridable methods as hashing messages one at a
+        time, and is much faster.  For double hashing, pass the results back
+        in.
+
+        :param messages:
+            Sequence of byte strings to hash.
+
+        :param round_offset:
+            See the constructor.
+
+        :param lanes:
+            Maximum number of messages to hash at once, which bounds the
+            memory used.  Without NumPy, this is ignored: the messages are
+            hashed one at a time, with no speedup, and a warning is issued.
+            :class:`BitslicedSHA256` hashes in lanes without NumPy.
+
+        """
+
+        messages = [bytes(message) for message in messages]
+        if not messages:
+            return []
+        length = len(messages[0])
+        assert all(len(message) == length for message in messages), 'hash_many() requires messages of the same length'
+
+        if numpy is None or len(messages) == 1:
+            if len(messages) > 1:
+                warnings.warn('NumPy is not available, so hash_many() is hashing one message at a time', RuntimeWarning, stacklevel=2)
+            return [cls(message, round_offset).digest() for message in messages]
+
+        # Since the messages are the same length, they all get the same
+        # padding:
+        partial = length % 64
+        padding = b''.join(cls._pad_message(b'\x00' * partial, length * 8))[partial:]
+        blocks = (length + len(padding)) // 64
+
+        # Single-element arrays are broadcast as needed:
+        initial_state = cls.State(*[numpy.array([word], dtype=numpy.uint32) for word in cls.INITIAL_STATE])
+
+        digests = []
+        for first in range(0, len(messages), lanes):
+            batch = messages[first:first+lanes]
+            words = numpy.frombuffer(
+                b''.join([message + padding for message in batch]),
+                dtype='>u4',
+            ).reshape(len(batch), blocks * 16).T.astype(numpy.uint32)
+
+            state = initial_state
+            for block in range(blocks):
+                state = cls._process_words(
+                    [words[block * 16 + i] for i in range(16)],
+                    state,
+                    round_offset + block * 64,
+                )
+
+            # One row of 8 big-endian words per message:
+            result = numpy.column_stack(state).astype('>u4').tobytes()
+            digests.extend(result[i:i+32] for i in range(0, len(result), 32))
+
+        return digests
+
+    @classmethod
+    def from_midstate(cls, state, length, round_offset=None):
+        """
+        Static factory method which returns a new instance that resumes
+        hashing from a midstate, as returned by midstate().  Further data
+        passed to update() is hashed as if it followed the *length* bytes
+        the midstate was calculated from.
+
+        :param state:
+            The 8 32-bit words of the intermediate hash state.
+
+        :param length:
+            Number of bytes hashed to reach *state*.  Must be a multiple of
+            64.
+
+        :param round_offset:
+            See the constructor.  Defaults to the number of rounds needed to
+            hash *length* bytes.
+
+        """
+
+        if length % 64:
+            raise ValueError('Midstate length must be a multiple of 64 bytes (got %d)' % length)
+
+        instance = cls(round_offset=length // 64 * 64 if round_offset is None else round_offset)
+        instance.state = cls.State(*state)
+        instance.length = long(length) * 8
+        return instance
+
+    @classmethod
+    def traced(cls, on_round=None, on_expand=None, on_finalize=None):
+        """
+        Returns a subclass which calls the given functions as it hashes,
+        for generating test vectors or debugging.  If no functions are
+        given, returns this class, so there's no cost to having tracing
+        switched off.
+
+        The callbacks are attached to _round(), _expand_message() and
+        _finalize(), so they also see the rounds performed by code which
+        calls those directly, such as
+        :meth:`pifkoin.blockchain.BlockHeader.find_nonces`.  See
+        :class:`TraceRecorder` for a way to store the trace compactly.
+
+        :param on_round:
+            Called as ``on_round(number, state)`` after each round, with
+            the round number (counting from round_offset) and the new
+            working state.
+
+        :param on_expand:
+            Called as ``on_expand(w)`` with the 64 words of each expanded
+            message block.
+
+        :param on_finalize:
+            Called as ``on_finalize(state)`` with the intermediate hash
+            value after each block.
+
+        """
+
+        if on_round is None and on_expand is None and on_finalize is None:
+            return cls
+
+        methods = {}
+
+        # Only the operations being traced are overridden:
+        if on_round is not None:
+            def _round(tcls, number, w, prev=cls.INITIAL_STATE):
+                state = super(traced, tcls)._round(number, w, prev)
+                on_round(number, state)
+                return state
+            methods['_round'] = classmethod(_round)
+
+        if on_expand is not None:
+            def _expand_message(tcls, message):
+                w = super(traced, tcls)._expand_message(message)
+                on_expand(w)
+                return w
+            methods['_expand_message'] = classmethod(_expand_message)
+
+        if on_finalize is not None:
+            def _finalize(tcls, state, initial_state=cls.INITIAL_STATE):
+                state = super(traced, tcls)._finalize(state, initial_state)
+                on_finalize(state)
+                return state
+            methods['_finalize'] = classmethod(_finalize)
+
+        traced = type('Traced%s' % cls.__name__, (cls,), methods)
+        return traced
+
+    @classmethod
+    def variant(cls, rounds=None, exits=None, finalize=None, name=None):
+        """
+        Returns a subclass implementing a variant of the algorithm, for
+        experimenting with reduced-round hashes or the shortcuts used by
+        miners.
+
+        For example, after 61 rounds of the second hash of a block header,
+        the e register holds what will become the last word of the digest
+        (less the initial state), which must be zero to meet the minimum
+        difficulty.  This hash gives up on most headers three rounds early::
+
+            Bitcoin = SHA256.variant(exits={61: lambda state: state.e == 0xa41f32e7})
+            try:
+                h = Bitcoin(SHA256(header).digest()).digest()
+            except EarlyTermination:
+                h = None
+
+        :param rounds:
+            Number of rounds to perform per block, up to 64.  Defaults to
+            the same as this class.
+
+        :param exits:
+            Dict mapping a number of rounds to a function, which is called
+            with the working state after that many rounds of each block.
+            If it returns a false value, hashing stops and
+            :exc:`EarlyTermination` is raised.  The state words must be
+            ints, so this doesn't work with hash_many().
+
+        :param finalize:
+            Function called as ``finalize(state, initial_state)`` in place of
+            _finalize() at the end of each block, returning the new
+            intermediate hash value.  Useful for reduced-round variants
+            where the feed-forward addition gets in the way.
+
+        :param name:
+            Name of the returned class.
+
+        """
+
+        rounds = cls.ROUNDS if rounds is None else rounds
+        # Exits are inherited when making a variant of a variant:
+        inherited = exits
+        exits = dict(cls._exits)
+        exits.update(inherited or {})
+        if not 1 <= rounds <= 64:
+            raise ValueError('Rounds must be between 1 and 64 (got %d)' % rounds)
+        for after in exits:
+            if not 1 <= after <= rounds:
+                raise ValueError('Cannot exit after round %d of %d' % (after, rounds))
+
+        methods = {'ROUNDS': rounds, '_exits': exits}
+
+        if exits:
+            stretches = cls._stretches(rounds, exits)
+
+            def _process_words(vcls, message, state=cls.INITIAL_STATE, round_offset=0):
+                w = vcls._expand_message(message)
+
+                midstate = state
+                for first, last, check in stretches:
+                    for i in range(first, last):
+                        midstate = vcls._round(round_offset + i, w[i], midstate)
+                    if check is not None and not check(midstate):
+                        raise EarlyTermination(round_offset + last, midstate)
+
+                return vcls._finalize(midstate, state)
+            methods['_process_words'] = classmethod(_process_words)
+
+        if finalize is not None:
+            def _finalize(vcls, state, initial_state=cls.INITIAL_STATE):
+                return vcls.State(*finalize(state, initial_state))
+            methods['_finalize'] = classmethod(_finalize)
+
+        return type(name or '%sVariant' % cls.__name__, (cls,), methods)
+
+    @staticmethod
+    def _stretches(rounds, exits):
+        """
+        Splits the rounds of a variant into stretches between its exits,
+        returning a list of (first round, last round + 1, predicate or
+        None) tuples.
+        """
+
+        stretches = []
+        first = 0
+        for after in sorted(exits):
+            stretches.append((first, after, exits[after]))
+            first = after
+        if first < rounds:
+            stretches.append((first, rounds, None))
+        return stretches
+
     def __init__(self, message=b'', round_offset=0):
         """
         Constructor.
@@ -276,24 +589,59 @@ class SHA256(object):
         """
         Updates the hash with the contents of *message*.
 
-        Hashing uses 512-bit blocks, so the message is buffered until there's
-        enough data to process a complete block.  When digest() is called,
-        any remaining data in the buffer will be padded and digested.
+        Hashing uses 512-bit blocks, so any data left over after the last
+        complete block is buffered until there's more.  When digest() is
+        called, any remaining data in the buffer will be padded and digested.
+
+        Complete blocks are passed to _process_block() as slices of a
+        :class:`memoryview`, without copying, so hashing large inputs takes
+        time proportional to their size.
 
         :param message:
-            A byte string to digest.
+            A byte string, or any other object supporting the buffer
+            protocol (such as a :class:`bytearray`, :class:`array.array` or
+            :class:`mmap.mmap`), to digest.  Non-contiguous buffers are
+            copied first, and anything else is converted with bytes(), as
+            before.
 
         """
 
-        message = bytes(message)
-        self.length += len(message) * 8
-        self.buffer = b''.join((self.buffer, message))
+        try:
+            view = memoryview(message)
+        except TypeError:
+            if sys.version < '3':
+                # Python 2's memoryview() doesn't support old-style buffers
+                # such as mmap, which bytes() would turn into their repr():
+                try:
+                    message = buffer(message)[:]
+                except TypeError:
+                    pass
+            view = memoryview(bytes(message))
+        if not getattr(view, 'c_contiguous', True):
+            # Such as a strided slice, which can't be cast:
+            view = memoryview(view.tobytes())
+        if view.itemsize != 1 or view.ndim != 1:
+            view = view.cast('B')
+        self.length += len(view) * 8
+
+        # Top up a partial block left over from last time:
+        start = 0
+        if self.buffer:
+            start = min(64 - len(self.buffer), len(view))
+            self.buffer = b''.join((self.buffer, view[:start].tobytes()))
+            if len(self.buffer) < 64:
+                return
+            self.state = self._process_block(self.buffer, self.state, self.round_offset)
+            self.buffer = b''
+            self.round_offset += 64
 
-        while len(self.buffer) >= 64:
-            self.state = self._process_block(self.buffer[:64], self.state, self.round_offset)
-            self.buffer = self.buffer[64:]
+        end = start + (len(view) - start) // 64 * 64
+        for offset in range(start, end, 64):
+            self.state = self._process_block(view[offset:offset+64], self.state, self.round_offset)
             self.round_offset += 64
 
+        self.buffer = view[end:].tobytes()
+
     def digest(self):
         """
         Returns the SHA256 digest of the message.
@@ -316,6 +664,441 @@ class SHA256(object):
 
         return binascii.hexlify(self.digest())
 
+    def copy(self):
+        """
+        Returns a copy of this hash object, which can be updated separately.
+        Useful for hashing several messages which share a prefix, without
+        hashing the prefix more than once.
+        """
+
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def midstate(self):
+        """
+        Returns the intermediate hash state after the data passed so far,
+        which must be a multiple of 64 bytes long.  Pass it to
+        from_midstate() to resume hashing later, or elsewhere.
+        """
+
+        if self.buffer:
+            raise ValueError('Midstate is only defined after a multiple of 64 bytes (%d left over)' % len(self.buffer))
+        return self.state
+
+
+class FastSHA256(SHA256):
+    """
+    Drop-in replacement for :class:`SHA256` which is several times faster.
+
+    It has the same API, so it can be used anywhere the reference class can
+    (such as :meth:`pifkoin.blockchain.BlockHeader.find_nonces`), but the
+    bitwise operations are inlined, and _process_block() keeps the
+    registers in local variables rather than calling _round().  Overriding
+    the operations in a subclass therefore has no effect; use
+    :class:`SHA256` for that.  traced() still works.
+
+    Like the reference class, it also works with NumPy arrays in place of
+    ints.
+    """
+
+    # K paired with each round number, for _process_words():
+    _ROUNDS = tuple(enumerate(SHA256.K))
+
+    # A version of _process_words() which calls _round(), for traced():
+    _process_words_by_round = SHA256.__dict__['_process_words']
+
+    @classmethod
+    def _round(cls, number, w, prev=SHA256.INITIAL_STATE):
+        a, b, c, d, e, f, g, h = prev
+
+        # Rotations can leave garbage above bit 31 (of ints), which the
+        # final masking throws away:
+        t1 = (
+            h +
+            (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))) +
+            ((e & f) ^ (~e & g)) +
+            cls.K[number % 64] +
+            w
+        )
+        t2 = (
+            (((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) +
+            ((a & b) ^ (a & c) ^ (b & c))
+        )
+
+        return cls.State((t1 + t2) & 0xffffffff, a, b, c, (d + t1) & 0xffffffff, e, f, g)
+
+    @classmethod
+    def _finalize(cls, state, initial_state=SHA256.INITIAL_STATE):
+        a, b, c, d, e, f, g, h = state
+        a0, b0, c0, d0, e0, f0, g0, h0 = initial_state
+
+        return cls.State(
+            (a + a0) & 0xffffffff,
+            (b + b0) & 0xffffffff,
+            (c + c0) & 0xffffffff,
+            (d + d0) & 0xffffffff,
+            (e + e0) & 0xffffffff,
+            (f + f0) & 0xffffffff,
+            (g + g0) & 0xffffffff,
+            (h + h0) & 0xffffffff,
+        )
+
+    @classmethod
+    def _expand_message(cls, message):
+        assert len(message) == 16, '_expand_message() got %d words, expected 16' % len(message)
+
+        w = list(message)
+        append = w.append
+        for i in range(16, 64):
+            x = w[i - 15]
+            y = w[i - 2]
+            append((
+                w[i - 16] +
+                (((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)) +
+                w[i - 7] +
+                (((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10))
+            ) & 0xffffffff)
+
+        return w
+
+    @classmethod
+    def _process_words(cls, message, state=SHA256.INITIAL_STATE, round_offset=0):
+        w = cls._expand_message(message)
+
+        a, b, c, d, e, f, g, h = state
+        for i, k in cls._ROUNDS:
+            t1 = (
+                h +
+                (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))) +
+                ((e & f) ^ (~e & g)) +
+                k +
+                w[i]
+            )
+            t2 = (
+                (((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) +
+                ((a & b) ^ (a & c) ^ (b & c))
+            )
+            h = g
+            g = f
+            f = e
+            e = (d + t1) & 0xffffffff
+            d = c
+            c = b
+            b = a
+            a = (t1 + t2) & 0xffffffff
+
+        return cls._finalize((a, b, c, d, e, f, g, h), state)
+
+    @classmethod
+    def traced(cls, on_round=None, on_expand=None, on_finalize=None):
+        """
+        Like :meth:`SHA256.traced`.  When tracing rounds, the returned class
+        goes back to calling _round() for each one.
+        """
+
+        traced = super(FastSHA256, cls).traced(on_round, on_expand, on_finalize)
+        if on_round is not None:
+            traced._process_words = cls.__dict__.get('_process_words_by_round', FastSHA256._process_words_by_round)
+        return traced
+
+    @classmethod
+    def variant(cls, rounds=None, exits=None, finalize=None, name=None):
+        """
+        Like :meth:`SHA256.variant`, keeping the rounds inlined.
+        """
+
+        variant = super(FastSHA256, cls).variant(rounds, exits, finalize, name)
+        variant._ROUNDS = FastSHA256._ROUNDS[:variant.ROUNDS]
+        if not variant._exits:
+            return variant
+        variant._process_words_by_round = variant.__dict__['_process_words']
+
+        # Same as FastSHA256._process_words(), with a check at the end of
+        # each stretch of rounds:
+        stretches = [
+            (FastSHA256._ROUNDS[first:last], check)
+            for first, last, check in cls._stretches(variant.ROUNDS, variant._exits)
+        ]
+
+        def _process_words(vcls, message, state=SHA256.INITIAL_STATE, round_offset=0):
+            w = vcls._expand_message(message)
+
+            a, b, c, d, e, f, g, h = state
+            for stretch, check in stretches:
+                for i, k in stretch:
+                    t1 = (
+                        h +
+                        (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))) +
+                        ((e & f) ^ (~e & g)) +
+                        k +
+                        w[i]
+                    )
+                    t2 = (
+                        (((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) +
+                        ((a & b) ^ (a & c) ^ (b & c))
+                    )
+                    h = g
+                    g = f
+                    f = e
+                    e = (d + t1) & 0xffffffff
+                    d = c
+                    c = b
+                    b = a
+                    a = (t1 + t2) & 0xffffffff
+
+                if check is not None and not check(vcls.State(a, b, c, d, e, f, g, h)):
+                    raise EarlyTermination(round_offset + stretch[-1][0] + 1, vcls.State(a, b, c, d, e, f, g, h))
+
+            return vcls._finalize((a, b, c, d, e, f, g, h), state)
+
+        variant._process_words = classmethod(_process_words)
+        return variant
+
+
+class TraceRecorder(object):
+    """
+    Records the working state after every round of one or more hashes,
+    along with each block's expanded message and intermediate hash value,
+    into preallocated arrays of 32-bit words rather than Python objects.
+    This takes 2336 bytes per block, so the rounds of millions of hashes
+    can be kept in memory.
+
+    Usage::
+
+        recorder = TraceRecorder()
+        SHA256.traced(**recorder.callbacks())(b'abc').digest()
+        recorder.state(0, 63)   # state after the last round of block 0
+
+    Only int words can be recorded, so it won't work with hash_many().
+    """
+
+    def __init__(self, blocks=64):
+        """
+        Constructor.
+
+        :param blocks:
+            Number of blocks to allocate space for.  The arrays are grown
+            (doubling in size) if more are recorded.
+
+        """
+
+        self.capacity = 0
+        self.blocks = 0
+        self.rounds = array.array(_WORD)
+        self.schedule = array.array(_WORD)
+        self.digests = array.array(_WORD)
+        self._grow(blocks)
+
+    def _grow(self, blocks):
+        """Adds room for *blocks* more blocks to the arrays."""
+
+        zero = array.array(_WORD, [0])
+        self.rounds.extend(zero * (blocks * 64 * 8))
+        self.schedule.extend(zero * (blocks * 64))
+        self.digests.extend(zero * (blocks * 8))
+        self.capacity += blocks
+
+    def callbacks(self):
+        """Returns keyword arguments for :meth:`SHA256.traced`."""
+
+        return {
+            'on_round': self.on_round,
+            'on_expand': self.on_expand,
+            'on_finalize': self.on_finalize,
+        }
+
+    def on_round(self, number, state):
+        if self.blocks == self.capacity:
+            self._grow(self.capacity or 1)
+        offset = (self.blocks * 64 + number % 64) * 8
+        self.rounds[offset:offset+8] = array.array(_WORD, state)
+
+    def on_expand(self, w):
+        if self.blocks == self.capacity:
+            self._grow(self.capacity or 1)
+        offset = self.blocks * 64
+        self.schedule[offset:offset+64] = array.array(_WORD, w)
+
+    def on_finalize(self, state):
+        if self.blocks == self.capacity:
+            self._grow(self.capacity or 1)
+        offset = self.blocks * 8
+        self.digests[offset:offset+8] = array.array(_WORD, state)
+        self.blocks += 1
+
+    def state(self, block, number):
+        """
+        Returns the working state recorded after round *number* (0-63) of
+        the *block*th block hashed.
+        """
+
+        offset = (block * 64 + number) * 8
+        return SHA256.State(*self.rounds[offset:offset+8])
+
+    def expanded(self, block):
+        """Returns the 64 expanded message words of the *block*th block."""
+
+        return list(self.schedule[block * 64:block * 64 + 64])
+
+    def intermediate(self, block):
+        """
+        Returns the intermediate hash value after the *block*th block, as
+        bytes.  After the last block of a message, this is its digest.
+        """
+
+        return struct.pack('>LLLLLLLL', *self.digests[block * 8:block * 8 + 8])
+
+    def clear(self):
+        """Starts recording from the first block again, reusing the arrays."""
+
+        self.blocks = 0
+
+    def __len__(self):
+        return self.blocks
+
+
+class BitslicedSHA256(SHA256):
+    """
+    SHA256 implementation which hashes many messages at once, by slicing
+    their words into bit-planes.
+
+    Each 32-bit word is represented by a tuple of 32 Python ints, the nth
+    holding bit n of the word for every message (one message per bit, or
+    "lane").  The bitwise operations then work on all lanes at once, and
+    rotations and shifts just reorder the tuple.  Addition becomes a
+    ripple-carry adder.  Since Python ints have no fixed width, the number
+    of lanes is unlimited, though thousands work best.
+
+    Constants are bit-planes of 0 or -1 (all ones), so they apply to any
+    number of lanes.  Plain int words are hashed like :class:`SHA256`, so
+    instances work as a (slow) drop-in replacement, and the class can be
+    passed as *sha_impl* to
+    :meth:`pifkoin.blockchain.BlockHeader.find_nonces` with lanes.
+    """
+
+    @staticmethod
+    def _planes(x):
+        """Returns *x* as bit-planes, slicing it first if it's an int."""
+
+        if isinstance(x, tuple):
+            return x
+        return tuple(-((x >> bit) & 1) for bit in range(32))
+
+    @classmethod
+    def _sum_mod32(cls, *args):
+        if not any(isinstance(x, tuple) for x in args):
+            return super(BitslicedSHA256, cls)._sum_mod32(*args)
+
+        total = cls._planes(args[0])
+        for x in args[1:]:
+            result = []
+            carry = 0
+            for a, b in zip(total, cls._planes(x)):
+                t = a ^ b
+                result.append(t ^ carry)
+                carry = (a & b) | (carry & t)
+            total = tuple(result)
+        return total
+
+    @classmethod
+    def _xor(cls, *args):
+        if not isinstance(args[0], tuple):
+            return super(BitslicedSHA256, cls)._xor(*args)
+        if len(args) == 2:
+            return tuple(a ^ b for a, b in zip(args[0], args[1]))
+        return tuple(a ^ b ^ c for a, b, c in zip(*args))
+
+    @staticmethod
+    def _and(x, y):
+        if not isinstance(x, tuple):
+            return x & y
+        return tuple(a & b for a, b in zip(x, y))
+
+    @staticmethod
+    def _invert(x):
+        if not isinstance(x, tuple):
+            return ~x
+        return tuple(~a for a in x)
+
+    @staticmethod
+    def _rrot(x, n):
+        if not isinstance(x, tuple):
+            return SHA256._rrot(x, n)
+        return x[n:] + x[:n]
+
+    @staticmethod
+    def _shr(x, n):
+        if not isinstance(x, tuple):
+            return SHA256._shr(x, n)
+        return x[n:] + (0,) * n
+
+    @classmethod
+    def _lanes_constant(cls, value):
+        return cls._planes(value)
+
+    @staticmethod
+    def _lanes_from(values):
+        # Transposes the values by way of binary strings, which is much
+        # faster than setting bits one at a time.  Lane 0 is the least
+        # significant bit, so comes last:
+        rows = ['{0:032b}'.format(value) for value in reversed(values)]
+        columns = list(zip(*rows))
+        return tuple(int(''.join(columns[31 - bit]), 2) for bit in range(32))
+
+    @staticmethod
+    def _lanes_to(word, count):
+        """Returns the values of the first *count* lanes of *word*, as ints."""
+
+        mask = (1 << count) - 1
+        rows = zip(*['{0:0{1}b}'.format(plane & mask, count) for plane in reversed(word)])
+        return [int(''.join(row), 2) for row in rows][::-1]
+
+    @staticmethod
+    def _lanes_matching(word, value, count):
+        matches = (1 << count) - 1
+        for bit, plane in enumerate(word):
+            matches &= plane if (value >> bit) & 1 else ~plane
+
+        lanes = []
+        while matches:
+            lowest = matches & -matches
+            lanes.append(lowest.bit_length() - 1)
+            matches ^= lowest
+        return lanes
+
+    @classmethod
+    def hash_many(cls, messages, round_offset=0, lanes=4096):
+        """
+        Like :meth:`SHA256.hash_many`, using bit-planes rather than NumPy
+        arrays.
+        """
+
+        messages = [bytes(message) for message in messages]
+        if not messages:
+            return []
+        length = len(messages[0])
+        assert all(len(message) == length for message in messages), 'hash_many() requires messages of the same length'
+
+        partial = length % 64
+        padding = b''.join(cls._pad_message(b'\x00' * partial, length * 8))[partial:]
+        words = (length + len(padding)) // 4
+
+        digests = []
+        for first in range(0, len(messages), lanes):
+            batch = messages[first:first+lanes]
+            unpacked = [struct.unpack('>%dL' % words, message + padding) for message in batch]
+            message_words = [cls._lanes_from(column) for column in zip(*unpacked)]
+
+            state = cls.State(*[cls._planes(word) for word in cls.INITIAL_STATE])
+            for block in range(words // 16):
+                state = cls._process_words(message_words[block * 16:block * 16 + 16], state, round_offset + block * 64)
+
+            columns = [cls._lanes_to(word, len(batch)) for word in state]
+            digests.extend(struct.pack('>LLLLLLLL', *row) for row in zip(*columns))
+
+        return digests
+
 
 if __name__ == '__main__':
     # Test routine.  Compares our output to that of the stdlib.  We also
@@ -345,6 +1128,7 @@ if __name__ == '__main__':
     finally:
         elapsed = time.time() - start
         print ('Mine: %d hashes (%d bytes) in %0.2f secs (%0.2f H/s %d B/s)' % (i+1, consumed, elapsed, float(i+1) / elapsed, float(consumed) / elapsed))
+        mine_elapsed = elapsed
 
     try:
         consumed = 0
@@ -358,7 +1142,103 @@ if __name__ == '__main__':
         elapsed = time.time() - start
         print ('stdlib: %d hashes (%d bytes) in %0.2f secs (%0.2f H/s %d B/s)' % (i+1, consumed, elapsed, float(i+1) / elapsed, float(consumed) / elapsed))
 
+    try:
+        fast = []
+        consumed = 0
+        start = time.time()
+        for i in range(count):
+            fast.append(FastSHA256(message[:i]).hexdigest())
+            consumed += i
+    finally:
+        fast_elapsed = time.time() - start
+        print ('Fast: %d hashes (%d bytes) in %0.2f secs (%0.2f H/s %d B/s, %0.1fx mine)' % (i+1, consumed, fast_elapsed, float(i+1) / fast_elapsed, float(consumed) / fast_elapsed, mine_elapsed / fast_elapsed))
+
     for a, b, i in zip(mine, stdlib, range(count)):
         assert a == b, '%r (mine) != %r (stdlib) calculating SHA256(%r) of length %d' % (a, b, message[:i], i)
+    for a, b, i in zip(fast, stdlib, range(count)):
+        assert a == b, '%r (fast) != %r (stdlib) calculating SHA256(%r) of length %d' % (a, b, message[:i], i)
+
+    # Test copy() and midstate round-tripping, with a shared prefix:
+    split = len(message) // 64 * 64
+    prefix = SHA256(message[:split])
+    for suffix in (b'', b'abc', message[split:]):
+        h = prefix.copy()
+        h.update(suffix)
+        assert h.digest() == hashlib.sha256(message[:split] + suffix).digest(), 'copy() failed'
+        h = SHA256.from_midstate(prefix.midstate(), split)
+        h.update(suffix)
+        assert h.digest() == hashlib.sha256(message[:split] + suffix).digest(), 'from_midstate() failed'
+    assert prefix.digest() == hashlib.sha256(message[:split]).digest(), 'copy() modified the original'
+
+    # Test update() with other kinds of buffer, which should hash the same
+    # bytes as the stdlib does:
+    import mmap
+    import tempfile
+    if sys.version > '3':
+        # Python 2's memoryview doesn't support strided slices:
+        strided = memoryview(bytearray(message))[::2]
+        assert SHA256(strided).digest() == hashlib.sha256(message[::2]).digest(), 'Failed to hash a strided memoryview'
+    with tempfile.TemporaryFile() as f:
+        f.write(message)
+        f.flush()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert SHA256(mapped).digest() == hashlib.sha256(message).digest(), 'Failed to hash an mmap'
+        mapped.close()
+    words = array.array('H', message[:len(message) // 2 * 2])
+    assert SHA256(words).digest() == hashlib.sha256(message[:len(message) // 2 * 2]).digest(), 'Failed to hash an array'
+
+    # Test tracing, which should record the same rounds and digests with
+    # either implementation, and not change the results:
+    assert SHA256.traced() is SHA256, 'traced() without callbacks should return the class'
+    recorders = []
+    for cls in (SHA256, FastSHA256):
+        recorder = TraceRecorder(1)
+        assert cls.traced(**recorder.callbacks())(message).digest() == hashlib.sha256(message).digest(), 'traced() changed the digest'
+        assert len(recorder) == len(message) // 64 + (2 if len(message) % 64 > 55 else 1), 'traced() recorded %d blocks' % len(recorder)
+        assert recorder.intermediate(len(recorder) - 1) == hashlib.sha256(message).digest(), 'TraceRecorder has the wrong digest'
+        recorders.append(recorder)
+    assert recorders[0].rounds == recorders[1].rounds and recorders[0].schedule == recorders[1].schedule, 'SHA256 and FastSHA256 traces differ'
+
+    # Test variants: a full-length variant should match the stdlib, early
+    # exits should only be taken when the predicate fails, and reduced
+    # rounds should agree between implementations:
+    for cls in (SHA256, FastSHA256):
+        assert cls.variant()(message).digest() == hashlib.sha256(message).digest(), 'variant() changed the digest'
+        exits = {61: lambda state: state.e == 0xa41f32e7}
+        try:
+            cls.variant(exits=exits)(message).digest()
+            assert False, 'variant() did not exit early'
+        except EarlyTermination as e:
+            assert e.round % 64 == 61, 'variant() exited after round %d' % e.round
+        passing = {61: lambda state: True}
+        assert cls.variant(exits=passing)(message).digest() == hashlib.sha256(message).digest(), 'variant() exited anyway'
+    for rounds in (1, 20, 63):
+        no_feed_forward = lambda state, initial_state: state
+        assert SHA256.variant(rounds, finalize=no_feed_forward)(message).digest() == FastSHA256.variant(rounds, finalize=no_feed_forward)(message).digest(), '%d-round variants differ' % rounds
+
+    # Test the bit-sliced implementation, both one message at a time and
+    # in lanes:
+    assert BitslicedSHA256(message).digest() == hashlib.sha256(message).digest(), 'BitslicedSHA256 got the wrong digest'
+    for length in (80, 32):
+        messages = [os.urandom(length) for i in range(count)]
+        start = time.time()
+        mine = BitslicedSHA256.hash_many(messages)
+        elapsed = time.time() - start
+        print ('Bitsliced: %d hashes (%d bytes each) in %0.2f secs (%0.2f H/s)' % (len(messages), length, elapsed, float(len(messages)) / elapsed))
+
+        for a, m in zip(mine, messages):
+            assert a == hashlib.sha256(m).digest(), 'BitslicedSHA256.hash_many() got %r calculating SHA256(%r)' % (a, m)
+
+    # Also test hash_many(), with block header-sized messages and then
+    # their hashes (as when double hashing):
+    for length in (80, 32):
+        messages = [os.urandom(length) for i in range(count)]
+        start = time.time()
+        mine = SHA256.hash_many(messages)
+        elapsed = time.time() - start
+        print ('hash_many: %d hashes (%d bytes each) in %0.2f secs (%0.2f H/s)' % (len(messages), length, elapsed, float(len(messages)) / elapsed))
+
+        for a, m in zip(mine, messages):
+            assert a == hashlib.sha256(m).digest(), 'hash_many() got %r calculating SHA256(%r)' % (a, m)
 
 # eof